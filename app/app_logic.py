@@ -1,18 +1,28 @@
+import base64
 import datetime
+import hashlib
 import sys
 import logging
 import os, re
 import app.transformers_util
 from app import html_parser
-from app.db_connector import get_engine
+from app.db_connector import get_engine, get_async_engine
+from app.document_events import NOTIFY_QUERY, notify_params
+from app.embedding_search import find_nearest_documents
 from app.models import (
     Bookmark,
     Entity,
+    CanonicalEntity,
+    DocumentEntity,
+    IdentifyEntity,
     Page,
     Document,
     PagePayload,
     DocumentDisplay,
     Document_Embeddings,
+    Job,
+    LlmResultCache,
+    DocumentJsonForLLMS,
 )
 from app.together_api_client import (
     TogetherMixtralOpenAIClient,
@@ -22,6 +32,7 @@ from app.together_api_client import (
 from sqlalchemy import (
     select,
     delete,
+    update,
     create_engine,
     and_,
     or_,
@@ -30,7 +41,9 @@ from sqlalchemy import (
     func,
     text,
 )
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 
 logging.basicConfig(
@@ -43,6 +56,7 @@ logging.basicConfig(
 env_vers = os.environ
 
 engine = get_engine()
+async_engine = get_async_engine()
 
 mixtralClient = TogetherMixtralClient()
 
@@ -70,6 +84,9 @@ def delete_bookmark_and_associate_records(bookmark_id) -> None:
         session.execute(delete(Document).where(Document.id == doc.id))
         session.execute(delete(Bookmark).where(Bookmark.id == bookmark_id))
         session.execute(delete(Entity).where(Entity.document_id == doc.id))
+        session.execute(
+            delete(DocumentEntity).where(DocumentEntity.document_id == doc.id)
+        )
         session.commit()
         logging.info(f"Bookmark {bookmark_id} and associated records deleted")
 
@@ -83,7 +100,9 @@ def delete_document_and_associate_records(document_id) -> None:
     with Session(engine) as session:
         session.execute(delete(Document).where(Document.id == document_id))
         session.execute(delete(Entity).where(Entity.document_id == document_id))
-        session.execute(delete(Concept).where(Concept.document_id == document_id))
+        session.execute(
+            delete(DocumentEntity).where(DocumentEntity.document_id == document_id)
+        )
         session.commit()
         logging.info(f"Document {document_id} and associated records deleted")
 
@@ -110,6 +129,15 @@ def get_document_by_bookmark_id(bookmark_id) -> Document:
     return doc
 
 
+async def get_document_by_bookmark_id_async(bookmark_id) -> Document:
+    async with AsyncSession(async_engine) as session:
+        return await session.scalar(
+            select(Document)
+            .join(Bookmark, Bookmark.document_id == Document.id)
+            .where(Bookmark.id == bookmark_id)
+        )
+
+
 def get_document_by_id(document_id) -> Document:
     session = Session(engine)
     doc = session.scalar(select(Document).where(Document.id == document_id))
@@ -117,6 +145,11 @@ def get_document_by_id(document_id) -> Document:
     return doc
 
 
+async def get_document_by_id_async(document_id) -> Document:
+    async with AsyncSession(async_engine) as session:
+        return await session.scalar(select(Document).where(Document.id == document_id))
+
+
 def get_document_by_url(url) -> Document:
     session = Session(engine)
     doc = session.scalar(select(Document).where(Document.url == url))
@@ -130,15 +163,6 @@ def get_documents_ids() -> list[int]:
     return docs_ids
 
 
-def get_entities_by_document_id(document_id) -> Entity:
-    session = Session(engine)
-    entities = session.scalars(
-        select(Entity).where(Entity.document_id == document_id)
-    ).all()
-    session.close()
-    return entities
-
-
 def create_page(payload: PagePayload) -> Page:
     page = html_parser.create_page(payload)
     if page == None:
@@ -148,6 +172,24 @@ def create_page(payload: PagePayload) -> Page:
     return page
 
 
+async def create_page_async(payload: PagePayload) -> Page:
+    page = await html_parser.create_page_async(payload)
+    if page == None:
+        logging.info(f"Page not found for url {payload.url}")
+        return None
+
+    return page
+
+
+async def create_page_from_stream(url: str, chunks, encoding: str = None) -> Page:
+    page = await html_parser.create_page_from_stream(url, chunks, encoding)
+    if page == None:
+        logging.info(f"Page not found for url {url}")
+        return None
+
+    return page
+
+
 def create_document(page: Page):
     session = Session(engine)
     doc = session.scalar(select(Document).where(Document.url == page.clean_url))
@@ -169,6 +211,27 @@ def create_document(page: Page):
     return doc
 
 
+async def create_document_async(page: Page) -> Document:
+    async with AsyncSession(async_engine) as session:
+        doc = await session.scalar(
+            select(Document).where(Document.url == page.clean_url)
+        )
+
+        ## If Document isn't already exist, create it
+        if doc:
+            return doc
+
+        doc = Document()
+        doc.title = page.title.strip()
+        doc.url = page.clean_url
+        doc.original_text = page.full_text
+        session.add(doc)
+        await session.commit()
+        await session.refresh(doc)
+
+        return doc
+
+
 def clone_document(doc: Document):
 
     old_doc = get_document_by_id(doc.id)
@@ -197,11 +260,28 @@ def update_document(doc: Document, related_objects: list[list] = None):
             logging.info(f"Adding related objects to document {doc.id}")
             for related_object in related_objects:
                 session.add_all(related_object)
+        ## Wakes the /document_plus event streams of the document, sent on commit
+        session.execute(NOTIFY_QUERY, notify_params(doc.id, doc.status))
         session.commit()
         session.refresh(doc)
         return doc
 
 
+async def update_document_async(doc: Document, related_objects: list[list] = None):
+    async with AsyncSession(async_engine) as session:
+        session.add(doc)
+
+        if related_objects:
+            logging.info(f"Adding related objects to document {doc.id}")
+            for related_object in related_objects:
+                session.add_all(related_object)
+        ## Wakes the /document_plus event streams of the document, sent on commit
+        await session.execute(NOTIFY_QUERY, notify_params(doc.id, doc.status))
+        await session.commit()
+        await session.refresh(doc)
+        return doc
+
+
 def reassociate_bookmark_with_document(old_document_id, new_document_id):
     """
     This function reassociate a bookmark with a new document
@@ -225,32 +305,211 @@ def reassociate_bookmark_with_document(old_document_id, new_document_id):
         return bookmark
 
 
-async def extract_info_from_doc(doc: Document):
+def normalize_entity_name(name: str) -> str:
+    return " ".join(name.split()).lower()
+
+
+def normalize_entity_type(type: str) -> str:
+    type = " ".join((type or "").split()).lower()
+    return type or "unknown"
+
+
+async def save_document_entities_async(
+    document_id: int, entities: list[IdentifyEntity], source: str
+) -> None:
+    """
+    Upsert the entities generated by the LLM into canonical_entity and link them to the document.
+    Entities with the same normalized name and type as an existing one reuse its row.
+    """
+    new_entities = {}
+    for entity in entities:
+        if not entity.name:
+            continue
+        key = (normalize_entity_name(entity.name), normalize_entity_type(entity.type))
+        new_entities.setdefault(key, entity)
+
+    if len(new_entities) == 0:
+        return
+
+    async with AsyncSession(async_engine) as session:
+        stmt = pg_insert(CanonicalEntity).values(
+            [
+                {"name": entity.name.strip(), "normalized_name": name, "type": type}
+                for (name, type), entity in new_entities.items()
+            ]
+        )
+        ## No-op update so RETURNING also gives the ids of entities that already exist
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["normalized_name", "type"],
+            set_={"normalized_name": stmt.excluded.normalized_name},
+        ).returning(
+            CanonicalEntity.id, CanonicalEntity.normalized_name, CanonicalEntity.type
+        )
+        rows = await session.execute(stmt)
+        entity_ids = {(name, type): id for id, name, type in rows.all()}
+
+        await session.execute(
+            pg_insert(DocumentEntity)
+            .values(
+                [
+                    {
+                        "document_id": document_id,
+                        "entity_id": entity_ids[key],
+                        "description": entity.explanation,
+                        "source": source,
+                    }
+                    for key, entity in new_entities.items()
+                ]
+            )
+            .on_conflict_do_nothing()
+        )
+        await session.commit()
+        logging.info(f"Linked {len(new_entities)} entities to document {document_id}")
+
+
+def document_entities_query():
+    """Select (DocumentEntity, CanonicalEntity) pairs, filter with .where()"""
+    return select(DocumentEntity, CanonicalEntity).join(
+        CanonicalEntity, CanonicalEntity.id == DocumentEntity.entity_id
+    )
+
+
+def to_entity(link: DocumentEntity, canonical: CanonicalEntity) -> Entity:
+    """Entity as returned by the API, for a canonical entity linked to a document"""
+    return Entity(
+        id=canonical.id,
+        document_id=link.document_id,
+        name=canonical.name,
+        description=link.description,
+        source=link.source,
+        type=canonical.type,
+        score=link.score,
+    )
+
+
+LLM_SUMMARIZATION_MODE = os.environ.get("LLM_SUMMARIZATION_MODE", "single")
+## Stream LLM answers and save the summary fields on the document as soon as they're generated
+LLM_STREAM = os.environ.get("LLM_STREAM", "true").lower() == "true"
+
+
+def llm_cache_key(text: str, summarization_mode: str = "single") -> str:
+    """Hash of the whitespace normalized text, the prompt version, the model name and the mode"""
+    normalized_text = " ".join(text.split())
+    prefix = f"{mixtralClient._model_name}\n{mixtralClient._prompt_version}"
+    if summarization_mode != "single":
+        prefix += f"\n{summarization_mode}"
+    return hashlib.sha256(f"{prefix}\n{normalized_text}".encode()).hexdigest()
+
+
+async def get_cached_llm_result_async(key: str) -> DocumentJsonForLLMS:
+    async with AsyncSession(async_engine) as session:
+        cached = await session.get(LlmResultCache, key)
+
+    if cached is None:
+        return None
+
+    response = DocumentJsonForLLMS.model_validate({**cached.result, "usage": None})
+    response.usage = {**(cached.usage or {}), "cached": True}
+    return response
+
+
+async def save_llm_result_async(key: str, response: DocumentJsonForLLMS) -> None:
+    async with AsyncSession(async_engine) as session:
+        await session.execute(
+            pg_insert(LlmResultCache)
+            .values(
+                key=key,
+                model_name=mixtralClient._model_name,
+                prompt_version=mixtralClient._prompt_version,
+                result=response.model_dump(exclude={"usage"}),
+                usage=response.usage,
+                created_at=datetime.datetime.utcnow(),
+            )
+            .on_conflict_do_nothing()
+        )
+        await session.commit()
+
+
+def clean_bullet_points(points: list[str]) -> list[str]:
+    return [re.sub(r"[1-9]{,2}\.", "", point).strip() for point in points]
+
+
+def partial_result_saver(doc: Document):
+    """
+    on_field callback for a streamed LLM answer, saves the one sentence summary, what the article
+    is about and the bullet points while the rest of the answer is generated.
+    The document stays Processing, /document_plus returns these fields with a 206.
+    """
+
+    async def save_partial_field(key: str, value) -> None:
+        if key == "oneSentenceSummary" and isinstance(value, str) and value:
+            doc.short_summary = value
+        elif key == "whatThisArticleIsAbout" and isinstance(value, str) and value:
+            doc.is_about = value
+        elif key == "summaryInNumericBulletPoints" and isinstance(value, list) and value:
+            doc.summary_bullet_points = clean_bullet_points(
+                [str(point) for point in value]
+            )
+        else:
+            return
+
+        try:
+            await update_document_async(doc)
+            logging.info(f"Saved streamed {key} for document {doc.id}")
+        except Exception as e:
+            logging.error(f"Error saving streamed {key} for document {doc.id} {e}")
+
+    return save_partial_field
+
+
+async def extract_info_from_doc(doc: Document, summarization_mode: str = None):
     """
     Function that takes pages and return a document with the generated summary,
-    bullet points and entities generate by LLM
+    bullet points and entities generate by LLM.
+    summarization_mode is single (compress the article to fit the prompt) or map_reduce
+    (summarize chunks of long articles, then combine), LLM_SUMMARIZATION_MODE by default.
     """
+    summarization_mode = summarization_mode or LLM_SUMMARIZATION_MODE
 
     doc.status = "Processing"
-    update_document(doc)
+    await update_document_async(doc)
 
     try:
-        logging.info(f"Generating summary for document {doc.id}")
-        response = await mixtralClient.generate(doc.original_text)
-        logging.info(f"Response from LLM {response}")
+        cache_key = llm_cache_key(doc.original_text, summarization_mode)
+        response = await get_cached_llm_result_async(cache_key)
+
+        if response is not None:
+            logging.info(f"Using cached LLM result for document {doc.id}")
+        else:
+            logging.info(f"Generating summary for document {doc.id} ({summarization_mode})")
+            on_field = partial_result_saver(doc) if LLM_STREAM else None
+            if summarization_mode == "map_reduce":
+                response = await mixtralClient.generate_map_reduce(
+                    doc.original_text, on_field=on_field
+                )
+            else:
+                response = await mixtralClient.generate(
+                    doc.original_text, on_field=on_field
+                )
+            logging.info(f"Response from LLM {response}")
+
+            try:
+                await save_llm_result_async(cache_key, response)
+            except Exception as e:
+                logging.error(f"Error caching LLM result for document {doc.id} {e}")
 
     except ApiCallException as e:
         logging.error(f"Error generating with LLM {e}")
-        ## TODO store exception in DB
 
         doc.status = "Api Failure"
-        update_document(doc)
+        doc.llm_service_meta = {"retries": e.attempts - 1, "error": e.response}
+        await update_document_async(doc)
         return
 
     except Exception as e:
         logging.error(f"Error generating with LLM {e}")
         doc.status = "Failure"
-        update_document(doc)
+        await update_document_async(doc)
         return
 
     try:
@@ -265,10 +524,9 @@ async def extract_info_from_doc(doc: Document):
             doc.is_about = "No article is about was generated"
 
         if response.summaryInNumericBulletPoints:
-            doc.summary_bullet_points = [
-                re.sub(r"[1-9]{,2}\.", "", point).strip()
-                for point in response.summaryInNumericBulletPoints
-            ]
+            doc.summary_bullet_points = clean_bullet_points(
+                response.summaryInNumericBulletPoints
+            )
 
         else:
             doc.summary_bullet_points = ["No bullet points were generated"]
@@ -277,27 +535,163 @@ async def extract_info_from_doc(doc: Document):
             doc.llm_service_meta = response.usage
 
         if response.entities_and_concepts:
-            new_entities = []
-            for entity in response.entities_and_concepts:
-                new_entity = Entity()
-                new_entity.document_id = doc.id
-                new_entity.name = entity.name
-                new_entity.description = entity.explanation
-                new_entity.type = entity.type
-                new_entity.source = mixtralClient._model_name
-                new_entities.append(new_entity)
+            await save_document_entities_async(
+                doc.id, response.entities_and_concepts, mixtralClient._model_name
+            )
 
         logging.info(f"LLM ussage was {response.usage}")
 
         doc.update_at = datetime.datetime.now()
         doc.status = "Done"
 
-        return update_document(doc, [new_entities])
+        return await update_document_async(doc)
 
     except Exception as e:
         doc.status = "Failure"
         logging.error(f"Error generating with LLM {e}")
-        update_document(doc)
+        await update_document_async(doc)
+
+
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = int(os.environ.get("JOB_RETRY_DELAY", 30))
+## A Running job not updated for this long belongs to a worker that died, it can be claimed again
+JOB_LOCK_TIMEOUT = int(os.environ.get("JOB_LOCK_TIMEOUT", 15 * 60))
+## Workers refresh locked_at this often while a job runs, so long LLM runs aren't reclaimed
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", JOB_LOCK_TIMEOUT / 5))
+
+ACTIVE_JOB_STATUSES = ["Pending", "Running"]
+
+
+async def enqueue_job_async(
+    document_id: int, kind: str = "generate", summarization_mode: str = None
+) -> Job:
+    """
+    Queue a job for the document, unless one is already pending or running for it.
+    The partial unique index ix_job_active_document_id makes concurrent enqueues of the same
+    document insert a single job.
+    """
+    async with AsyncSession(async_engine) as session:
+        job_id = await session.scalar(
+            pg_insert(Job)
+            .values(
+                kind=kind,
+                document_id=document_id,
+                summarization_mode=summarization_mode or LLM_SUMMARIZATION_MODE,
+                status="Pending",
+                attempts=0,
+                max_attempts=JOB_MAX_ATTEMPTS,
+                run_after=datetime.datetime.utcnow(),
+                created_at=datetime.datetime.utcnow(),
+                update_at=datetime.datetime.utcnow(),
+            )
+            .on_conflict_do_nothing(
+                index_elements=["document_id"],
+                ## A literal predicate, Postgres can't match bind parameters to the index's
+                index_where=text("status IN ('Pending', 'Running')"),
+            )
+            .returning(Job.id)
+        )
+        await session.commit()
+
+        if job_id is None:
+            job = await session.scalar(
+                select(Job).where(
+                    Job.document_id == document_id,
+                    Job.status.in_(ACTIVE_JOB_STATUSES),
+                )
+            )
+            logging.info(f"Job {job.id if job else None} already queued for document {document_id}")
+            return job
+
+        job = await session.get(Job, job_id)
+        logging.info(f"Job {job.id} {kind} queued for document {document_id}")
+        return job
+
+
+async def claim_job_async() -> Job:
+    """
+    Claim the oldest runnable job, or one whose worker stopped updating it.
+    SKIP LOCKED lets any number of workers claim concurrently without waiting on each other.
+    """
+    now = datetime.datetime.utcnow()
+    async with AsyncSession(async_engine) as session:
+        job = await session.scalar(
+            select(Job)
+            .where(
+                or_(
+                    and_(Job.status == "Pending", Job.run_after <= now),
+                    and_(
+                        Job.status == "Running",
+                        Job.locked_at
+                        < now - datetime.timedelta(seconds=JOB_LOCK_TIMEOUT),
+                    ),
+                )
+            )
+            .order_by(Job.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if job is None:
+            return None
+
+        job.status = "Running"
+        job.attempts += 1
+        job.locked_at = now
+        job.update_at = now
+        await session.commit()
+        await session.refresh(job)
+        return job
+
+
+def owned_job(job: Job):
+    """
+    Where clause matching the job only while this claim of it is running. A job reclaimed after
+    JOB_LOCK_TIMEOUT has more attempts, so the worker that lost it can't update it any more.
+    """
+    return and_(Job.id == job.id, Job.status == "Running", Job.attempts == job.attempts)
+
+
+async def update_owned_job_async(job: Job, **values) -> bool:
+    """Update the job if this worker still owns it, False when it was claimed again or finished"""
+    async with AsyncSession(async_engine) as session:
+        result = await session.execute(update(Job).where(owned_job(job)).values(**values))
+        await session.commit()
+    if result.rowcount == 0:
+        logging.warning(f"Job {job.id} attempt {job.attempts} is no longer owned by this worker")
+        return False
+    for key, value in values.items():
+        setattr(job, key, value)
+    return True
+
+
+async def heartbeat_job_async(job: Job) -> bool:
+    """
+    Refresh locked_at of a running job. False when the job was claimed again by another worker
+    (its attempts moved on) or is no longer running.
+    """
+    now = datetime.datetime.utcnow()
+    return await update_owned_job_async(job, locked_at=now, update_at=now)
+
+
+async def complete_job_async(job: Job) -> bool:
+    return await update_owned_job_async(
+        job, status="Done", update_at=datetime.datetime.utcnow()
+    )
+
+
+async def fail_job_async(job: Job, error: str) -> bool:
+    """Put the job back in the queue with an exponential delay, or mark it Failed after max_attempts"""
+    now = datetime.datetime.utcnow()
+    values = {"last_error": error, "update_at": now}
+    if job.attempts < job.max_attempts:
+        values["status"] = "Pending"
+        values["run_after"] = now + datetime.timedelta(
+            seconds=JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+        )
+    else:
+        values["status"] = "Failed"
+
+    return await update_owned_job_async(job, **values)
 
 
 def create_bookmark(page: Page, user_id: str) -> Bookmark:
@@ -335,6 +729,38 @@ def create_bookmark(page: Page, user_id: str) -> Bookmark:
     return bookmark
 
 
+async def create_bookmark_async(page: Page, user_id: str) -> Bookmark:
+    async with AsyncSession(async_engine) as session:
+
+        # Check if document exists, retrieve the bookmark and return
+        # if exists. Else, create the document, bookmark.
+
+        bookmark = await session.scalar(
+            select(Bookmark).where(
+                and_(Bookmark.url == page.clean_url, Bookmark.user_id == user_id)
+            )
+        )
+
+        if bookmark:
+            logging.info(f"Bookmark from url {page.clean_url} already exists")
+            return bookmark
+
+        doc = await create_document_async(page)
+
+        bookmark = Bookmark()
+        bookmark.url = page.clean_url
+        bookmark.update_at = datetime.datetime.now()
+        bookmark.document_id = doc.id
+        bookmark.user_id = user_id
+
+        session.add(bookmark)
+        await session.commit()
+        await session.refresh(bookmark)
+        logging.info(f"Bookmark was created with id {bookmark.id}")
+
+        return bookmark
+
+
 def get_bookmarks_by_user_id(user_id: str) -> list[Bookmark]:
     session = Session(engine)
     bookmarks = session.scalars(
@@ -346,6 +772,114 @@ def get_bookmarks_by_user_id(user_id: str) -> list[Bookmark]:
     return bookmarks
 
 
+def encode_cursor(bookmark: Bookmark) -> str:
+    """Opaque keyset cursor pointing after the given bookmark"""
+    value = f"{bookmark.update_at.isoformat()},{bookmark.id}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime.datetime, int]:
+    """Returns (update_at, id) of a cursor. Raises ValueError if the cursor is malformed"""
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        update_at, id = value.split(",")
+        return datetime.datetime.fromisoformat(update_at), int(id)
+    except ValueError as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+
+def paginate_bookmarks(stmt, limit: int = None, cursor: str = None):
+    """
+    Apply keyset pagination over (update_at desc, id) to a statement selecting from Bookmark.
+    One extra row is requested to tell whether there is a next page.
+    """
+    stmt = stmt.order_by(Bookmark.update_at.desc(), Bookmark.id)
+
+    if cursor:
+        update_at, id = decode_cursor(cursor)
+        stmt = stmt.where(
+            or_(
+                Bookmark.update_at < update_at,
+                and_(Bookmark.update_at == update_at, Bookmark.id > id),
+            )
+        )
+
+    if limit:
+        stmt = stmt.limit(limit + 1)
+
+    return stmt
+
+
+def next_page(rows: list, limit: int = None, bookmark=lambda row: row) -> tuple[list, str]:
+    """Trim the extra row fetched by paginate_bookmarks and return (rows, next_cursor)"""
+    if limit is None or len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, encode_cursor(bookmark(rows[-1]))
+
+
+async def get_bookmarks_by_user_id_async(
+    user_id: str, limit: int = None, cursor: str = None
+) -> tuple[list[Bookmark], str]:
+    async with AsyncSession(async_engine) as session:
+        bookmarks = await session.scalars(
+            paginate_bookmarks(
+                select(Bookmark).where(Bookmark.user_id == user_id), limit, cursor
+            )
+        )
+        return next_page(bookmarks.all(), limit)
+
+
+def assemble_documents_display(
+    documents: list[Document], entities: list[Entity]
+) -> list[DocumentDisplay]:
+    """
+    Group entities by document in one pass and build a DocumentDisplay per document,
+    keeping the order of documents.
+    """
+    entities_by_document = {}
+    for entity in entities:
+        entities_by_document.setdefault(entity.document_id, []).append(entity)
+
+    return [
+        DocumentDisplay.from_orm(
+            document, entities=entities_by_document.get(document.id, [])
+        )
+        for document in documents
+    ]
+
+
+async def get_documents_plus_by_user_id_async(
+    user_id: str, limit: int = None, cursor: str = None
+) -> tuple[list[DocumentDisplay], str]:
+    """
+    Load the user's bookmarked documents and their entities in two queries,
+    no matter how many bookmarks the user has.
+    """
+    async with AsyncSession(async_engine) as session:
+        rows = await session.execute(
+            paginate_bookmarks(
+                select(Bookmark, Document)
+                .join(Document, Bookmark.document_id == Document.id)
+                .where(Bookmark.user_id == user_id),
+                limit,
+                cursor,
+            )
+        )
+        rows, next_cursor = next_page(rows.all(), limit, lambda row: row[0])
+        documents = [row[1] for row in rows]
+
+        entities = await session.execute(
+            document_entities_query().where(
+                DocumentEntity.document_id.in_([document.id for document in documents])
+            )
+        )
+        entities = [to_entity(*row) for row in entities.all()]
+
+    return assemble_documents_display(documents, entities), next_cursor
+
+
 def get_bookmark_by_document_id(document_id: int) -> Bookmark:
     session = Session(engine)
     bookmark = session.scalar(
@@ -363,6 +897,12 @@ def get_bookmark_by_url(url: str) -> Bookmark:
     return bookmark
 
 
+async def get_bookmark_by_url_async(url: str) -> Bookmark:
+    url = html_parser.clean_url(url)
+    async with AsyncSession(async_engine) as session:
+        return await session.scalar(select(Bookmark).where(Bookmark.url == url))
+
+
 def get_bookmark_document(id: int) -> Document:
     session = Session(engine)
     doc = session.scalar(select(Document).where(Document.bookmark_id == id))
@@ -377,95 +917,159 @@ def get_bookmark_by_id(id: int) -> Bookmark:
     return bookmark
 
 
+async def get_bookmark_by_id_async(id: int) -> Bookmark:
+    async with AsyncSession(async_engine) as session:
+        return await session.scalar(select(Bookmark).where(Bookmark.id == id))
+
+
 def get_entities_by_document_id(document_id) -> list[Entity]:
-    session = Session(engine)
-    entities = session.scalars(
-        select(Entity).where(Entity.document_id == document_id)
-    ).all()
-    session.close()
-    return entities
+    with Session(engine) as session:
+        rows = session.execute(
+            document_entities_query().where(DocumentEntity.document_id == document_id)
+        ).all()
+    return [to_entity(*row) for row in rows]
+
+
+async def get_entities_by_document_id_async(document_id) -> list[Entity]:
+    async with AsyncSession(async_engine) as session:
+        rows = await session.execute(
+            document_entities_query().where(DocumentEntity.document_id == document_id)
+        )
+        return [to_entity(*row) for row in rows.all()]
 
 
 def get_entities_by_user_id(user_id: str) -> list[Entity]:
-    session = Session(engine)
-    entities = session.scalars(
-        select(Entity)
-        .join(Document, Document.id == Entity.document_id)
-        .join(Bookmark, Bookmark.document_id == Document.id)
-        .where(Bookmark.user_id == user_id)
-    ).all()
-    session.close()
-    return entities
+    with Session(engine) as session:
+        rows = session.execute(
+            document_entities_query()
+            .join(Bookmark, Bookmark.document_id == DocumentEntity.document_id)
+            .where(Bookmark.user_id == user_id)
+        ).all()
+    return [to_entity(*row) for row in rows]
+
+
+async def get_entities_by_user_id_async(
+    user_id: str, limit: int = None, cursor: str = None
+) -> tuple[list[Entity], str]:
+    """Entities of the user's documents, paginated over the user's bookmarks"""
+    async with AsyncSession(async_engine) as session:
+        bookmarks = await session.scalars(
+            paginate_bookmarks(
+                select(Bookmark).where(Bookmark.user_id == user_id), limit, cursor
+            )
+        )
+        bookmarks, next_cursor = next_page(bookmarks.all(), limit)
+
+        rows = await session.execute(
+            document_entities_query().where(
+                DocumentEntity.document_id.in_(
+                    [bookmark.document_id for bookmark in bookmarks]
+                )
+            )
+        )
+        return [to_entity(*row) for row in rows.all()], next_cursor
 
 
 def get_entities_by_user_id_and_type(user_id: str, type: str) -> list[Entity]:
-    session = Session(engine)
-    entities = session.scalars(
-        select(Entity)
-        .join(Document, Document.id == Entity.document_id)
-        .join(Bookmark, Bookmark.document_id == Document.id)
-        .where(Bookmark.user_id == user_id, Entity.type == type)
-    ).all()
-    session.close()
-    return entities
+    with Session(engine) as session:
+        rows = session.execute(
+            document_entities_query()
+            .join(Bookmark, Bookmark.document_id == DocumentEntity.document_id)
+            .where(
+                Bookmark.user_id == user_id,
+                CanonicalEntity.type == normalize_entity_type(type),
+            )
+        ).all()
+    return [to_entity(*row) for row in rows]
 
 
 def get_documenets_by_entity_id(entity_id: int) -> list[Document]:
     session = Session(engine)
     documents = session.scalars(
         select(Document)
-        .join(Entity, Entity.document_id == Document.id)
-        .where(Entity.id == entity_id)
+        .join(DocumentEntity, DocumentEntity.document_id == Document.id)
+        .where(DocumentEntity.entity_id == entity_id)
     ).all()
     session.close()
     return documents
 
 
-def get_entities_tree_by_user_id(user_id: str) -> list:
-    session = Session(engine)
-    queryTypes = text(
-        """select e.type 
-	            from entity e
-	            join document d on e.document_id = d.id
-	            join bookmark b on b.document_id = d.id
-	            where b.user_id = '{USER_ID}'
-	        group by 1""".format(
-            USER_ID=user_id
-        )
+def entities_tree_query(user_id: str):
+    """(type, entity name, document id, document title) rows of the user's entities"""
+    return (
+        select(CanonicalEntity.type, CanonicalEntity.name, Document.id, Document.title)
+        .join(DocumentEntity, DocumentEntity.entity_id == CanonicalEntity.id)
+        .join(Document, Document.id == DocumentEntity.document_id)
+        .join(Bookmark, Bookmark.document_id == Document.id)
+        .where(Bookmark.user_id == user_id)
+        .order_by(CanonicalEntity.type, CanonicalEntity.name, Document.id)
     )
 
-    types = session.execute(queryTypes).fetchall()
-    nodes = []
-    for index, type in enumerate(types):
-        node = {}
-        node["key"] = str(index)
-        node["label"] = type[0]
-        node["data"] = type[0] + " folder"
-        node["children"] = []
-
-        entities_nodes = get_entities_by_user_id_and_type(user_id, type[0])
-        for index2, entity in enumerate(entities_nodes):
-            entity_node = {}
-            entity_node["key"] = node["key"] + "-" + str(index2)
-            entity_node["label"] = entity.name
-            entity_node["data"] = entity.name + " entity"
-            entity_node["children"] = []
 
+def build_entities_tree(rows) -> list:
+    """
+    Group (type, entity name, document id, document title) rows into a
+    type -> entity -> document tree in one pass over the rows.
+    """
+    nodes = []
+    type_nodes = {}
+    entity_nodes = {}
+    document_keys = set()
+
+    for type, name, document_id, title in rows:
+        type = type or "unknown"
+        title = title or "Untitled"
+
+        node = type_nodes.get(type)
+        if node is None:
+            node = {
+                "key": str(len(nodes)),
+                "label": type,
+                "data": type + " folder",
+                "children": [],
+            }
+            type_nodes[type] = node
+            nodes.append(node)
+
+        entity_node = entity_nodes.get((type, name))
+        if entity_node is None:
+            entity_node = {
+                "key": node["key"] + "-" + str(len(node["children"])),
+                "label": name,
+                "data": f"{name} entity",
+                "children": [],
+            }
+            entity_nodes[(type, name)] = entity_node
             node["children"].append(entity_node)
 
-            documents = get_documenets_by_entity_id(entity.id)
-            for index3, document in enumerate(documents):
-                document_node = {}
-                document_node["key"] = entity_node["key"] + "-" + str(index3)
-                document_node["label"] = document.title
-                document_node["data"] = document.title + " document"
-                entity_node["children"].append(document_node)
-        nodes.append(node)
+        ## The same entity can be extracted more than once from a document
+        if (type, name, document_id) in document_keys:
+            continue
+        document_keys.add((type, name, document_id))
+
+        entity_node["children"].append(
+            {
+                "key": entity_node["key"] + "-" + str(len(entity_node["children"])),
+                "label": title,
+                "data": title + " document",
+            }
+        )
 
-    session.close()
     return nodes
 
 
+def get_entities_tree_by_user_id(user_id: str) -> list:
+    with Session(engine) as session:
+        rows = session.execute(entities_tree_query(user_id)).all()
+    return build_entities_tree(rows)
+
+
+async def get_entities_tree_by_user_id_async(user_id: str) -> list:
+    async with AsyncSession(async_engine) as session:
+        rows = await session.execute(entities_tree_query(user_id))
+        return build_entities_tree(rows.all())
+
+
 def search_documents(user_id: str, search_term: str = None) -> list[Document]:
     session = Session(engine)
 
@@ -531,36 +1135,41 @@ async def generate_documents_embeddings():
         raise e
 
 
-def search_embeddings(user_id: str, search_term: str) -> list[DocumentDisplay]:
+async def search_embeddings(
+    user_id: str, search_term: str, top_k: int = 10
+) -> list[DocumentDisplay]:
     """
-    This function searches for document embeddings by search term
+    This function searches for the top_k documents whose embeddings are closest to the search term
     """
     logging.info(f"Generate embeddings for term {search_term}")
-    embedded_term = app.transformers_util.generate_embeddings(search_term) ## Generate embeddings for search term
+    embedded_term = await app.transformers_util.generate_embeddings_async(search_term) ## Generate embeddings for search term
     logging.info(f"Embeddings for term {search_term} are length is {len(embedded_term)}")
 
     # Get document with some embeddings that are closest to the search term
     logging.info(f"Searching for documents with embeddings closest to term {search_term}")
 
-    with Session(engine) as session:
-        stmt = text("""SELECT a.document_id, a.cosine_similarity
-                    FROM (SELECT de.document_id, MIN(1 - (de.embeddings <=> :vector)) AS cosine_similarity 
-                        FROM document_embeddings AS de
-                        JOIN bookmark ON de.document_id = bookmark.document_id
-                        WHERE bookmark.user_id = :user_id 
-                        GROUP BY de.document_id) a
-                    WHERE a.cosine_similarity > 0.05
-                    ORDER BY a.cosine_similarity DESC""")
-        
-        matched_documents = session.execute(stmt, {"vector": str(embedded_term.tolist()), "user_id": user_id}).all()
-        
+    async with AsyncSession(async_engine) as session:
+        matched_documents = await find_nearest_documents(
+            session, str(embedded_term.tolist()), user_id, top_k
+        )
+        similarities = {md[0]: md[1] for md in matched_documents}
+
+        documents = await session.scalars(
+            select(Document).where(Document.id.in_(list(similarities)))
+        )
+        documents = sorted(documents.all(), key=lambda doc: -similarities[doc.id])
+
+        entities = await session.execute(
+            document_entities_query().where(
+                DocumentEntity.document_id.in_(list(similarities))
+            )
+        )
+        entities = [to_entity(*row) for row in entities.all()]
+
     logging.info(f"Found {len(matched_documents)} matched document for term {search_term}")
 
-    results = []
-    for md in matched_documents:
-        document = get_document_by_id(md[0])
-        entities = get_entities_by_document_id(md[0])
-        display = DocumentDisplay.from_orm(document, entities=entities, cosine_similarity=md[1])
-        results.append(display)    
+    results = assemble_documents_display(documents, entities)
+    for display in results:
+        display.cosine_similarity = similarities[display.id]
 
-    return results
\ No newline at end of file
+    return results
@@ -1,6 +1,9 @@
-import os, sys
+import os, sys, time
 import logging
+import bisect
 import sqlalchemy
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
 
 logging.basicConfig(
@@ -10,6 +13,103 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
+""" Connection pool settings, overridable from the environment """
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.environ.get("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.environ.get("DB_POOL_PRE_PING", "true").lower() == "true"
+
+POOL_WAIT_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30]
+
+pool_metrics = {}
+
+
+class PoolMetrics:
+    """
+    Counters for a single connection pool. The wait time histogram counts how long
+    callers waited to check out a connection, using cumulative buckets in seconds.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.pool = None
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_count = 0
+        self.wait_sum = 0.0
+        self.wait_buckets = [0] * (len(POOL_WAIT_BUCKETS) + 1)
+
+    def observe_wait(self, seconds: float) -> None:
+        self.wait_count += 1
+        self.wait_sum += seconds
+        self.wait_buckets[bisect.bisect_left(POOL_WAIT_BUCKETS, seconds)] += 1
+
+    def snapshot(self) -> dict:
+        histogram = {}
+        total = 0
+        for bound, count in zip(POOL_WAIT_BUCKETS + ["+Inf"], self.wait_buckets):
+            total += count
+            histogram[str(bound)] = total
+
+        return {
+            "name": self.name,
+            "pool_size": self.pool.size() if self.pool else None,
+            "checked_out": self.pool.checkedout() if self.pool else None,
+            "checked_in": self.pool.checkedin() if self.pool else None,
+            "overflow": self.pool.overflow() if self.pool else None,
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "wait_count": self.wait_count,
+            "wait_sum": self.wait_sum,
+            "wait_histogram": histogram,
+        }
+
+
+class InstrumentedPoolMixin:
+    """Times every checkout of the pool it is mixed into and records it on `metrics`"""
+
+    metrics: PoolMetrics = None
+
+    def _do_get(self):
+        self.metrics.pool = self
+        start_time = time.perf_counter()
+        try:
+            connection = super()._do_get()
+            self.metrics.checkouts += 1
+            return connection
+        except sqlalchemy.exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            self.metrics.observe_wait(time.perf_counter() - start_time)
+
+
+def pool_options(name: str, poolclass: type) -> dict:
+    """Build the engine pool arguments and register the pool metrics under name"""
+    metrics = PoolMetrics(name)
+    pool_metrics[name] = metrics
+    logging.info(
+        f"Pool {name}: size {DB_POOL_SIZE}, overflow {DB_MAX_OVERFLOW}, timeout {DB_POOL_TIMEOUT}, "
+        f"recycle {DB_POOL_RECYCLE}, pre_ping {DB_POOL_PRE_PING}"
+    )
+    return {
+        "poolclass": type(
+            f"Instrumented{poolclass.__name__}",
+            (InstrumentedPoolMixin, poolclass),
+            {"metrics": metrics},
+        ),
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def get_pool_metrics() -> list[dict]:
+    return [metrics.snapshot() for metrics in pool_metrics.values()]
+
 
 def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
 
@@ -35,6 +135,7 @@ def connect_unix_socket() -> sqlalchemy.engine.base.Engine:
             query={"unix_sock": f"/cloudsql/{instance_connection_name}/.s.PGSQL.5432"},
         ),
         client_encoding="utf8",
+        **pool_options("sync", QueuePool),
     )
     logging.info(f"Connected to database using Unix socket")
     return pool
@@ -58,6 +159,7 @@ def connect() -> sqlalchemy.engine.base.Engine:
             database=db_name,
         ),
         client_encoding="utf8",
+        **pool_options("sync", QueuePool),
     )
     logging.info(f"Connected to database using TCP")
     return pool
@@ -69,3 +171,58 @@ def get_engine():
         if os.environ.get("INSTANCE_CONNECTION_NAME")
         else connect()
     )
+
+
+def connect_unix_socket_async() -> AsyncEngine:
+    """Initializes an async Unix socket connection pool for a Cloud SQL instance of Postgres."""
+    logging.info(f"Connecting to database using async Unix socket")
+    db_user = os.environ["DB_USER"]
+    db_pass = os.environ["DB_PASSWORD"]
+    db_name = os.environ["DB_NAME"]
+    instance_connection_name = os.environ["INSTANCE_CONNECTION_NAME"]
+
+    pool = create_async_engine(
+        # Equivalent URL:
+        # postgresql+asyncpg://<db_user>:<db_pass>@/<db_name>
+        #                         ?host=/cloudsql/<INSTANCE_CONNECTION_NAME>
+        sqlalchemy.engine.url.URL.create(
+            drivername="postgresql+asyncpg",
+            username=db_user,
+            password=db_pass,
+            database=db_name,
+            query={"host": f"/cloudsql/{instance_connection_name}"},
+        ),
+        **pool_options("async", AsyncAdaptedQueuePool),
+    )
+    logging.info(f"Connected to database using async Unix socket")
+    return pool
+
+
+def connect_async() -> AsyncEngine:
+    """Initializes an async TCP connection pool for Postgres."""
+    logging.info(f"Connecting to database using async TCP")
+    db_user = os.environ["DB_USER"]
+    db_pass = os.environ["DB_PASSWORD"]
+    db_name = os.environ["DB_NAME"]
+
+    pool = create_async_engine(
+        # Equivalent URL:
+        # postgresql+asyncpg://<db_user>:<db_pass>@/<db_name>
+        sqlalchemy.engine.url.URL.create(
+            drivername="postgresql+asyncpg",
+            username=db_user,
+            password=db_pass,
+            database=db_name,
+        ),
+        **pool_options("async", AsyncAdaptedQueuePool),
+    )
+    logging.info(f"Connected to database using async TCP")
+    return pool
+
+
+def get_async_engine() -> AsyncEngine:
+    return (
+        connect_unix_socket_async()
+        if os.environ.get("INSTANCE_CONNECTION_NAME")
+        else connect_async()
+    )
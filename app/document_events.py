@@ -0,0 +1,93 @@
+import sys
+import json
+import asyncio
+import logging
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+logging.basicConfig(
+    stream=sys.stdout,
+    format="%(asctime)s - %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+DOCUMENT_STATUS_CHANNEL = "document_status"
+
+NOTIFY_QUERY = text("SELECT pg_notify(:channel, :payload)")
+
+
+def notify_params(document_id: int, status: str) -> dict:
+    """
+    Parameters of NOTIFY_QUERY for a document update. Run it in the transaction that saves the
+    document, Postgres delivers the notification on commit.
+    """
+    return {
+        "channel": DOCUMENT_STATUS_CHANNEL,
+        "payload": json.dumps({"document_id": document_id, "status": status}),
+    }
+
+
+class DocumentStatusListener:
+    """
+    Holds one LISTEN connection per process and hands the document status notifications
+    to the event streams subscribed to the document.
+    The connection is taken out of the async engine's pool when the first stream starts,
+    and opened again on the next subscription if Postgres closes it.
+    """
+
+    def __init__(self, engine: AsyncEngine) -> None:
+        self._engine = engine
+        self._connection = None
+        self._lock = asyncio.Lock()
+        self._subscribers = {}
+        self.notifications = 0
+
+    async def ensure_started(self) -> None:
+        if self._connection is not None:
+            return
+        async with self._lock:
+            if self._connection is not None:
+                return
+            connection = await self._engine.raw_connection()
+            driver_connection = connection.driver_connection
+            await driver_connection.add_listener(DOCUMENT_STATUS_CHANNEL, self._on_notification)
+            driver_connection.add_termination_listener(self._on_termination)
+            self._connection = connection
+            logging.info(f"Listening on {DOCUMENT_STATUS_CHANNEL}")
+
+    def subscribe(self, document_id: int) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(document_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, document_id: int, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(document_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[document_id]
+
+    def _on_notification(self, connection, pid, channel, payload) -> None:
+        self.notifications += 1
+        try:
+            event = json.loads(payload)
+        except json.JSONDecodeError:
+            logging.error(f"Invalid {channel} notification: {payload}")
+            return
+        for queue in self._subscribers.get(event.get("document_id"), ()):
+            queue.put_nowait(event)
+
+    def _on_termination(self, connection) -> None:
+        logging.warning(f"{DOCUMENT_STATUS_CHANNEL} listener connection closed")
+        self._connection = None
+
+    def stats(self) -> dict:
+        return {
+            "listening": self._connection is not None,
+            "documents": len(self._subscribers),
+            "streams": sum(len(queues) for queues in self._subscribers.values()),
+            "notifications": self.notifications,
+        }
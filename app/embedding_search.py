@@ -0,0 +1,67 @@
+import os
+import logging
+from sqlalchemy import text
+
+
+## Number of nearest embedding rows looked at per requested document. A document has
+## several embeddings (title, summary, bullet points) so more rows than top_k are needed.
+SEARCH_CANDIDATES_PER_RESULT = int(os.environ.get("SEARCH_CANDIDATES_PER_RESULT", 8))
+SEARCH_HNSW_EF_SEARCH = int(os.environ.get("SEARCH_HNSW_EF_SEARCH", 100))
+
+## pgvector's upper bound of hnsw.ef_search
+HNSW_MAX_EF_SEARCH = 1000
+
+## The inner ORDER BY distance LIMIT lets Postgres walk the HNSW index on
+## document_embeddings.embeddings instead of scoring every row of the user.
+SEARCH_EMBEDDINGS_QUERY = text(
+    """SELECT nearest.document_id, MAX(1 - nearest.distance) AS cosine_similarity
+    FROM (SELECT de.document_id, de.embeddings <=> :vector AS distance
+        FROM document_embeddings AS de
+        JOIN bookmark ON de.document_id = bookmark.document_id
+        WHERE bookmark.user_id = :user_id
+        ORDER BY de.embeddings <=> :vector
+        LIMIT :candidates) nearest
+    GROUP BY nearest.document_id
+    HAVING MAX(1 - nearest.distance) > 0.05
+    ORDER BY cosine_similarity DESC
+    LIMIT :top_k"""
+)
+
+## Scores every embedding of the user, the index can't serve the per-document aggregate
+EXACT_SEARCH_EMBEDDINGS_QUERY = text(
+    """SELECT de.document_id, MAX(1 - (de.embeddings <=> :vector)) AS cosine_similarity
+    FROM document_embeddings AS de
+    JOIN bookmark ON de.document_id = bookmark.document_id
+    WHERE bookmark.user_id = :user_id
+    GROUP BY de.document_id
+    HAVING MAX(1 - (de.embeddings <=> :vector)) > 0.05
+    ORDER BY cosine_similarity DESC
+    LIMIT :top_k"""
+)
+
+
+async def find_nearest_documents(session, vector: str, user_id: str, top_k: int) -> list:
+    """
+    (document_id, cosine_similarity) of the top_k documents of the user closest to the vector.
+    The HNSW scan filters on user_id after walking the index, so a user owning a small share
+    of the embeddings can get fewer than top_k documents back from it. Then the user's
+    embeddings are scored exactly, as they were before the index.
+    """
+    candidates = top_k * SEARCH_CANDIDATES_PER_RESULT
+    ## The scan returns at most ef_search rows, it must cover the candidates
+    ef_search = min(max(SEARCH_HNSW_EF_SEARCH, candidates), HNSW_MAX_EF_SEARCH)
+    await session.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+
+    params = {"vector": vector, "user_id": user_id, "top_k": top_k}
+    matched_documents = await session.execute(
+        SEARCH_EMBEDDINGS_QUERY, {**params, "candidates": candidates}
+    )
+    matched_documents = matched_documents.all()
+    if len(matched_documents) >= top_k:
+        return matched_documents
+
+    logging.info(
+        f"HNSW search found {len(matched_documents)} of {top_k} documents, scoring exactly"
+    )
+    matched_documents = await session.execute(EXACT_SEARCH_EMBEDDINGS_QUERY, params)
+    return matched_documents.all()
@@ -1,13 +1,12 @@
 from typing import Any
-import requests
 import os
 import logging
 import sys
 import re
 import json
-from time import sleep
-from transformers import AutoTokenizer
-from app.icog_util import truncate_text
+import aiohttp
+from app.icog_util import truncate_text, get_tokenizer, count_prompt_tokens
+from app.llm_retry import ApiCallException, RetryPolicy
 
 
 logging.basicConfig(
@@ -111,13 +110,9 @@ class HfApiClient:
         self._base_url = "https://api-inference.huggingface.co/models/"
         self._model_name = "meta-llama/Llama-2-70b-chat-hf"
         self._api_url = self._base_url + self._model_name
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            self._model_name, use_auth_token=config["HF_API_TOKEN"]
-        )
+        self._tokenizer = get_tokenizer(self._model_name, token=config["HF_API_TOKEN"])
         self._max_length = 4096
-        self._retry_sleep = 30
-        self._retry_attempts = 0
-        self._retry_max_attempts = 2
+        self._retry_policy = RetryPolicy()
         self._templates = LlamaTemplates()
         self._parameters = {
             "max_length": 4096,
@@ -139,9 +134,26 @@ class HfApiClient:
 
         return results
 
-    def api_call(
+    def shorten_text(self, body_text: str, template: LlamaTemplates) -> str:
+        """Truncate the body text so the text and the template fit in the model max length"""
+        # count tokens of body text
+        text_tokens_ids = self._tokenizer(body_text, return_tensors="pt").input_ids
+        text_num_tokens = len(text_tokens_ids[0])
+
+        # count tokens of prompt, the template doesn't change so the count is memoized
+        template_num_tokens = count_prompt_tokens(self._model_name, template.getTemplate())
+
+        ## New max length take into account the token in the template
+        new_max_length = self._max_length - template_num_tokens
+        logging.info(f"New max length is: {new_max_length}")
+
+        new_body_text = truncate_text(body_text, new_max_length, text_num_tokens)
+        logging.info(f"New body text length is {len(new_body_text)}")
+        return new_body_text
+
+    async def api_call(
         self, body_text: str, template: LlamaTemplates, parameters, options
-    ) -> dict:
+    ) -> str:
         API_URL = self._api_url
         headers = {
             "Authorization": f"Bearer {self._api_token}",
@@ -151,71 +163,37 @@ class HfApiClient:
         query = template(body_text)
         payload = {"inputs": query, "parameters": parameters, "options": options}
 
-        response = requests.post(API_URL, headers=headers, json=payload)
-
-        # If error true, sleep for 30 seconds and
-        # try again.
-        # If error still true, return error message.
-        status = response.status_code
-        # In case the service isn't ready or overloaded
-        if (status == 503 or status == 429) and (
-            self._retry_attempts < self._retry_max_attempts
-        ):
-            logging.info(
-                f"API Call Error: {response.content}. Retrying in {self._retry_sleep} seconds"
-            )
-            self._retry_attempts += 1
-            sleep(self._retry_sleep)
-            logging.info(f"Retrying now")
-            return self.api_call(body_text, template, parameters, options)
-
-        # In case there are too many failures
-        elif status == 503 and self._retry_attempts >= self._retry_max_attempts:
-            self._retry_attempts = 0
-            logging.warn(f"Retry limit reached. Returning error")
-            raise ResourceWarning("Retry limit reached. Returning an error")
-
-        # In case text is too long
-        elif status == 422:
-            logging.warn(
-                f"Error calling HF with {response.status_code} and message {response.content}. For: {body_text[:20]}"
-            )
-            # count tokens of body text
-            text_tokens_ids = self._tokenizer(body_text, return_tensors="pt").input_ids
-            text_num_tokens = len(text_tokens_ids[0])
-
-            # count tokens of prompt
-            template_tokens_ids = self._tokenizer(
-                template.getTemplate(), return_tensors="pt"
-            ).input_ids
-            template_num_tokens = len(template_tokens_ids[0])
-
-            ## New max length take into account the token in the template
-            new_max_length = self._max_length - template_num_tokens
-            logging.info(f"New max length is: {new_max_length}")
-            new_body_text = truncate_text(body_text, new_max_length, text_num_tokens)
-            logging.info(f"New body text length is {len(new_body_text)}")
-            return self.api_call(new_body_text, template, parameters, options)
-
-        elif response.status_code == 200:
-            try:
-                results = response.json()
-                answer = results[0]["generated_text"]
-                logging.info(
-                    f"API Call successful. Status code {response.status_code}. Generated text length: {len(answer)}"
+        async with aiohttp.ClientSession(headers=headers) as session:
+            async with session.post(API_URL, json=payload) as response:
+                status = response.status
+
+                if status == 200:
+                    try:
+                        results = await response.json()
+                        answer = results[0]["generated_text"]
+                        logging.info(
+                            f"API Call successful. Status code {status}. Generated text length: {len(answer)}"
+                        )
+                        return answer
+                    except (json.JSONDecodeError, aiohttp.ContentTypeError):
+                        logging.error(f"Error decoding JSON response: {response}")
+                        return None
+
+                content = await response.text()
+                logging.warning(
+                    f"Error calling HF with {status} and message {content}. For: {body_text[:20]}"
+                )
+                raise ApiCallException(
+                    "Error during API call",
+                    {
+                        "status_code": status,
+                        "content": content,
+                        "reason": response.reason,
+                        "retry_after": response.headers.get("Retry-After"),
+                    },
                 )
-                self._retry_attempts = 0
-                return answer
-            except json.JSONDecodeError:
-                logging.error(f"Error decoding JSON response: {response}")
-                return None
-        else:
-            logging.error(
-                f"Response from HF API isn't right. Status code: {response.status_code} Contenct {response.content}"
-            )
-            return None
 
-    def generate(self, body_text: str, template: LlamaTemplates) -> str:
+    async def generate(self, body_text: str, template: LlamaTemplates) -> str:
         parameters = {
             "max_length": 4000,
             "max_new_tokens": 1000,
@@ -231,20 +209,22 @@ class HfApiClient:
 
         logging.info(f"Sending query to API with template: {template.__name__}...")
 
-        try:
-            results = self.api_call(body_text, template, parameters, options)
+        ## A 422 means the text is too long, the retry policy shortens it and calls again
+        request = {"body_text": body_text}
 
-            if results == None:
-                logging.error(f"API Call Error for template: {template.__name__}")
-                return None
-            else:
-                logging.info(
-                    f"API Call successful. Returning results. len(results): {len(results)}"
-                )
-            return results
-        except ResourceWarning as e:
-            logging.error(e)
-            raise ResourceWarning(e)
-        except Exception as e:
-            logging.error(e)
-            raise Exception(e)
+        def shorten():
+            request["body_text"] = self.shorten_text(request["body_text"], template)
+
+        results, attempts = await self._retry_policy.run(
+            lambda: self.api_call(request["body_text"], template, parameters, options),
+            on_too_long=shorten,
+        )
+
+        if results == None:
+            logging.error(f"API Call Error for template: {template.__name__}")
+            return None
+
+        logging.info(
+            f"API Call successful after {attempts} attempts. Returning results. len(results): {len(results)}"
+        )
+        return results
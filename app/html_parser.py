@@ -1,8 +1,22 @@
+import os
+import codecs
+import bisect
+import asyncio
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import requests
 import logging
 import re
+from html.parser import HTMLParser
+from lxml import etree
 from bs4 import BeautifulSoup
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution
 from app.models import Page, PagePayload
+from app.page_fetcher import page_fetcher, FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT
+from app.icog_util import LRUCache
 import urllib.parse as urlparse
 
 
@@ -16,6 +30,41 @@ logger = logging.getLogger(__name__)
 
 MININUM_PARAGRAPH_LENGTH = 10
 
+## bs4 is the original BeautifulSoup html.parser path, lxml (opt-in) builds the same tree
+## into lxml and walks it once
+HTML_PARSER_BACKEND = os.environ.get("HTML_PARSER_BACKEND", "bs4")
+
+ARTICLE_SELECTORS = ["article", "div#article", "div.article-body", "div.article", "main"]
+
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 256))
+PAGE_CACHE_TTL = float(os.environ.get("PAGE_CACHE_TTL", 60 * 60))
+
+## With workers, pages are parsed in worker processes so parsing doesn't hold the event loop
+## or the GIL. Off by default (0 parses in the API process): it only pays off with spare cores,
+## and uploads are then collected whole instead of fed to the parser as they arrive.
+## At most HTML_PARSER_MAX_PENDING pages wait for a worker.
+HTML_PARSER_WORKERS = int(os.environ.get("HTML_PARSER_WORKERS", 0))
+HTML_PARSER_MAX_PENDING = int(
+    os.environ.get("HTML_PARSER_MAX_PENDING", max(HTML_PARSER_WORKERS, 1) * 4)
+)
+
+## Parsed pages keyed by clean URL and a hash of the HTML, so the same page sent again
+## (a second click, or another user bookmarking the same article) isn't parsed again
+page_cache = LRUCache(PAGE_CACHE_SIZE, PAGE_CACHE_TTL)
+
+
+def get_html(payload: PagePayload) -> str:
+    """HTML sent by the extension, or fetched from the URL when only the URL was sent"""
+    if payload.html:
+        logging.info("Html_parser -> get_html -> Using payload html")
+        return payload.html
+
+    logging.info("Html_parser -> get_html -> requests.get -> payload.url")
+    response = requests.get(
+        payload.url, timeout=(FETCH_CONNECT_TIMEOUT, FETCH_READ_TIMEOUT)
+    )
+    return response.text
+
 
 def get_webpage(payload: PagePayload) -> BeautifulSoup:
     """_summary_
@@ -27,15 +76,7 @@ def get_webpage(payload: PagePayload) -> BeautifulSoup:
         BeautifulSoup: BeatifulSoup object
     """
     try:
-
-        if payload.html:
-            logging.info("Html_parser -> get_webpage -> Using payload html")
-            return BeautifulSoup(payload.html, "html.parser")
-
-        logging.info("Html_parser -> get_webpage -> requests.get -> payload.url")
-        response = requests.get(payload.url)
-        content = response.text
-        return BeautifulSoup(content, "html.parser")
+        return BeautifulSoup(get_html(payload), "html.parser")
     except requests.exceptions.InvalidSchema as e:
         logging.error(
             f"InvalidSchema wrror getting webpage: {payload.url} with error: {e}"
@@ -99,7 +140,7 @@ def get_title(soup: BeautifulSoup) -> str:
         logging.error("No title found in webpage")
         title = soup.find("h2")
 
-    return title.text
+    return title.text if title is not None else None
 
 
 def extract_author_medium(soup: BeautifulSoup) -> str:
@@ -136,14 +177,303 @@ def clean_url(url: str) -> str:
     return clean_url
 
 
-def create_page(payload: PagePayload) -> Page:
+def selector_matches(element) -> list[int]:
+    """Indexes of the ARTICLE_SELECTORS the element matches"""
+    tag = element.tag
+    if tag == "article":
+        return [0]
+    if tag == "main":
+        return [4]
+    if tag != "div":
+        return []
+
+    matches = []
+    if element.get("id") == "article":
+        matches.append(1)
+    classes = element.get("class", "").split()
+    if "article-body" in classes:
+        matches.append(2)
+    if "article" in classes:
+        matches.append(3)
+    return matches
+
+
+## Void tags, whitespace preserving tags and tags whose strings are left out of .text,
+## as BeautifulSoup's html.parser builder has them
+SOUP_RULES = HTMLTreeBuilder()
+
+## Attributes read by the walk, the others aren't kept in the tree
+WALKED_ATTRIBUTES = {"id", "class", "data-testid"}
+
+## Characters lxml refuses in text and attribute values
+XML_INVALID_CHARACTERS = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+def xml_text(text: str) -> str:
+    if XML_INVALID_CHARACTERS.search(text):
+        return XML_INVALID_CHARACTERS.sub("", text)
+    return text
+
+
+class SoupTreeParser(HTMLParser):
+    """
+    Builds an lxml tree from html.parser events with BeautifulSoup's rules, so the lxml walk
+    sees the tree create_page_bs4 does on malformed markup. Nothing is closed implicitly
+    (a div stays inside its p, a p inside a p), an end tag closes the most recent open tag
+    of its name or nothing, and void tags close at once. Comments, declarations and the
+    strings of script, style, template, rt and rp aren't kept, as they are not in bs4's .text.
+    """
+
+    ROOT = "document"
+
+    def __init__(self) -> None:
+        ## Character references are resolved like bs4 does, not by html.parser
+        super().__init__(convert_charrefs=False)
+        self._builder = etree.TreeBuilder()
+        self._builder.start(self.ROOT, {})
+        self._open_tags = []
+        self._open_elements = []
+        self._data = []
+        self._string_containers = 0
+        self._preserve_whitespace = 0
+        self._closed_void_tags = []
+
+    def handle_starttag(self, tag: str, attrs: list, void: bool = True) -> None:
+        self._end_data()
+        attributes = {
+            name: xml_text(value or "") for name, value in attrs if name in WALKED_ATTRIBUTES
+        }
+        try:
+            element = self._builder.start(tag, attributes)
+        except ValueError:
+            ## A name lxml refuses (e.g. <a:b>), the element is kept under another name
+            element = self._builder.start("unknown", attributes)
+        self._open_tags.append(tag)
+        self._open_elements.append(element)
+        self._string_containers += tag in SOUP_RULES.string_containers
+        self._preserve_whitespace += tag in SOUP_RULES.preserve_whitespace_tags
+
+        if void and tag in SOUP_RULES.empty_element_tags:
+            self._pop_to(tag)
+            ## Its end tag, if any, is then ignored
+            self._closed_void_tags.append(tag)
+
+    def handle_startendtag(self, tag: str, attrs: list) -> None:
+        self.handle_starttag(tag, attrs, void=False)
+        self._end_data()
+        self._pop_to(tag)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self._closed_void_tags:
+            ## Dropped without ending the string, like bs4 does
+            self._closed_void_tags.remove(tag)
+        else:
+            self._end_data()
+            self._pop_to(tag)
+
+    def handle_data(self, data: str) -> None:
+        self._data.append(data)
+
+    def handle_charref(self, name: str) -> None:
+        try:
+            code = int(name[1:], 16) if name[:1] in ("x", "X") else int(name)
+        except ValueError:
+            code = None
+        data = None
+        if code is not None and code < 256:
+            try:
+                data = bytes([code]).decode("windows-1252")
+            except UnicodeDecodeError:
+                pass
+        if data is None and code is not None:
+            try:
+                data = chr(code)
+            except (ValueError, OverflowError):
+                pass
+        self.handle_data(data or "\N{REPLACEMENT CHARACTER}")
+
+    def handle_entityref(self, name: str) -> None:
+        character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+        self.handle_data(character if character is not None else f"&{name}")
+
+    def handle_comment(self, data: str) -> None:
+        self._end_data()
+
+    def handle_decl(self, decl: str) -> None:
+        self._end_data()
+
+    def handle_pi(self, data: str) -> None:
+        self._end_data()
+
+    def unknown_decl(self, data: str) -> None:
+        self._end_data()
+        if data.upper().startswith("CDATA["):
+            self._builder.data(xml_text(data[len("CDATA[") :]))
+
+    def close(self):
+        super().close()
+        self._end_data()
+        while self._open_tags:
+            self._pop()
+        self._builder.end(self.ROOT)
+        return self._builder.close()
+
+    def _end_data(self) -> None:
+        if not self._data:
+            return
+        data = "".join(self._data)
+        self._data = []
+        if self._string_containers:
+            return
+        if not self._preserve_whitespace and not data.strip(" \t\n\r\f"):
+            ## Whitespace between tags is one space or newline in bs4
+            data = "\n" if "\n" in data else " "
+        self._builder.data(xml_text(data))
+
+    def _pop(self) -> None:
+        tag = self._open_tags.pop()
+        self._string_containers -= tag in SOUP_RULES.string_containers
+        self._preserve_whitespace -= tag in SOUP_RULES.preserve_whitespace_tags
+        self._builder.end(self._open_elements.pop().tag)
+
+    def _pop_to(self, tag: str) -> None:
+        if tag not in self._open_tags:
+            return
+        while self._open_tags[-1] != tag:
+            self._pop()
+        self._pop()
+
+
+def parse_lxml(html: str):
+    parser = SoupTreeParser()
+    parser.feed(html)
+    return parser.close()
+
+
+def extract_article_lxml(root) -> dict:
+    """
+    Same result as find_main_article_element, get_paragraphs, get_title and extract_author_medium,
+    in one walk of the tree. The walk records the position of every text element (p, h1-h3)
+    and author element, and the range of positions each article candidate covers, so
+    picking the article and collecting its paragraphs don't walk the tree again.
+    """
+    text_elements = []
+    text_orders = []
+    h1_p_counts = [0]
+    authors = []
+    candidates = [[] for _ in ARTICLE_SELECTORS]
+    open_candidates = []
+    order = 0
+
+    for event, element in etree.iterwalk(root, events=("start", "end")):
+        if not isinstance(element.tag, str):
+            continue
+
+        if event == "end":
+            if open_candidates and open_candidates[-1][0] is element:
+                _, record = open_candidates.pop()
+                record["last"] = len(text_elements)
+                record["last_order"] = order
+            continue
+
+        order += 1
+        tag = element.tag
+        if tag in ("p", "h1", "h2", "h3"):
+            text_elements.append(element)
+            text_orders.append(order)
+            h1_p_counts.append(h1_p_counts[-1] + (tag in ("p", "h1")))
+        if element.get("data-testid") == "authorName":
+            authors.append((order, element))
+
+        matches = selector_matches(element)
+        if matches:
+            ## Descendants only, like bs4's find_all on the article element
+            record = {"first": len(text_elements), "first_order": order + 1}
+            open_candidates.append((element, record))
+            for match in matches:
+                candidates[match].append(record)
+
+    articles = next((records for records in candidates if records), None)
+    if articles is None:
+        return None
+
+    content_estimator = [
+        h1_p_counts[record["last"]] - h1_p_counts[record["first"]] for record in articles
+    ]
+    logging.info(content_estimator)
+    if max(content_estimator) < 3:
+        logging.warning("Not enought content on the page")
+        raise ValueError("Not enough contect on the page")
+
+    article = articles[content_estimator.index(max(content_estimator))]
+    elements = text_elements[article["first"] : article["last"]]
+
+    paragraphs = []
+    title = None
+    first_h2 = None
+    for element in elements:
+        text = "".join(element.itertext())
+        words = len(text.split(" "))
+        if element.tag == "p":
+            if words > 8:
+                paragraphs.append(text)
+        elif words > 3:
+            paragraphs.append(text)
+
+        if title is None and element.tag == "h1":
+            title = text
+        elif first_h2 is None and element.tag == "h2":
+            first_h2 = text
+
+    author = None
+    start = bisect.bisect_left(authors, article["first_order"], key=lambda item: item[0])
+    if start < len(authors) and authors[start][0] <= article["last_order"]:
+        author = "".join(authors[start][1].itertext())
+
+    return {
+        "paragraphs": paragraphs,
+        "title": title if title is not None else first_h2,
+        "author": author,
+    }
+
+
+def create_page_lxml(url: str, html: str) -> Page:
+    try:
+        root = parse_lxml(html)
+    except Exception as e:
+        logging.error(f"Error parsing webpage: {url} with error: {e}")
+        return None
+
+    return page_from_lxml_root(url, root)
+
+
+def page_from_lxml_root(url: str, root) -> Page:
+    article = extract_article_lxml(root)
+    if article is None:
+        logging.error("No article found in webpage")
+        return None
+
+    page = Page()
+    page.clean_url = clean_url(url)
+    page.paragraphs = article["paragraphs"]
+    page.author = article["author"]
+    page.full_text = "\n".join(article["paragraphs"])
+    page.title = article["title"]
+
+    return page
+
 
-    html = get_webpage(payload)
-    if html is None:
-        logging.error("No webpage found")
+def create_page_bs4(url: str, html: str) -> Page:
+    try:
+        html = BeautifulSoup(html, "html.parser")
+    except Exception as e:
+        logging.error(f"Error parsing webpage: {url} with error: {e}")
         return None
 
     article_element = find_main_article_element(html)
+    if article_element is None:
+        logging.error("No article found in webpage")
+        return None
 
     paragraphs = get_paragraphs(article_element)
 
@@ -155,7 +485,7 @@ def create_page(payload: PagePayload) -> Page:
     author = extract_author_medium(article_element)
 
     page = Page()
-    page.clean_url = clean_url(payload.url)
+    page.clean_url = clean_url(url)
     page.paragraphs = paragraphs
     page.author = author
     page.full_text = "\n".join(paragraphs)
@@ -164,6 +494,188 @@ def create_page(payload: PagePayload) -> Page:
     return page
 
 
+def parse_page(url: str, html: str, backend: str = None) -> Page:
+    """Page of the article in the html, parsed with the HTML_PARSER_BACKEND backend"""
+    if (backend or HTML_PARSER_BACKEND) == "lxml":
+        return create_page_lxml(url, html)
+    return create_page_bs4(url, html)
+
+
+class ParserQueueFull(Exception):
+    """Raised when HTML_PARSER_MAX_PENDING pages are already waiting for a parser process"""
+
+
+class ParserPool:
+    """
+    Bounded pool of parser processes. The HTML is sent to a worker once, and the worker sends
+    back the page fields without full_text, which is rebuilt from the paragraphs.
+    Workers are spawned, not forked, so they don't inherit the API's threads and models.
+    """
+
+    def __init__(self, workers: int, max_pending: int) -> None:
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def parse(self, url: str, html, encoding: str = None) -> Page:
+        if self.pending >= self.max_pending:
+            raise ParserQueueFull(f"HTML parser queue is full ({self.pending} pending)")
+
+        self.pending += 1
+        try:
+            fields = await asyncio.get_running_loop().run_in_executor(
+                self._get_executor(),
+                parse_page_fields,
+                url,
+                html,
+                encoding,
+                HTML_PARSER_BACKEND,
+            )
+        except BrokenProcessPool:
+            ## A worker died (e.g. out of memory), start a new pool for the next pages
+            logging.error(f"HTML parser pool broken while parsing {url}")
+            self._executor = None
+            raise
+        finally:
+            self.pending -= 1
+
+        if fields is None:
+            return None
+        clean_url, title, author, paragraphs = fields
+        return Page(
+            clean_url=clean_url,
+            title=title,
+            author=author,
+            paragraphs=paragraphs,
+            full_text="\n".join(paragraphs),
+        )
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {"workers": self.workers, "pending": self.pending, "max_pending": self.max_pending}
+
+
+def parse_page_fields(url: str, html, encoding: str = None, backend: str = None) -> tuple:
+    """Runs in a parser process, returns (clean_url, title, author, paragraphs) or None"""
+    if isinstance(html, bytes):
+        try:
+            html = html.decode(encoding or "utf-8", errors="replace")
+        except LookupError:
+            html = html.decode("utf-8", errors="replace")
+    page = parse_page(url, html, backend)
+    if page is None:
+        return None
+    return page.clean_url, page.title, page.author, page.paragraphs
+
+
+parser_pool = ParserPool(HTML_PARSER_WORKERS, HTML_PARSER_MAX_PENDING)
+
+
+async def parse_page_async(url: str, html, encoding: str = None) -> Page:
+    """parse_page in the parser pool, or in this process when HTML_PARSER_WORKERS is 0"""
+    if parser_pool.workers > 0:
+        return await parser_pool.parse(url, html, encoding)
+    if isinstance(html, bytes):
+        html = html.decode(encoding or "utf-8", errors="replace")
+    return parse_page(url, html)
+
+
+def create_page(payload: PagePayload) -> Page:
+    try:
+        html = get_html(payload)
+    except Exception as e:
+        logging.error(f"Error getting webpage: {payload.url} with error: {e}")
+        return None
+
+    return parse_page(payload.url, html)
+
+
+async def create_page_async(payload: PagePayload) -> Page:
+    """create_page for the API, pages sent without their HTML are fetched with page_fetcher"""
+    html = payload.html
+    if not html:
+        logging.info("Html_parser -> create_page_async -> page_fetcher -> payload.url")
+        html = await page_fetcher.fetch(payload.url)
+        if html is None:
+            return None
+
+    key = (clean_url(payload.url), hashlib.sha256(html.encode()).hexdigest())
+    page = page_cache.get(key)
+    if page is not None:
+        logging.info("Html_parser -> create_page_async -> Using cached page")
+        return page
+
+    page = await parse_page_async(payload.url, html)
+    if page is not None:
+        page_cache.set(key, page)
+    return page
+
+
+async def create_page_from_stream(url: str, chunks, encoding: str = None) -> Page:
+    """
+    Page from an HTML body read in chunks (an async iterator of bytes). With the parser pool,
+    the bytes are sent to a worker as they are. Otherwise with the lxml backend, each chunk is
+    decoded and fed to SoupTreeParser as it arrives, so the HTML is never held as one string.
+    Shares page_cache with create_page_async.
+    """
+    digest = hashlib.sha256()
+    try:
+        if parser_pool.workers > 0:
+            parts = []
+            async for chunk in chunks:
+                digest.update(chunk)
+                parts.append(chunk)
+            html = b"".join(parts)
+        elif HTML_PARSER_BACKEND == "lxml":
+            ## Read as UTF-8 without a charset in the Content-Type, like the bs4 path
+            decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+            parser = SoupTreeParser()
+            async for chunk in chunks:
+                digest.update(chunk)
+                parser.feed(decoder.decode(chunk))
+            parser.feed(decoder.decode(b"", final=True))
+            root = parser.close()
+        else:
+            parts = []
+            async for chunk in chunks:
+                digest.update(chunk)
+                parts.append(chunk)
+            html = b"".join(parts).decode(encoding or "utf-8", errors="replace")
+    except (etree.LxmlError, LookupError, AssertionError) as e:
+        ## html.parser rejects some markup with an AssertionError
+        logging.error(f"Error parsing webpage: {url} with error: {e}")
+        return None
+
+    key = (clean_url(url), digest.hexdigest())
+    page = page_cache.get(key)
+    if page is not None:
+        logging.info("Html_parser -> create_page_from_stream -> Using cached page")
+        return page
+
+    if parser_pool.workers > 0:
+        page = await parser_pool.parse(url, html, encoding)
+    elif HTML_PARSER_BACKEND == "lxml":
+        page = page_from_lxml_root(url, root)
+    else:
+        page = create_page_bs4(url, html)
+
+    if page is not None:
+        page_cache.set(key, page)
+    return page
+
+
 if __name__ == "__main__":
     url = "https://bergum.medium.com/four-mistakes-when-introducing-embeddings-and-vector-search-d39478a568c5#tour"
     tree = get_webpage(url)
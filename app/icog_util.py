@@ -1,17 +1,19 @@
+import os
 import logging
 import sys
+import re
 import string
+import time
+import threading
 import numpy as np
 import math
+import functools
 
 from stop_words import get_stop_words
 from nltk.tokenize import word_tokenize
 from transformers import AutoTokenizer
 from typing import Any, Dict, List, Union
-from sumy.parsers.plaintext import PlaintextParser
-from sumy.nlp.tokenizers import Tokenizer
-from sumy.summarizers.lsa import LsaSummarizer
-from sumy.nlp.stemmers import Stemmer
+from collections import OrderedDict
 from sumy.utils import get_stop_words
 
 
@@ -25,6 +27,15 @@ logging.basicConfig(
 translator = str.maketrans("", "", string.punctuation)
 stopwords = get_stop_words("en")
 
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+|\n+")
+WORD = re.compile(r"[a-z0-9]+")
+
+## Directory with tokenizer snapshots saved as <TOKENIZER_DIR>/<model name>, skips the Hub download
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR")
+
+_tokenizers = {}
+_tokenizers_lock = threading.Lock()
+
 
 def remove_stop_words(string, return_format="String"):
     """This method removes stop words from a string.
@@ -45,12 +56,146 @@ def remove_stop_words(string, return_format="String"):
         return " ".join(filtered_tokens)
 
 
+class LRUCache:
+    """
+    Bounded least recently used cache, with an optional time to live (seconds) for entries.
+    Counts hits and misses so the cache can be sized from real traffic.
+    """
+
+    def __init__(self, max_size: int, ttl: float = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value) -> None:
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+def get_tokenizer(model_name: str, **kwargs):
+    """
+    Tokenizer of model_name, loaded once per process and shared by every client using the model.
+    Loaded from TOKENIZER_DIR when it holds a snapshot of the model, else from the Hub.
+    """
+    tokenizer = _tokenizers.get(model_name)
+    if tokenizer is not None:
+        return tokenizer
+
+    with _tokenizers_lock:
+        if model_name not in _tokenizers:
+            path = model_name
+            if TOKENIZER_DIR and os.path.isdir(os.path.join(TOKENIZER_DIR, model_name)):
+                path = os.path.join(TOKENIZER_DIR, model_name)
+
+            start_time = time.perf_counter()
+            _tokenizers[model_name] = AutoTokenizer.from_pretrained(path, **kwargs)
+            logging.info(
+                f"Loaded tokenizer {model_name} from {path} in {time.perf_counter() - start_time:.2f} seconds"
+            )
+        return _tokenizers[model_name]
+
+
+@functools.lru_cache(maxsize=256)
+def count_prompt_tokens(model_name: str, text: str) -> int:
+    """
+    Token count of a fixed prompt part (system message, examples, template), memoized.
+    Don't use it for article texts, they would fill the cache with one-off entries.
+    """
+    return len(get_tokenizer(model_name).encode(text, add_special_tokens=False))
+
+
+def split_sentences(text: str) -> list[str]:
+    """Split on sentence ends and line breaks, dropping empty pieces"""
+    return [sentence for sentence in SENTENCE_END.split(text) if sentence.strip()]
+
+
+def score_sentences(sentences: list[str]) -> np.ndarray:
+    """
+    Cosine similarity of each sentence's TF-IDF vector to the document centroid.
+    The sentence-term matrix is kept as (sentence, term, weight) arrays, so the cost is
+    linear in the number of words instead of an SVD of a dense matrix.
+    """
+    vocabulary = {}
+    term_ids = []
+    sentence_ids = []
+    for index, sentence in enumerate(sentences):
+        terms = [
+            vocabulary.setdefault(word, len(vocabulary))
+            for word in WORD.findall(sentence.lower())
+            if word not in stopwords
+        ]
+        term_ids.extend(terms)
+        sentence_ids.extend([index] * len(terms))
+
+    number_of_sentences = len(sentences)
+    if not term_ids:
+        return np.zeros(number_of_sentences)
+
+    ## Term frequency of each (sentence, term) pair
+    pairs, tf = np.unique(
+        np.array(sentence_ids, dtype=np.int64) * len(vocabulary) + np.array(term_ids),
+        return_counts=True,
+    )
+    rows = pairs // len(vocabulary)
+    columns = pairs % len(vocabulary)
+
+    document_frequency = np.bincount(columns, minlength=len(vocabulary))
+    idf = np.log((1 + number_of_sentences) / (1 + document_frequency)) + 1
+    weights = tf * idf[columns]
+
+    norms = np.sqrt(np.bincount(rows, weights**2, minlength=number_of_sentences))
+    normalized = weights / norms[rows]
+    centroid = np.bincount(columns, normalized, minlength=len(vocabulary))
+    centroid_norm = np.linalg.norm(centroid)
+
+    return np.bincount(rows, normalized * centroid[columns], minlength=number_of_sentences) / centroid_norm
+
+
 def truncate_text(
     text: str, llm_max_tokens: int, number_of_tokens: int, LANGUAGE="english"
 ) -> str:
     """
-    Truncate_text recursive function that tokenizes and splits the text into chunks of 512 tokens
-    Then, use the LSA summarizer to summarize each chunk
+    Extractive compression of a text to fit llm_max_tokens.
+    Sentences are ranked by their similarity to the whole text (score_sentences) and the
+    best ones are kept, in their original order, until the token budget is used.
 
     Args:
         text (str): The text that need to be truncate
@@ -61,34 +206,33 @@ def truncate_text(
         Summary (str)
     """
 
-    summarizer = LsaSummarizer()
-
-    if number_of_tokens > llm_max_tokens:
-        logging.info(
-            f"Text is too long. Splitting into chunks of {llm_max_tokens} tokens"
-        )
-        parser = PlaintextParser.from_string(text, Tokenizer(LANGUAGE))
-        num_sentences = len(parser.document.sentences)
-        avg_tokens_per_sentence = int(number_of_tokens / num_sentences)
-        excess_tokens = number_of_tokens - llm_max_tokens
-        num_sentences_to_summarize = num_sentences - (
-            math.ceil(excess_tokens / avg_tokens_per_sentence)
-        )
-
-        logging.info(f"Number of tokens: {number_of_tokens}.")
-        logging.info(f"Number of sentences: {num_sentences}.")
-        logging.info(f"Average tokens per sentence: {avg_tokens_per_sentence}.")
-        logging.info(f"Excess tokens: {excess_tokens}.")
-        logging.info(f"Number of sentences to summarize: {num_sentences_to_summarize}")
-
-        summary = summarizer(parser.document, num_sentences_to_summarize)
-        summary_text = " ".join([sentence._text for sentence in summary])
-        return summary_text
-
-    else:
+    if number_of_tokens <= llm_max_tokens:
         logging.info("Text is short enough. No need to summarizing.")
         return text
 
+    tokens_per_char = number_of_tokens / max(len(text), 1)
+    max_chars = int(llm_max_tokens / tokens_per_char)
+    sentences = split_sentences(text)
+    if not sentences:
+        return text[:max_chars]
+
+    scores = score_sentences(sentences)
+    sentence_tokens = np.array([len(sentence) + 1 for sentence in sentences]) * tokens_per_char
+
+    ## Best sentences first, keep as many as fit in the budget
+    ranking = np.argsort(-scores, kind="stable")
+    fits = np.cumsum(sentence_tokens[ranking]) <= llm_max_tokens
+    selected = np.sort(ranking[fits])
+    if len(selected) == 0:
+        ## Not even the best sentence fits, e.g. a page without punctuation
+        return sentences[ranking[0]][:max_chars]
+
+    logging.info(
+        f"Text has {number_of_tokens} tokens in {len(sentences)} sentences. "
+        f"Keeping {len(selected)} sentences to fit {llm_max_tokens} tokens"
+    )
+    return " ".join(sentences[index] for index in selected)
+
 
 if __name__ == "__main__":
     text = "city in the region of Southern Savonia in Finland"
@@ -0,0 +1,69 @@
+import json
+
+
+class PartialJsonObject:
+    """
+    Parses a JSON object while it streams in, one chunk of text at a time.
+    A top level field is available in fields as soon as its value is complete,
+    before the rest of the object arrives. Text before the opening brace is ignored.
+    """
+
+    def __init__(self) -> None:
+        self.text = ""
+        self.fields = {}
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._key = None
+        self._value_start = None
+
+    def feed(self, chunk: str) -> list[str]:
+        """Add a chunk of the answer, returns the keys of the fields completed by it"""
+        self.text += chunk
+        completed = []
+        text = self.text
+
+        for index in range(self._position, len(text)):
+            char = text[index]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    ## A string at the top level before the colon is a key
+                    if self._depth == 1 and self._value_start is None:
+                        self._key = json.loads(text[self._string_start : index + 1])
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = index
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                if self._depth == 1:
+                    self._complete(index, completed)
+                self._depth = max(0, self._depth - 1)
+            elif char == ":" and self._depth == 1:
+                self._value_start = index + 1
+            elif char == "," and self._depth == 1:
+                self._complete(index, completed)
+
+        self._position = len(text)
+        return completed
+
+    def _complete(self, end: int, completed: list) -> None:
+        if self._value_start is None or self._key is None:
+            return
+        raw_value = self.text[self._value_start : end]
+        self._value_start = None
+        try:
+            self.fields[self._key] = json.loads(raw_value)
+        except json.JSONDecodeError:
+            return
+        completed.append(self._key)
@@ -0,0 +1,140 @@
+import os
+import sys
+import random
+import asyncio
+import logging
+import aiohttp
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+
+logging.basicConfig(
+    stream=sys.stdout,
+    format="%(asctime)s - %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+config = os.environ
+
+LLM_RETRY_MAX_ATTEMPTS = int(config.get("LLM_RETRY_MAX_ATTEMPTS", 4))
+LLM_RETRY_BASE_DELAY = float(config.get("LLM_RETRY_BASE_DELAY", 2))
+LLM_RETRY_MAX_DELAY = float(config.get("LLM_RETRY_MAX_DELAY", 60))
+
+## Rate limited or the service is overloaded / not ready, worth trying again later
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+## The prompt is too long for the model, retrying only helps with a shorter text
+TOO_LONG_STATUS = {413, 422}
+
+
+class ApiCallException(Exception):
+    """
+    Error from an LLM API call. response holds status_code, reason, content and retry_after,
+    attempts is the number of calls made before giving up.
+    """
+
+    def __init__(self, message, response, attempts=1):
+        super().__init__(message)
+        self.response = response
+        self.attempts = attempts
+
+    @property
+    def status_code(self):
+        return self.response.get("status_code") if self.response else None
+
+
+def parse_retry_after(value) -> float:
+    """Seconds to wait from a Retry-After header, given in seconds or as an HTTP date"""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+        return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Async retry with exponential backoff and full jitter, shared by the LLM clients.
+    Waiting uses asyncio.sleep so other requests keep running during the backoff.
+
+    Errors are classified by status code:
+    - 408, 429 and 5xx, plus connection errors and timeouts, are retried.
+      A Retry-After header sets the minimum delay.
+    - 413 and 422 (text too long) are retried right away, only if the caller can shorten the text.
+    - Anything else fails on the first attempt.
+    """
+
+    def __init__(
+        self,
+        max_attempts: int = LLM_RETRY_MAX_ATTEMPTS,
+        base_delay: float = LLM_RETRY_BASE_DELAY,
+        max_delay: float = LLM_RETRY_MAX_DELAY,
+    ) -> None:
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def classify(self, error: Exception) -> str:
+        if isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+            return "retry"
+        if isinstance(error, ApiCallException):
+            if error.status_code in RETRYABLE_STATUS:
+                return "retry"
+            if error.status_code in TOO_LONG_STATUS:
+                return "too_long"
+        return "fail"
+
+    def backoff(self, attempt: int, retry_after: float = None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    async def run(self, call, on_too_long=None):
+        """
+        Await call() until it succeeds or the error isn't retryable. on_too_long, if given,
+        is called before retrying a too long request. Returns (result, attempts).
+        Raises ApiCallException with the number of attempts made.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await call(), attempt
+
+            except (ApiCallException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                kind = self.classify(e)
+                can_retry = attempt < self.max_attempts and (
+                    kind == "retry" or (kind == "too_long" and on_too_long is not None)
+                )
+
+                if not can_retry:
+                    logging.error(f"API call failed after {attempt} attempts: {e}")
+                    if isinstance(e, ApiCallException):
+                        e.attempts = attempt
+                        raise e
+                    raise ApiCallException(
+                        "Error during API call",
+                        {"status_code": None, "reason": repr(e)},
+                        attempt,
+                    ) from e
+
+                if kind == "too_long":
+                    logging.warning(f"API call text is too long, shortening. Attempt {attempt}")
+                    on_too_long()
+                    continue
+
+                retry_after = None
+                if isinstance(e, ApiCallException):
+                    retry_after = parse_retry_after(e.response.get("retry_after"))
+                delay = self.backoff(attempt, retry_after)
+                logging.info(
+                    f"API call error: {e}. Attempt {attempt}, retrying in {delay:.1f} seconds"
+                )
+                await asyncio.sleep(delay)
@@ -1,21 +1,32 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, status, Response
+from fastapi import FastAPI, HTTPException, BackgroundTasks, status, Request, Response, Query
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import List, Optional, Literal
 from app.models import (
     Bookmark,
     Document,
+    Page,
     PagePayload,
     DocumentDisplay,
     HTTPError,
     SearchPayload,
 )
+import os
+import asyncio
 import logging
 import sys, re, time
 import uvicorn
 import re
 import app.app_logic as app_logic
+import app.db_connector as db_connector
+import app.html_parser as html_parser
+import app.transformers_util as transformers_util
+from app.transformers_util import EmbeddingQueueFull
+from app.html_parser import ParserQueueFull
+from concurrent.futures.process import BrokenProcessPool
+from app.document_events import DocumentStatusListener
+from app.request_compression import DecompressRequestMiddleware
 import urllib.parse as urlparse
 
 
@@ -38,7 +49,19 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
+app.add_middleware(DecompressRequestMiddleware)
+
+## Maximum page size of the paginated user listings
+MAX_PAGE_LIMIT = 500
+
+## Document event streams send a comment line this often to keep proxies from closing them,
+## and end after DOCUMENT_EVENTS_MAX_SECONDS, clients reconnect if the document isn't ready yet
+DOCUMENT_EVENTS_HEARTBEAT_SECONDS = float(os.environ.get("DOCUMENT_EVENTS_HEARTBEAT_SECONDS", 15))
+DOCUMENT_EVENTS_MAX_SECONDS = float(os.environ.get("DOCUMENT_EVENTS_MAX_SECONDS", 600))
+
+document_listener = DocumentStatusListener(app_logic.async_engine)
 
 
 @app.get("/")
@@ -57,6 +80,41 @@ async def ping():
     return {"Message": "Service is up and running"}
 
 
+@app.get("/metrics/db_pool", status_code=200)
+async def get_db_pool_metrics():
+    """Connection pool usage: checked-out connections, overflow and checkout wait time histogram"""
+    return db_connector.get_pool_metrics()
+
+
+@app.get("/metrics/embedding_cache", status_code=200)
+async def get_embedding_cache_metrics():
+    """Hit and miss counters of the search query embedding cache"""
+    return transformers_util.query_cache.stats()
+
+
+@app.get("/metrics/page_cache", status_code=200)
+async def get_page_cache_metrics():
+    """Hit and miss counters of the parsed page cache"""
+    return html_parser.page_cache.stats()
+
+
+@app.get("/metrics/html_parser", status_code=200)
+async def get_html_parser_metrics():
+    """Parser processes and pages waiting for one"""
+    return html_parser.parser_pool.stats()
+
+
+@app.on_event("shutdown")
+def shutdown_html_parser():
+    html_parser.parser_pool.shutdown()
+
+
+@app.get("/metrics/document_events", status_code=200)
+async def get_document_events_metrics():
+    """Open document event streams and notifications received by this process"""
+    return document_listener.stats()
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     logging.error(request)
@@ -64,60 +122,126 @@ async def validation_exception_handler(request, exc):
     return PlainTextResponse(str(request), status_code=400)
 
 
-@app.post(
-    "/bookmark",
-    responses={
-        400: {
-            "model": HTTPError,
-            "description": "Reporting back errors",
-        },
-        201: {"model": Bookmark, "description": "Bookmark created successfully"},
-    },
-)
-async def create_bookmark(
-    payload: PagePayload, background_tasks: BackgroundTasks, response: Response
-):
-
-    logging.info(f"Icognition bookmark endpoint called on {payload.url}")
-
-    if payload.user_id == None:
-        logging.warn(f"User ID not provided for {payload.url}")
+async def get_existing_bookmark(url: str, user_id: str) -> Bookmark:
+    """Validate a bookmark request, returns the bookmark of the URL if it already exists"""
+    if user_id == None:
+        logging.warn(f"User ID not provided for {url}")
         raise HTTPException(
             status_code=400,
             detail="User ID not provided for the bookmark",
         )
 
     # Check if payload.url is not the root URL of a website
-    if re.match(r"^https?://[^/]+/$", payload.url):
-        logging.warn(f"Invalid URL provided: {payload.url}")
+    if re.match(r"^https?://[^/]+/$", url):
+        logging.warn(f"Invalid URL provided: {url}")
         raise HTTPException(
             status_code=400,
             detail="I am sorry, I can't analyze home pages",
         )
 
-    page = app_logic.create_page(payload)
+    ## The bookmark URL is cleaned from the payload URL, check for it before parsing the page
+    bookmark = await app_logic.get_bookmark_by_url_async(url)
+    if bookmark is not None:
+        logging.info(f"Bookmark already exists for {bookmark.url}")
+    return bookmark
+
 
+async def save_bookmark(
+    page: Page, url: str, user_id: str, summarization_mode: Optional[str]
+) -> Bookmark:
     if page is None:
-        logging.warn(f"Page object not created for {payload.url}")
+        logging.warn(f"Page object not created for {url}")
         raise HTTPException(
             status_code=400,
             detail="Hmm, I wasn't able to find information on this page. I sent a message to our engineers",
         )
 
-    ## Check in bookmark already exists
-    bookmark = app_logic.get_bookmark_by_url(page.clean_url)
+    logging.info(f"Page object created for {page.clean_url}")
+    bookmark = await app_logic.create_bookmark_async(page, user_id)
+    logging.info(f"Bookmark created for {bookmark.url}")
+    await app_logic.enqueue_job_async(
+        bookmark.document_id, "generate", summarization_mode
+    )
+    return bookmark
+
+
+@app.post(
+    "/bookmark",
+    responses={
+        400: {
+            "model": HTTPError,
+            "description": "Reporting back errors",
+        },
+        201: {"model": Bookmark, "description": "Bookmark created successfully"},
+    },
+)
+async def create_bookmark(
+    payload: PagePayload,
+    response: Response,
+    summarization_mode: Optional[Literal["single", "map_reduce"]] = Query(default=None),
+):
+    """
+    The body can be compressed with Content-Encoding gzip, deflate, br or zstd
+    (see DecompressRequestMiddleware)
+    """
+
+    logging.info(f"Icognition bookmark endpoint called on {payload.url}")
+
+    response.status_code = status.HTTP_201_CREATED
+    bookmark = await get_existing_bookmark(payload.url, payload.user_id)
     if bookmark is not None:
-        logging.info(f"Bookmark already exists for {page.clean_url}")
-        response.status_code = status.HTTP_201_CREATED
         return bookmark
-    else:
-        logging.info(f"Page object created for {page.clean_url}")
-        bookmark = app_logic.create_bookmark(page, payload.user_id)
-        logging.info(f"Bookmark created for {bookmark.url}")
-        background_tasks.add_task(generate_document, bookmark.document_id)
-        response.status_code = status.HTTP_201_CREATED
+
+    try:
+        page = await app_logic.create_page_async(payload)
+    except (ParserQueueFull, BrokenProcessPool) as e:
+        logging.warning(e)
+        raise HTTPException(status_code=503, detail="Bookmarking is busy, please try again")
+    return await save_bookmark(page, payload.url, payload.user_id, summarization_mode)
+
+
+@app.post(
+    "/bookmark/html",
+    responses={
+        400: {
+            "model": HTTPError,
+            "description": "Reporting back errors",
+        },
+        201: {"model": Bookmark, "description": "Bookmark created successfully"},
+    },
+)
+async def create_bookmark_from_html(
+    request: Request,
+    response: Response,
+    url: str,
+    user_id: Optional[str] = None,
+    summarization_mode: Optional[Literal["single", "map_reduce"]] = Query(default=None),
+):
+    """
+    Same as /bookmark with the page HTML as the raw request body (text/html, optionally
+    compressed) and the URL and user in the query. The body is fed to the parser as it
+    arrives instead of being decoded from a JSON string first.
+    """
+
+    logging.info(f"Icognition bookmark html endpoint called on {url}")
+
+    response.status_code = status.HTTP_201_CREATED
+    bookmark = await get_existing_bookmark(url, user_id)
+    if bookmark is not None:
         return bookmark
 
+    content_type = request.headers.get("content-type", "")
+    charset = None
+    if "charset=" in content_type:
+        charset = content_type.split("charset=")[-1].split(";")[0].strip()
+
+    try:
+        page = await app_logic.create_page_from_stream(url, request.stream(), charset)
+    except (ParserQueueFull, BrokenProcessPool) as e:
+        logging.warning(e)
+        raise HTTPException(status_code=503, detail="Bookmarking is busy, please try again")
+    return await save_bookmark(page, url, user_id, summarization_mode)
+
 
 @app.post(
     "/document/regenerate",
@@ -125,21 +249,23 @@ async def create_bookmark(
     status_code=status.HTTP_202_ACCEPTED,
 )
 async def post_regenerate_document(
-    old_doc: Document, background_tasks: BackgroundTasks
+    old_doc: Document,
+    summarization_mode: Optional[Literal["single", "map_reduce"]] = Query(default=None),
 ):
     """
     This method create document using a bookmark id and a URL.
     Because create_bookmark also generate document, this method is use to re-generate
     the a document. Because it can take time to generate a document, this method
-    kickoff the generate and return 202
+    kickoff the generate and return 202.
+    summarization_mode=map_reduce summarizes long articles in chunks instead of compressing them.
     """
     logging.info(f"Regenrate Document ID {old_doc.id}")
-    # Generate LLM content in a background process
+    # Generate LLM content in the worker process (app/worker.py)
 
     # Reason for returning bookmark is because the document will changed after the regeneration,
     # and the bookmark will be used to get the new document
     new_doc = app_logic.clone_document(old_doc)
-    background_tasks.add_task(regenerate_document, new_doc)
+    await app_logic.enqueue_job_async(new_doc.id, "regenerate", summarization_mode)
     bookmark = app_logic.reassociate_bookmark_with_document(old_doc.id, new_doc.id)
 
     if bookmark is None:
@@ -148,37 +274,30 @@ async def post_regenerate_document(
     return bookmark
 
 
-## Background task to generate summaries from LLM
-async def generate_document(document_id):
-    document = app_logic.get_document_by_id(document_id)
-
-    if document.status in ["Pending", "Done", "Failure"]:
-        logging.info(f"Background task for document ID: {document_id}")
-        document = await app_logic.extract_info_from_doc(document)
-        logging.info(f"Background task for document ID: {document_id} completed")
-
-
-## Background task to regenerate summaries from LLM if not already exists
-async def regenerate_document(doc: Document):
-
-    if doc.status in ["Pending", "Done", "Failure"]:
-
-        new_doc = await app_logic.extract_info_from_doc(doc)
-        if new_doc:
-            logging.info(f"Background task for document ID: {new_doc.id} completed")
-        else:
-            logging.error(
-                f"Background document regenaring for document ID: {doc.id} failed"
-            )
+def set_next_cursor(response: Response, next_cursor: Optional[str]) -> None:
+    """The cursor of the next page is returned in the X-Next-Cursor header, absent on the last page"""
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
 
 
 @app.get("/bookmark/user/{user_id}", response_model=List[Bookmark], status_code=200)
-async def get_bookmarks_by_user_id(user_id: str):
-    bookmarks = app_logic.get_bookmarks_by_user_id(user_id)
+async def get_bookmarks_by_user_id(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+):
+    try:
+        bookmarks, next_cursor = await app_logic.get_bookmarks_by_user_id_async(
+            user_id, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
     if bookmarks is None:
         raise HTTPException(status_code=404, detail="Bookmarks not found")
 
+    set_next_cursor(response, next_cursor)
     logging.info(f"Icognition return {len(bookmarks)} bookmarks")
     return bookmarks
 
@@ -188,28 +307,27 @@ async def get_bookmarks_by_user_id(user_id: str):
     response_model=List[DocumentDisplay],
     status_code=200,
 )
-async def get_documents_plus_by_user_id(user_id: str):
-    bookmarks = app_logic.get_bookmarks_by_user_id(user_id)
-
-    if bookmarks is None:
-        raise HTTPException(status_code=404, detail="Bookmarks not found")
-
-    results = []
-    for bookmark in bookmarks:
-        document = app_logic.get_document_by_id(bookmark.document_id)
-        entities = app_logic.get_entities_by_document_id(document.id)
-
-        display = DocumentDisplay.from_orm(document, entities=entities)
-
-        results.append(display)
+async def get_documents_plus_by_user_id(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+):
+    try:
+        results, next_cursor = await app_logic.get_documents_plus_by_user_id_async(
+            user_id, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
+    set_next_cursor(response, next_cursor)
     logging.info(f"Icognition return {len(results)} documents_plus")
     return results
 
 
 @app.get("/bookmark", response_model=Bookmark, status_code=200)
 async def get_bookmark_by_url(url: str):
-    bookmark = app_logic.get_bookmark_by_url(url)
+    bookmark = await app_logic.get_bookmark_by_url_async(url)
 
     if bookmark is None:
         raise HTTPException(status_code=404, detail="Bookmark not found")
@@ -221,7 +339,7 @@ async def get_bookmark_by_url(url: str):
 @app.get("/bookmark/{id}/document")
 async def get_bookmark_document(id: int, response: Response):
     logging.info(f"Icognition bookmark document endpoint called on {id}")
-    document = app_logic.get_document_by_bookmark_id(id)
+    document = await app_logic.get_document_by_bookmark_id_async(id)
 
     if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -240,7 +358,7 @@ async def get_document_plus(bookmark_id: int, response: Response, background_tas
     """get document with entities and concepts"""
 
     logging.info(f"Document plus -> endpoint called on bookmark {bookmark_id}")
-    document = app_logic.get_document_by_bookmark_id(bookmark_id)
+    document = await app_logic.get_document_by_bookmark_id_async(bookmark_id)
 
     if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -253,7 +371,7 @@ async def get_document_plus(bookmark_id: int, response: Response, background_tas
         )
         return DocumentDisplay.from_orm(document)
     elif document.status == "Done":
-        entities = app_logic.get_entities_by_document_id(document.id)
+        entities = await app_logic.get_entities_by_document_id_async(document.id)
 
         response.status_code = status.HTTP_200_OK
         logging.info(
@@ -269,10 +387,88 @@ async def get_document_plus(bookmark_id: int, response: Response, background_tas
         return DocumentDisplay.from_orm(document)
 
 
+async def document_display_event(document: Document) -> str:
+    entities = None
+    if document.status == "Done":
+        entities = await app_logic.get_entities_by_document_id_async(document.id)
+    display = DocumentDisplay.from_orm(document, entities=entities)
+    return f"event: {document.status}\ndata: {display.model_dump_json()}\n\n"
+
+
+async def document_events(document_id: int, state: dict):
+    """
+    Send the document now and after each status notification, until it's no longer
+    Pending or Processing. Every heartbeat re-reads the document as well, in case a
+    notification was missed while the listener reconnected.
+    """
+    queue = document_listener.subscribe(document_id)
+    try:
+        try:
+            await document_listener.ensure_started()
+        except Exception as e:
+            logging.error(f"Document events -> listener not started, re-reading on heartbeat {e}")
+
+        deadline = time.monotonic() + DOCUMENT_EVENTS_MAX_SECONDS
+        last_event = None
+        while True:
+            document = await app_logic.get_document_by_id_async(document_id)
+            if document is None:
+                return
+
+            event = await document_display_event(document)
+            if event != last_event:
+                yield event
+                last_event = event
+
+            if document.status not in ["Processing", "Pending"]:
+                state["status"] = document.status
+                return
+            if time.monotonic() > deadline:
+                return
+
+            try:
+                await asyncio.wait_for(queue.get(), DOCUMENT_EVENTS_HEARTBEAT_SECONDS)
+                ## Several updates may have arrived, one read covers them all
+                while not queue.empty():
+                    queue.get_nowait()
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+    finally:
+        document_listener.unsubscribe(document_id, queue)
+
+
+@app.get("/document_plus/{bookmark_id}/events")
+async def get_document_plus_events(bookmark_id: int, background_tasks: BackgroundTasks):
+    """
+    Server-sent events with the document of the bookmark, instead of polling /document_plus.
+    An event is sent on connect and on every change, named after the document status,
+    with the same body as /document_plus. The stream ends once the document is Done or failed.
+    """
+    document = await app_logic.get_document_by_bookmark_id_async(bookmark_id)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+
+    state = {"status": document.status}
+
+    async def generate_embedding_when_done():
+        if state["status"] == "Done":
+            await generate_embedding()
+
+    # Generate embeddings for the document, like /document_plus does once it's Done
+    background_tasks.add_task(generate_embedding_when_done)
+
+    return StreamingResponse(
+        document_events(document.id, state),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background_tasks,
+    )
+
+
 @app.get("/document/{id}")
 async def get_document(id: int, response: Response):
     logging.info(f"Icognition document endpoint called on {id}")
-    document = app_logic.get_document_by_id(id)
+    document = await app_logic.get_document_by_id_async(id)
 
     if document is None:
         raise HTTPException(status_code=404, detail="Document not found")
@@ -291,7 +487,7 @@ async def get_document(id: int, response: Response):
 @app.get("/document/{id}/entities")
 async def get_entities(id: int, response: Response):
     logging.info(f"Icognition document entities endpoint called on {id}")
-    entities = app_logic.get_entities_by_document_id(id)
+    entities = await app_logic.get_entities_by_document_id_async(id)
 
     if entities is None:
         response.status_code = status.HTTP_404_NOT_FOUND
@@ -314,16 +510,28 @@ async def delete_document(id: int) -> None:
 
 
 @app.get("/entities/{user_id}", response_model=List, status_code=200)
-async def post_entities_tree(user_id: str):
-    logging.info(f"Post entities tree")
-    entities = app_logic.get_entities_by_user_id(user_id)
+async def get_entities_by_user_id(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(default=None, ge=1, le=MAX_PAGE_LIMIT),
+    cursor: Optional[str] = None,
+):
+    logging.info(f"Get entities by user")
+    try:
+        entities, next_cursor = await app_logic.get_entities_by_user_id_async(
+            user_id, limit, cursor
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    set_next_cursor(response, next_cursor)
     return entities
 
 
 @app.get("/entities_tree/{user_id}", response_model=List, status_code=200)
 async def post_entities_tree(user_id: str):
     logging.info(f"Post entities tree")
-    entities = app_logic.get_entities_tree_by_user_id(user_id)
+    entities = await app_logic.get_entities_tree_by_user_id_async(user_id)
     return entities
 
 
@@ -334,7 +542,13 @@ async def search_documents(search_payload: SearchPayload):
     if(search_payload.query == None):
         documents = app_logic.search_documents(search_payload.user_id, search_payload.query)
     else:
-        documents = app_logic.search_embeddings(search_payload.user_id, search_payload.query)
+        try:
+            documents = await app_logic.search_embeddings(
+                search_payload.user_id, search_payload.query, search_payload.top_k
+            )
+        except EmbeddingQueueFull as e:
+            logging.warning(e)
+            raise HTTPException(status_code=503, detail="Search is busy, please try again")
 
     return documents
 
@@ -1,5 +1,5 @@
 from sqlmodel import SQLModel, Field, ARRAY, Float, JSON, Integer
-from sqlalchemy import Column
+from sqlalchemy import Column, Index, UniqueConstraint, text
 from sqlalchemy.dialects.postgresql import TEXT, JSONB
 from pgvector.sqlalchemy import Vector
 from typing import Optional, List, Dict
@@ -32,11 +32,12 @@ class HTTPError(SQLModel, table=False):
 
 class SearchPayload(SQLModel, table=False):
     """
-    Represents the payload for a search, including the query and user ID.
+    Represents the payload for a search, including the query, user ID and number of documents to return.
     """
 
     query: Optional[str] = Field(default=None)
     user_id: Optional[str] = Field(default=None)
+    top_k: int = Field(default=10, ge=1, le=100)
 
 
 class Page(SQLModel, table=False):
@@ -64,6 +65,15 @@ class Bookmark(SQLModel, table=True):
     cloned_documents: List[int] = Field(default=[], sa_column=Column(ARRAY(Integer)))
 
 
+## Supports the keyset pagination of a user's bookmarks, ordered by update_at desc, id
+Index(
+    "ix_bookmark_user_id_update_at_id",
+    Bookmark.__table__.c.user_id,
+    Bookmark.__table__.c.update_at.desc(),
+    Bookmark.__table__.c.id,
+)
+
+
 class Document(SQLModel, table=True):
     """
     Represents a document with its ID, title, URL, original text, authors, short summary, summary bullet points,
@@ -86,12 +96,76 @@ class Document(SQLModel, table=True):
 
 
 class Document_Embeddings(SQLModel, table=True):
+    __table_args__ = (
+        Index(
+            "ix_document_embeddings_embeddings_hnsw",
+            "embeddings",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embeddings": "vector_cosine_ops"},
+        ),
+    )
+
     id: int = Field(default=None, primary_key=True)
-    document_id: int = Field(nullable=False)
+    document_id: int = Field(nullable=False, index=True)
     field: str = Field(default=None, nullable=True)
     embeddings: List[float] = Field(sa_column=Column(Vector(384)))
 
 
+class LlmResultCache(SQLModel, table=True):
+    """
+    Represents a parsed LLM answer (DocumentJsonForLLMS without usage), keyed by a hash of the
+    normalized text, prompt version and model name, so identical content is summarized once.
+    """
+
+    __tablename__ = "llm_result_cache"
+
+    key: str = Field(primary_key=True)
+    model_name: str = Field(nullable=False)
+    prompt_version: str = Field(nullable=False)
+    result: Dict = Field(sa_column=Column(JSONB, nullable=False))
+    usage: Optional[Dict] = Field(default=None, sa_column=Column(JSONB))
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+
+
+class Job(SQLModel, table=True):
+    """
+    Represents background work on a document, e.g. generating its summary with the LLM.
+    Workers claim pending jobs with SELECT ... FOR UPDATE SKIP LOCKED and record every attempt.
+    """
+
+    __table_args__ = (
+        ## Claiming only looks at Pending and Running jobs, finished ones stay out of the index
+        Index(
+            "ix_job_claim",
+            "status",
+            "run_after",
+            "id",
+            postgresql_where=text("status IN ('Pending', 'Running')"),
+        ),
+        ## At most one pending or running job per document
+        Index(
+            "ix_job_active_document_id",
+            "document_id",
+            unique=True,
+            postgresql_where=text("status IN ('Pending', 'Running')"),
+        ),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    kind: str = Field(nullable=False)
+    document_id: int = Field(nullable=False, index=True)
+    summarization_mode: str = Field(default="single", nullable=False)
+    status: str = Field(default="Pending", nullable=False)
+    attempts: int = Field(default=0, nullable=False)
+    max_attempts: int = Field(default=3, nullable=False)
+    last_error: Optional[str] = Field(default=None, nullable=True)
+    run_after: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    locked_at: Optional[datetime] = Field(default=None, nullable=True)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+    update_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
+
+
 class DocArtifact(SQLModel, table=False):
     """
     Represents a document artifact with its ID.
@@ -115,6 +189,36 @@ class Entity(SQLModel, table=True):
     score: Optional[float] = Field(default=None, nullable=True)
 
 
+class CanonicalEntity(SQLModel, table=True):
+    """
+    Represents an entity shared by all documents and users, unique by its normalized name and type.
+    The name keeps the spelling of the first time the entity was seen.
+    """
+
+    __tablename__ = "canonical_entity"
+    __table_args__ = (UniqueConstraint("normalized_name", "type"),)
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(nullable=False)
+    normalized_name: str = Field(nullable=False)
+    type: str = Field(nullable=False)
+
+
+class DocumentEntity(SQLModel, table=True):
+    """
+    Links a document to a canonical entity, with the description, source and score
+    given to the entity in that document.
+    """
+
+    __tablename__ = "document_entity"
+
+    document_id: int = Field(primary_key=True)
+    entity_id: int = Field(primary_key=True, index=True)
+    description: str = Field(default=None, nullable=True)
+    source: str = Field(default=None, nullable=True)
+    score: Optional[float] = Field(default=None, nullable=True)
+
+
 """ 
 The pydantic class is used to give JSON Schema to the Together.AI API. See how it's being used in togeher_api_client.py 
 Why I used Pydantic instead of SQLModel? Good question, in my testing I was not able to get a complete JSON Schema from SQLModel.
@@ -0,0 +1,95 @@
+import os
+import codecs
+import asyncio
+import logging
+import aiohttp
+
+
+FETCH_CONNECT_TIMEOUT = float(os.environ.get("FETCH_CONNECT_TIMEOUT", 5))
+FETCH_READ_TIMEOUT = float(os.environ.get("FETCH_READ_TIMEOUT", 10))
+FETCH_TOTAL_TIMEOUT = float(os.environ.get("FETCH_TOTAL_TIMEOUT", 30))
+FETCH_MAX_BYTES = int(os.environ.get("FETCH_MAX_BYTES", 5 * 1024 * 1024))
+FETCH_MAX_CONNECTIONS = int(os.environ.get("FETCH_MAX_CONNECTIONS", 100))
+FETCH_MAX_PER_HOST = int(os.environ.get("FETCH_MAX_PER_HOST", 4))
+
+FETCH_CHUNK_SIZE = 64 * 1024
+
+
+class PageFetcher:
+    """
+    Fetches pages for bookmarks sent without their HTML, without blocking the event loop.
+    One connection pool for the process, with at most max_per_host connections to a site,
+    so a slow site can't take every connection. Bodies are decoded while they stream in and
+    cut off at max_bytes, the article is near the top of a page.
+    """
+
+    def __init__(
+        self,
+        connect_timeout: float = FETCH_CONNECT_TIMEOUT,
+        read_timeout: float = FETCH_READ_TIMEOUT,
+        total_timeout: float = FETCH_TOTAL_TIMEOUT,
+        max_bytes: int = FETCH_MAX_BYTES,
+        max_connections: int = FETCH_MAX_CONNECTIONS,
+        max_per_host: int = FETCH_MAX_PER_HOST,
+    ) -> None:
+        self.max_bytes = max_bytes
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self._timeout = aiohttp.ClientTimeout(
+            total=total_timeout, sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        ## Created on first use, a session belongs to the running event loop
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections, limit_per_host=self.max_per_host
+                ),
+                timeout=self._timeout,
+                headers={"User-Agent": "Icognition App"},
+            )
+        return self._session
+
+    async def fetch(self, url: str) -> str:
+        """HTML of the page, None when it can't be fetched in time or isn't a 200"""
+        try:
+            async with self._get_session().get(url) as response:
+                if response.status != 200:
+                    logging.error(f"Page fetcher -> {url} returned status {response.status}")
+                    return None
+                return await self._read_text(url, response)
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            logging.error(f"Page fetcher -> error fetching {url} {e!r}")
+            return None
+
+    async def _read_text(self, url: str, response: aiohttp.ClientResponse) -> str:
+        try:
+            decoder = codecs.getincrementaldecoder(response.charset or "utf-8")(
+                errors="replace"
+            )
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        parts = []
+        size = 0
+        async for chunk in response.content.iter_chunked(FETCH_CHUNK_SIZE):
+            chunk = chunk[: self.max_bytes - size]
+            size += len(chunk)
+            parts.append(decoder.decode(chunk))
+            if size >= self.max_bytes:
+                logging.warning(f"Page fetcher -> {url} is over {self.max_bytes} bytes, cut off")
+                break
+
+        parts.append(decoder.decode(b"", final=True))
+        return "".join(parts)
+
+    async def close(self) -> None:
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+page_fetcher = PageFetcher()
@@ -0,0 +1,189 @@
+import io
+import os
+import zlib
+import logging
+from starlette.datastructures import Headers
+from starlette.exceptions import HTTPException
+from starlette.responses import PlainTextResponse
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+REQUEST_MAX_DECOMPRESSED_BYTES = int(
+    os.environ.get("REQUEST_MAX_DECOMPRESSED_BYTES", 50 * 1024 * 1024)
+)
+
+
+class BodyTooLarge(Exception):
+    """Raised by a decompressor as soon as its output would go over the allowed size"""
+
+
+class ZlibDecompressor:
+    def __init__(self, wbits: int) -> None:
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        ## The output of a call is capped, a small body can't inflate to gigabytes in one call.
+        ## Input left unconsumed at the cap means there's more output than allowed.
+        body = self._decompressor.decompress(data, max_size + 1)
+        if len(body) > max_size or self._decompressor.unconsumed_tail:
+            raise BodyTooLarge()
+        return body
+
+    def finish(self, max_size: int) -> bytes:
+        ## flush() isn't capped, and a complete stream has nothing left for it once its input
+        ## is consumed under the cap
+        if not self._decompressor.eof:
+            raise ValueError("Truncated stream")
+        return b""
+
+
+class BrotliDecompressor:
+    def __init__(self) -> None:
+        self._decompressor = brotli.Decompressor()
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        body = self._decompressor.process(data, output_buffer_limit=max_size + 1)
+        if len(body) > max_size or not self._decompressor.can_accept_more_data():
+            raise BodyTooLarge()
+        return body
+
+    def finish(self, max_size: int) -> bytes:
+        if not self._decompressor.is_finished():
+            raise ValueError("Truncated stream")
+        return b""
+
+
+class ZstdDecompressor:
+    """
+    zstandard's decompressobj can't cap the output of a call, so the compressed body is kept
+    (it's at most max_size) and read back through a stream reader in bounded reads at the end.
+    """
+
+    READ_SIZE = 256 * 1024
+
+    def __init__(self) -> None:
+        self._compressed = io.BytesIO()
+
+    def decompress(self, data: bytes, max_size: int) -> bytes:
+        self._compressed.write(data)
+        if self._compressed.tell() > max_size:
+            raise BodyTooLarge()
+        return b""
+
+    def finish(self, max_size: int) -> bytes:
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            self._compressed.getvalue(), read_across_frames=True
+        )
+        parts = []
+        size = 0
+        while True:
+            part = reader.read(min(self.READ_SIZE, max_size + 1 - size))
+            if not part:
+                return b"".join(parts)
+            parts.append(part)
+            size += len(part)
+            if size > max_size:
+                raise BodyTooLarge()
+
+
+def supported_encodings() -> list[str]:
+    encodings = ["gzip", "deflate"]
+    if brotli_supported():
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+def brotli_supported() -> bool:
+    ## Capping the output of a call needs Brotli 1.2's output_buffer_limit
+    return brotli is not None and hasattr(brotli.Decompressor, "can_accept_more_data")
+
+
+def get_decompressor(encoding: str):
+    """Decompressor for a Content-Encoding, None when it isn't supported"""
+    if encoding in ("gzip", "x-gzip"):
+        return ZlibDecompressor(16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return ZlibDecompressor(zlib.MAX_WBITS)
+    if encoding == "br" and brotli_supported():
+        return BrotliDecompressor()
+    if encoding == "zstd" and zstandard is not None:
+        return ZstdDecompressor()
+    return None
+
+
+class DecompressRequestMiddleware:
+    """
+    ASGI middleware decompressing request bodies sent with a Content-Encoding
+    (gzip, deflate, and br and zstd when Brotli 1.2+ and zstandard are installed).
+    gzip, deflate and br bodies are decompressed chunk by chunk as the app reads it, so handlers
+    that stream the body never hold it whole. zstd bodies are decompressed once complete.
+    Every decompressor caps its output, bodies over max_size once decompressed get a 413
+    before inflating further, raised as an HTTPException from receive so the app's exception
+    handling answers it.
+    """
+
+    def __init__(self, app, max_size: int = REQUEST_MAX_DECOMPRESSED_BYTES) -> None:
+        self.app = app
+        self.max_size = max_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        encoding = Headers(scope=scope).get("content-encoding", "").strip().lower()
+        if encoding in ("", "identity"):
+            return await self.app(scope, receive, send)
+
+        decompressor = get_decompressor(encoding)
+        if decompressor is None:
+            response = PlainTextResponse(
+                f"Unsupported Content-Encoding {encoding}, use one of {supported_encodings()}",
+                status_code=415,
+            )
+            return await response(scope, receive, send)
+
+        ## The app sees the decompressed body, the original length no longer applies
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value)
+            for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+
+        state = {"size": 0}
+
+        async def receive_decompressed():
+            message = await receive()
+            if message["type"] != "http.request":
+                return message
+
+            try:
+                body = decompressor.decompress(
+                    message.get("body", b""), self.max_size - state["size"]
+                )
+                if not message.get("more_body", False):
+                    body += decompressor.finish(self.max_size - state["size"] - len(body))
+            except BodyTooLarge:
+                raise HTTPException(
+                    status_code=413,
+                    detail=f"Request body is over {self.max_size} bytes decompressed",
+                )
+            except Exception as e:
+                logging.error(f"Error decompressing {encoding} request body {e}")
+                raise HTTPException(status_code=400, detail=f"Invalid {encoding} body")
+
+            state["size"] += len(body)
+            return {**message, "body": body}
+
+        await self.app(scope, receive_decompressed, send)
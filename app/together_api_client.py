@@ -5,13 +5,17 @@ import logging
 import sys
 import re
 import json
+import hashlib
 import openai
 import aiohttp
 import asyncio
-from time import sleep
-from transformers import AutoTokenizer
-from app.icog_util import truncate_text
+import bisect
+import time
+from pydantic import ValidationError
+from app.icog_util import truncate_text, split_sentences, get_tokenizer, count_prompt_tokens
+from app.llm_retry import ApiCallException, RetryPolicy
 from app.models import DocumentJsonForLLMS
+from app.json_stream import PartialJsonObject
 
 
 logging.basicConfig(
@@ -28,10 +32,148 @@ client = openai.OpenAI(
 )
 
 
-class ApiCallException(Exception):
-    def __init__(self, message, response):
-        super().__init__(message)
-        self.response = response
+LLM_MAX_IN_FLIGHT = int(config.get("LLM_MAX_IN_FLIGHT", 4))
+LLM_REQUESTS_PER_MINUTE = float(config.get("LLM_REQUESTS_PER_MINUTE", 60))
+LLM_TOKENS_PER_MINUTE = float(config.get("LLM_TOKENS_PER_MINUTE", 100000))
+## Completion tokens reserved per request until the real usage is known
+LLM_COMPLETION_TOKENS_ESTIMATE = int(config.get("LLM_COMPLETION_TOKENS_ESTIMATE", 1024))
+## Chat template markers ([INST], </s>...) added around each message
+LLM_MESSAGE_OVERHEAD_TOKENS = 8
+## Share of the budget kept when the API still says the prompt is too long
+LLM_TOO_LONG_SHRINK = 0.75
+## Map-reduce mode: article tokens per chunk and answer tokens per chunk summary
+LLM_MAP_CHUNK_TOKENS = int(config.get("LLM_MAP_CHUNK_TOKENS", 6000))
+LLM_MAP_MAX_TOKENS = int(config.get("LLM_MAP_MAX_TOKENS", 512))
+
+QUEUE_WAIT_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 120, 300]
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at per_minute / 60 per second, holding at most per_minute.
+    Used to stay under the requests per minute and tokens per minute quotas of the API.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self._rate = per_minute / 60
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount can be taken, 0 if available now"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0
+        return (amount - self.tokens) / self._rate
+
+    def take(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount: float) -> None:
+        """Return (or with a negative amount, charge) tokens once the real cost is known"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class LlmDispatcher:
+    """
+    Bounds the LLM calls of the process: at most max_in_flight concurrent calls,
+    and request and token rates under the per minute quotas, so bursts of bookmarks
+    queue here instead of being throttled by the API.
+    """
+
+    def __init__(
+        self, max_in_flight: int, requests_per_minute: float, tokens_per_minute: float
+    ) -> None:
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._lock = asyncio.Lock()
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.wait_sum = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(QUEUE_WAIT_BUCKETS) + 1)
+
+    async def _acquire_rate(self, tokens: int) -> None:
+        ## One waiter at a time so requests are served in arrival order
+        async with self._lock:
+            while True:
+                wait_time = max(
+                    self._requests.wait_time(1), self._tokens.wait_time(tokens)
+                )
+                if wait_time == 0:
+                    break
+                await asyncio.sleep(wait_time)
+            self._requests.take(1)
+            self._tokens.take(tokens)
+
+    def _observe_wait(self, seconds: float) -> None:
+        self.calls += 1
+        self.wait_sum += seconds
+        self.wait_max = max(self.wait_max, seconds)
+        self.wait_buckets[bisect.bisect_left(QUEUE_WAIT_BUCKETS, seconds)] += 1
+
+    async def submit(self, api_call, estimated_tokens: int, *args):
+        """Wait for a slot and for quota, then await api_call(*args)"""
+        start_time = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+            try:
+                await self._acquire_rate(estimated_tokens)
+            except BaseException:
+                self._semaphore.release()
+                raise
+        finally:
+            self.waiting -= 1
+        self._observe_wait(time.perf_counter() - start_time)
+
+        self.in_flight += 1
+        try:
+            res = await api_call(*args)
+            usage = res.get("usage") if isinstance(res, dict) else None
+            if usage and usage.get("total_tokens"):
+                self._tokens.give_back(estimated_tokens - usage["total_tokens"])
+            return res
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        histogram = {}
+        total = 0
+        for bound, count in zip(QUEUE_WAIT_BUCKETS + ["+Inf"], self.wait_buckets):
+            total += count
+            histogram[str(bound)] = total
+
+        return {
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "calls": self.calls,
+            "wait_sum": self.wait_sum,
+            "wait_max": self.wait_max,
+            "wait_histogram": histogram,
+            "requests_available": self._requests.tokens,
+            "tokens_available": self._tokens.tokens,
+        }
+
+
+## Shared by every client in the process, they draw on the same API quota
+dispatcher = LlmDispatcher(
+    LLM_MAX_IN_FLIGHT, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE
+)
 
 
 class PromptTemplates:
@@ -140,13 +282,9 @@ class TogetherMixtralClient:
         self._options = {"use_cache": True}
         self._api_url = "https://api.together.xyz/inference"
         self._model_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            self._model_name, use_fast=True, use_cache=False
-        )
+        self._tokenizer = get_tokenizer(self._model_name, use_fast=True, use_cache=False)
         self._max_length = 32000
-        self._retry_sleep = 30
-        self._retry_attempts = 0
-        self._retry_max_attempts = 2
+        self._retry_policy = RetryPolicy()
         self._client_session = aiohttp.ClientSession(
             headers={
                 "Authorization": f"Bearer {self._api_token}",
@@ -189,105 +327,359 @@ class TogetherMixtralClient:
 
         self._user_content_3_article = """Article: {BODY}"""
 
-    def build_query(self, templete: str, body_text: str) -> str:
-        results = templete.format(BODY=body_text)
-        tokens = self._tokenizer.encode(results, return_tensor="np")
-        if len(tokens[0]) > self._max_length:
-            logging.warn(f"Query is too big, let shorten the body text")
+        self._map_content = """Summarize this part of an article in up to ten bullet-points.
+        Keep the names of the people, companies, locations, products, topics and ideas it mentions, with a short explanation of each.
+        Only output the bullet-points.
+        Part {PART} of {PARTS}: {BODY}"""
+
+        ## Changes whenever the prompt or the answer schema is edited, used to key cached answers
+        self._prompt_version = hashlib.sha256(
+            "\n".join(
+                [
+                    self._system_content,
+                    self._user_content_1_examples,
+                    self._user_content_2_task,
+                    self._user_content_3_article,
+                    self._map_content,
+                    json.dumps(DocumentJsonForLLMS.model_json_schema(), sort_keys=True),
+                ]
+            ).encode()
+        ).hexdigest()[:16]
+
+    def count_tokens(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False))
+
+    def scaffold_tokens(self) -> int:
+        """Tokens of the fixed system, examples and task messages, memoized per process"""
+        messages = [
+            self._system_content,
+            self._user_content_1_examples,
+            self._user_content_2_task,
+            self._user_content_3_article.format(BODY=""),
+        ]
+        return sum(
+            count_prompt_tokens(self._model_name, message) + LLM_MESSAGE_OVERHEAD_TOKENS
+            for message in messages
+        )
+
+    def article_budget(self, template: PromptTemplates = None) -> int:
+        """Tokens left for the article once the fixed messages and the answer are reserved"""
+        if template is None:
+            scaffold_tokens = self.scaffold_tokens()
+        else:
+            scaffold_tokens = (
+                count_prompt_tokens(self._model_name, template(""))
+                + 2 * LLM_MESSAGE_OVERHEAD_TOKENS
+            )
+        return self._max_length - scaffold_tokens - LLM_COMPLETION_TOKENS_ESTIMATE
+
+    def build_messages(self, article: str, template: PromptTemplates = None) -> list[dict]:
+        """
+        Chat messages of the request. A template renders the whole prompt as one user message,
+        without one the system, examples, task and article messages are sent.
+        """
+        if template is not None:
+            return [
+                {"role": "system", "content": self._system_content},
+                {"role": "user", "content": template(article)},
+            ]
+        return [
+            {"role": "system", "content": self._system_content},
+            {"role": "user", "content": self._user_content_1_examples},
+            {"role": "user", "content": self._user_content_2_task},
+            {"role": "user", "content": self._user_content_3_article.format(BODY=article)},
+        ]
+
+    def build_payload(
+        self,
+        article: str,
+        model=DocumentJsonForLLMS,
+        temperature=0.2,
+        top_p=0.8,
+        top_k=70,
+        template: PromptTemplates = None,
+    ) -> dict:
+        return {
+            "model": self._model_name,
+            "messages": self.build_messages(article, template),
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "repetition_penalty": 1,
+            "response_format": {
+                "type": "json_object",
+                "schema": model.model_json_schema(),
+            },
+        }
+
+    def estimate_tokens(self, payload: dict) -> int:
+        """Rough token cost of a request for rate limiting, about 4 characters per token"""
+        prompt_length = sum(len(message["content"]) for message in payload["messages"])
+        return prompt_length // 4 + LLM_COMPLETION_TOKENS_ESTIMATE
+
+    def build_query(self, body_text: str, budget: int = None) -> tuple[str, dict]:
+        """
+        Fit the article in the token budget, compressing it with truncate_text only when
+        it doesn't fit. Returns the article and its token counts.
+        """
+        if budget is None:
+            budget = self.article_budget()
+
+        ## A token covers at least one byte, shorter texts can't be over budget
+        if len(body_text.encode()) <= budget:
+            return body_text, {"article_tokens": None, "truncated": False}
+
+        article_tokens = self.count_tokens(body_text)
+        if article_tokens <= budget:
+            return body_text, {"article_tokens": article_tokens, "truncated": False}
+
+        logging.info(
+            f"Article has {article_tokens} tokens, over the budget of {budget}. Shortening"
+        )
+        new_body_text = truncate_text(body_text, budget, article_tokens)
+
+        ## truncate_text estimates sentence tokens from their length, cut whatever is still over
+        ids = self._tokenizer.encode(new_body_text, add_special_tokens=False)
+        if len(ids) > budget:
+            ids = ids[:budget]
+            new_body_text = self._tokenizer.decode(ids)
+
+        return new_body_text, {
+            "article_tokens": article_tokens,
+            "truncated": True,
+            "truncated_tokens": len(ids),
+        }
 
-        return results
+    async def api_error(self, res) -> ApiCallException:
+        logging.info(f"API Call Error: {res.reason}. Status code: {res.status}")
+        return ApiCallException(
+            "Error during API call",
+            {
+                "status_code": res.status,
+                "content": await res.text(),
+                "reason": res.reason,
+                "retry_after": res.headers.get("Retry-After"),
+            },
+        )
 
     async def api_call(self, payload) -> dict:
         API_URL = self._api_url
         async with self._client_session.post(API_URL, json=payload) as res:
-            status = res.status
-            if status == 200:
+            if res.status == 200:
                 return await res.json()
             else:
-                logging.info(f"API Call Error: {res.reason}. Status code: {status}")
-                raise ApiCallException(
-                    "Error during API call",
-                    {
-                        "status_code": status,
-                        "content": str(res.content._exception),
-                        "reason": res.reason,
-                    },
-                )
-                return None
+                raise await self.api_error(res)
 
-    async def generate(
-        self,
-        body_text: str,
-        template: PromptTemplates = InclusiveTemplate(),
-        model=DocumentJsonForLLMS,
-        temperature=0.2,
-        top_p=0.8,
-        top_k=70,
-    ) -> DocumentJsonForLLMS:
-        ## Use template to generate prompt
-        prompt = template(body_text)
-        ## Build payload
+    async def api_call_stream(self, payload, on_field) -> dict:
+        """
+        Stream the answer as server-sent events and await on_field(key, value) for each top level
+        field of the JSON answer as soon as it's complete. Returns the same shape as api_call.
+        """
+        API_URL = self._api_url
+        parser = PartialJsonObject()
+        usage = None
+        async with self._client_session.post(
+            API_URL, json={**payload, "stream_tokens": True}
+        ) as res:
+            if res.status != 200:
+                raise await self.api_error(res)
+
+            async for line in res.content:
+                line = line.decode().strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:") :].strip()
+                if data == "[DONE]":
+                    break
+
+                event = json.loads(data)
+                if event.get("usage"):
+                    usage = event["usage"]
+                choices = event.get("choices") or [{}]
+                text = choices[0].get("text") or (event.get("token") or {}).get("text") or ""
+                for key in parser.feed(text):
+                    await on_field(key, parser.fields[key])
+
+        return {"output": {"choices": [{"text": parser.text}]}, "usage": usage or {}}
+
+    def split_into_chunks(self, body_text: str, chunk_tokens: int) -> list[str]:
+        """Split the text on sentence and line ends into chunks of at most chunk_tokens"""
+        pieces = split_sentences(body_text)
+        if not pieces:
+            return []
+        pieces_ids = self._tokenizer(pieces, add_special_tokens=False)["input_ids"]
+
+        chunks = []
+        current = []
+        current_tokens = 0
+        for piece, ids in zip(pieces, pieces_ids):
+            if current and current_tokens + len(ids) > chunk_tokens:
+                chunks.append(" ".join(current))
+                current = []
+                current_tokens = 0
+
+            ## A sentence longer than a chunk (e.g. no punctuation) is cut on token boundaries
+            if len(ids) > chunk_tokens:
+                for start in range(0, len(ids), chunk_tokens):
+                    chunks.append(self._tokenizer.decode(ids[start : start + chunk_tokens]))
+                continue
+
+            current.append(piece)
+            current_tokens += len(ids)
+
+        if current:
+            chunks.append(" ".join(current))
+        return chunks
+
+    async def summarize_chunk(self, chunk: str, part: int, parts: int) -> tuple[str, dict]:
         payload = {
-            "model": "mistralai/Mixtral-8x7B-Instruct-v0.1",
+            "model": self._model_name,
             "messages": [
                 {"role": "system", "content": self._system_content},
-                {"role": "user", "content": self._user_content_1_examples},
-                {"role": "user", "content": self._user_content_2_task},
                 {
                     "role": "user",
-                    "content": self._user_content_3_article.format(BODY=body_text),
+                    "content": self._map_content.format(PART=part, PARTS=parts, BODY=chunk),
                 },
             ],
-            "temperature": temperature,
-            "top_p": top_p,
-            "top_k": top_k,
+            "temperature": 0.2,
+            "top_p": 0.8,
+            "top_k": 70,
+            "max_tokens": LLM_MAP_MAX_TOKENS,
             "repetition_penalty": 1,
-            "response_format": {
-                "type": "json_object",
-                "schema": model.model_json_schema(),
-            },
+        }
+        res, attempts = await self._retry_policy.run(
+            lambda: dispatcher.submit(
+                self.api_call, self.estimate_tokens(payload), payload
+            )
+        )
+        return res["output"]["choices"][0]["text"].strip(), {
+            **res["usage"],
+            "retries": attempts - 1,
         }
 
-        continue_loop = True
-        self._retry_attempts = 0
+    async def generate_map_reduce(
+        self, body_text: str, model=DocumentJsonForLLMS, on_field=None
+    ) -> DocumentJsonForLLMS:
+        """
+        Summarize long articles without dropping content: split the article into chunks,
+        summarize the chunks concurrently (map), then generate the answer from the chunk
+        summaries (reduce). Articles that fit the budget go through generate directly.
+        """
+        if len(body_text.encode()) <= self.article_budget():
+            return await self.generate(body_text, model=model, on_field=on_field)
+        article_tokens = self.count_tokens(body_text)
+        if article_tokens <= self.article_budget():
+            return await self.generate(body_text, model=model, on_field=on_field)
+
+        start_time = time.perf_counter()
+        chunks = self.split_into_chunks(body_text, LLM_MAP_CHUNK_TOKENS)
+        logging.info(f"Map-reduce: {article_tokens} article tokens in {len(chunks)} chunks")
+
+        results = await asyncio.gather(
+            *[
+                self.summarize_chunk(chunk, part, len(chunks))
+                for part, chunk in enumerate(chunks, start=1)
+            ]
+        )
+        map_usage = {
+            "prompt_tokens": sum(usage.get("prompt_tokens", 0) for _, usage in results),
+            "completion_tokens": sum(
+                usage.get("completion_tokens", 0) for _, usage in results
+            ),
+            "retries": sum(usage["retries"] for _, usage in results),
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
 
-        while continue_loop:
-            try:
-                self._retry_attempts += 1
-                logging.debug(f"Attempt {self._retry_attempts} to generate summary")
-                res = await self.api_call(payload)
-                logging.debug(f"Response status: {res['status']}")
+        start_time = time.perf_counter()
+        notes = "\n".join(summary for summary, _ in results)
+        answer = await self.generate(notes, model=model, on_field=on_field)
+        reduce_usage = {
+            "prompt_tokens": answer.usage.get("prompt_tokens", 0),
+            "completion_tokens": answer.usage.get("completion_tokens", 0),
+            "retries": answer.usage["retries"],
+            "seconds": round(time.perf_counter() - start_time, 3),
+        }
 
-            except ApiCallException as e:
-                logging.error(f"Error calling API and/or handleResponse: {e}")
-                raise e
+        logging.info(f"Map-reduce: map {map_usage}, reduce {reduce_usage}")
+        answer.usage = {
+            "mode": "map_reduce",
+            "chunks": len(chunks),
+            "article_tokens": article_tokens,
+            "prompt_tokens": map_usage["prompt_tokens"] + reduce_usage["prompt_tokens"],
+            "completion_tokens": map_usage["completion_tokens"]
+            + reduce_usage["completion_tokens"],
+            "total_tokens": sum(
+                usage["prompt_tokens"] + usage["completion_tokens"]
+                for usage in [map_usage, reduce_usage]
+            ),
+            "retries": map_usage["retries"] + reduce_usage["retries"],
+            "map": map_usage,
+            "reduce": reduce_usage,
+        }
+        return answer
 
-            try:
-                answer = DocumentJsonForLLMS.model_validate_json(
-                    res["output"]["choices"][0]["text"]
-                )
-                answer.usage = res["usage"]
+    async def generate(
+        self,
+        body_text: str,
+        template: PromptTemplates = None,
+        model=DocumentJsonForLLMS,
+        temperature=0.2,
+        top_p=0.8,
+        top_k=70,
+        on_field=None,
+    ) -> DocumentJsonForLLMS:
+        """
+        Generate the document answer. With on_field, the answer is streamed and
+        on_field(key, value) is awaited for each field as soon as it's complete.
+        """
+        request = {"budget": self.article_budget(template)}
+        article, budget_meta = self.build_query(body_text, request["budget"])
+        request["payload"] = self.build_payload(
+            article, model, temperature, top_p, top_k, template
+        )
 
-            except ValidationError as e:
-                logging.error(f"Error validating JSON: {e}")
-                raise e
+        ## The tokenizer count can be off from the API's, shrink the article if it says too long
+        def shorten():
+            request["budget"] = int(request["budget"] * LLM_TOO_LONG_SHRINK)
+            shorter_text, meta = self.build_query(body_text, request["budget"])
+            budget_meta.update(meta)
+            request["payload"] = self.build_payload(
+                shorter_text, model, temperature, top_p, top_k, template
+            )
 
-            if answer is not None:
-                logging.debug(
-                    f"Answer is not None. Stop retrying. Number of attempts {self._retry_attempts}"
-                )
-                continue_loop = False
-            elif self._retry_attempts <= self._retry_max_attempts:
-                logging.debug(
-                    f"Answer is None. Retry. Number of attempts {self._retry_attempts}"
-                )
-                continue_loop = True
-                sleep(self._retry_sleep)
-            else:
-                continue_loop = False
-                logging.error(
-                    f"Exitting retry loop. Number of attempts {self._retry_attempts}"
+        def call():
+            if on_field is None:
+                return dispatcher.submit(
+                    self.api_call, self.estimate_tokens(request["payload"]), request["payload"]
                 )
+            return dispatcher.submit(
+                self.api_call_stream,
+                self.estimate_tokens(request["payload"]),
+                request["payload"],
+                on_field,
+            )
+
+        try:
+            res, attempts = await self._retry_policy.run(call, on_too_long=shorten)
+        except ApiCallException as e:
+            logging.error(f"Error calling API and/or handleResponse: {e}")
+            raise e
+
+        try:
+            answer = DocumentJsonForLLMS.model_validate_json(
+                res["output"]["choices"][0]["text"]
+            )
+            ## Stored on the document as llm_service_meta
+            answer.usage = {**res["usage"], **budget_meta, "retries": attempts - 1}
+            logging.info(
+                f"LLM tokens: prompt {res['usage'].get('prompt_tokens')}, "
+                f"completion {res['usage'].get('completion_tokens')}, "
+                f"article {budget_meta['article_tokens']}, truncated {budget_meta['truncated']}"
+            )
+
+        except ValidationError as e:
+            logging.error(f"Error validating JSON: {e}")
+            raise e
 
         return answer
 
@@ -310,9 +702,7 @@ class TogetherMixtralOpenAIClient:
         self._options = {"use_cache": True}
         self._api_url = "https://api.together.xyz/inference"
         self._model_name = "mistralai/Mixtral-8x7B-Instruct-v0.1"
-        self._tokenizer = AutoTokenizer.from_pretrained(
-            self._model_name, use_fast=True, use_cache=False
-        )
+        self._tokenizer = get_tokenizer(self._model_name, use_fast=True, use_cache=False)
         self._max_length = 32000
         self._retry_sleep = 30
         self._retry_attempts = 0
@@ -1,41 +1,113 @@
+import os
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer
 from app.models import Document, Entity, Document_Embeddings
+from app.icog_util import LRUCache
+
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 64))
+EMBEDDING_QUERY_WORKERS = int(os.environ.get("EMBEDDING_QUERY_WORKERS", 2))
+EMBEDDING_BATCH_WORKERS = int(os.environ.get("EMBEDDING_BATCH_WORKERS", 1))
+EMBEDDING_MAX_QUEUE = int(os.environ.get("EMBEDDING_MAX_QUEUE", 32))
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_EMBEDDING_CACHE_TTL", 24 * 60 * 60))
 
 model = SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
 model.encode("Encode this on startup to avoid latency")
 
-def generate_embeddings(term: str) -> list[float]:
-    return model.encode(term)
 
+class EmbeddingQueueFull(Exception):
+    """Raised when more than EMBEDDING_MAX_QUEUE inference calls are already waiting on a pool"""
 
-async def get_document_embeddings(
-    documents: list[Document],
-) -> list[Document_Embeddings]:
 
-    results = []
-    for document in documents:
+class InferencePool:
+    """
+    Runs model inference on worker threads so the event loop stays free.
+    The model releases the GIL inside torch, so encoding in threads runs alongside request handling.
+    At most max_queue calls are in flight, further calls fail fast with EmbeddingQueueFull.
+    """
 
-        results.append(
-            Document_Embeddings(
-                document_id=document.id,
-                field="title",
-                embeddings=model.encode(document.title),
-            )
+    def __init__(self, name: str, workers: int, max_queue: int) -> None:
+        self.name = name
+        self.max_queue = max_queue
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix=f"embeddings-{name}"
         )
-        results.append(
-            Document_Embeddings(
-                document_id=document.id,
-                field="short_summary",
-                embeddings=model.encode(document.short_summary),
+
+    async def run(self, fn, *args, **kwargs):
+        if self.pending >= self.max_queue:
+            raise EmbeddingQueueFull(
+                f"Embedding {self.name} queue is full ({self.pending} pending)"
             )
-        )
-        for bullet_point in document.summary_bullet_points:
-            results.append(
-                Document_Embeddings(
-                    document_id=document.id,
-                    field="summary_bullet_points",
-                    embeddings=model.encode(bullet_point),
-                )
+
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, functools.partial(fn, *args, **kwargs)
             )
+        finally:
+            self.pending -= 1
+
+
+## Search queries and document backfills use separate pools, so a large backfill
+## never delays a user's search.
+query_pool = InferencePool("query", EMBEDDING_QUERY_WORKERS, EMBEDDING_MAX_QUEUE)
+batch_pool = InferencePool("batch", EMBEDDING_BATCH_WORKERS, EMBEDDING_MAX_QUEUE)
+
+
+def generate_embeddings(term: str) -> list[float]:
+    return model.encode(term)
+
+
+## all-MiniLM-L6-v2 is uncased, so lower casing the query doesn't change its embedding
+query_cache = LRUCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+
+
+def normalize_query(term: str) -> str:
+    return " ".join(term.split()).lower()
+
+
+async def generate_embeddings_async(term: str) -> list[float]:
+    """Embedding of a search query, from query_cache when the same query was seen recently"""
+    key = normalize_query(term)
+    embeddings = query_cache.get(key)
+    if embeddings is None:
+        embeddings = await query_pool.run(generate_embeddings, key)
+        query_cache.set(key, embeddings)
+    return embeddings
+
+
+def document_texts(documents: list[Document]) -> list[tuple[int, str, str]]:
+    """(document_id, field, text) of every text of the documents that gets an embedding"""
+    texts = []
+    for document in documents:
+        if document.title:
+            texts.append((document.id, "title", document.title))
+        if document.short_summary:
+            texts.append((document.id, "short_summary", document.short_summary))
+        for bullet_point in document.summary_bullet_points or []:
+            texts.append((document.id, "summary_bullet_points", bullet_point))
+    return texts
+
+
+async def get_document_embeddings(
+    documents: list[Document], batch_size: int = EMBEDDING_BATCH_SIZE
+) -> list[Document_Embeddings]:
+    """
+    Encode the titles, summaries and bullet points of all documents together,
+    in mini-batches of batch_size sentences, and map the vectors back to their document.
+    """
+    texts = document_texts(documents)
+    if len(texts) == 0:
+        return []
+
+    vectors = await batch_pool.run(
+        model.encode, [text for _, _, text in texts], batch_size=batch_size
+    )
 
-    return results
+    return [
+        Document_Embeddings(document_id=document_id, field=field, embeddings=vector)
+        for (document_id, field, _), vector in zip(texts, vectors)
+    ]
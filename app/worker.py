@@ -0,0 +1,124 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+import app.app_logic as app_logic
+from app.models import Job
+from app.together_api_client import dispatcher
+
+
+logging.basicConfig(
+    stream=sys.stdout,
+    format="%(asctime)s - %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 4))
+WORKER_POLL_INTERVAL = float(os.environ.get("WORKER_POLL_INTERVAL", 2))
+WORKER_METRICS_INTERVAL = float(os.environ.get("WORKER_METRICS_INTERVAL", 60))
+
+stop_event = asyncio.Event()
+
+
+async def keep_job_locked(job: Job) -> None:
+    """
+    Refresh the job's lock while it runs, retries and rate limit waits can outlast JOB_LOCK_TIMEOUT.
+    Returns when the job was claimed again by another worker.
+    """
+    while True:
+        await asyncio.sleep(app_logic.JOB_HEARTBEAT_INTERVAL)
+        try:
+            if not await app_logic.heartbeat_job_async(job):
+                return
+        except Exception as e:
+            logging.error(f"Worker -> error refreshing the lock of job {job.id} {e}")
+
+
+async def process_job(job: Job) -> None:
+    """Generate the document of a job with the LLM and record the outcome on the job"""
+    try:
+        document = await app_logic.get_document_by_id_async(job.document_id)
+        if document is None:
+            await app_logic.fail_job_async(job, "Document not found")
+            return
+
+        ## extract_info_from_doc stores the failure on the document and returns None
+        document = await app_logic.extract_info_from_doc(document, job.summarization_mode)
+        if document is None:
+            await app_logic.fail_job_async(job, "Document generation failed")
+            return
+
+        if await app_logic.complete_job_async(job):
+            logging.info(f"Worker -> job {job.id} completed")
+
+    except Exception as e:
+        logging.error(f"Worker -> job {job.id} failed with error {e}")
+        await app_logic.fail_job_async(job, str(e))
+
+
+async def run_job(job: Job) -> None:
+    """Process the job while its lock is kept, and stop processing it if the lock is lost"""
+    logging.info(
+        f"Worker -> job {job.id} {job.kind} ({job.summarization_mode}) for document {job.document_id}, attempt {job.attempts}"
+    )
+    work = asyncio.create_task(process_job(job))
+    heartbeat = asyncio.create_task(keep_job_locked(job))
+    try:
+        await asyncio.wait([work, heartbeat], return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            logging.warning(f"Worker -> job {job.id} was claimed by another worker, stopping it")
+            work.cancel()
+            try:
+                await work
+            except asyncio.CancelledError:
+                pass
+    finally:
+        heartbeat.cancel()
+        work.cancel()
+
+
+async def worker_loop(number: int) -> None:
+    while not stop_event.is_set():
+        try:
+            job = await app_logic.claim_job_async()
+        except Exception as e:
+            logging.error(f"Worker {number} -> error claiming job {e}")
+            job = None
+
+        if job is None:
+            try:
+                await asyncio.wait_for(stop_event.wait(), WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        await run_job(job)
+
+
+async def log_metrics() -> None:
+    """LLM calls run in the worker, so their queue wait metrics are logged from here"""
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), WORKER_METRICS_INTERVAL)
+        except asyncio.TimeoutError:
+            logging.info(f"Worker -> LLM dispatcher {dispatcher.stats()}")
+
+
+async def main() -> None:
+    loop = asyncio.get_running_loop()
+    ## Cloud Run sends SIGTERM on scale down, let running jobs finish before exiting
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    logging.info(f"Worker started with concurrency {WORKER_CONCURRENCY}")
+    await asyncio.gather(
+        log_metrics(),
+        *[worker_loop(number) for number in range(WORKER_CONCURRENCY)],
+    )
+    logging.info("Worker stopped")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
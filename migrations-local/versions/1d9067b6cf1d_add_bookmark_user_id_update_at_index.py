@@ -0,0 +1,29 @@
+"""Add bookmark user_id, update_at, id index
+
+Revision ID: 1d9067b6cf1d
+Revises: 7a09c59166e1
+Create Date: 2026-10-18 15:40:12.204311
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = '1d9067b6cf1d'
+down_revision: Union[str, None] = '7a09c59166e1'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_bookmark_user_id_update_at_id', 'bookmark', ['user_id', sa.text('update_at DESC'), 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_bookmark_user_id_update_at_id', table_name='bookmark')
@@ -0,0 +1,37 @@
+"""Adding llm_result_cache table
+
+Revision ID: 7db9d994cda3
+Revises: b8f6886503e8
+Create Date: 2026-10-18 17:24:51.630958
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision: str = '7db9d994cda3'
+down_revision: Union[str, None] = 'b8f6886503e8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('llm_result_cache',
+    sa.Column('key', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('model_name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('prompt_version', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('result', postgresql.JSONB(astext_type=sa.Text()), nullable=False),
+    sa.Column('usage', postgresql.JSONB(astext_type=sa.Text()), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('key')
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('llm_result_cache')
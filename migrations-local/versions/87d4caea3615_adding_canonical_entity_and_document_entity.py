@@ -0,0 +1,72 @@
+"""Adding canonical_entity and document_entity
+
+Revision ID: 87d4caea3615
+Revises: 1d9067b6cf1d
+Create Date: 2026-10-18 16:02:41.518730
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = '87d4caea3615'
+down_revision: Union[str, None] = '1d9067b6cf1d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Must match normalize_entity_name and normalize_entity_type in app_logic
+NORMALIZED_NAME = "lower(regexp_replace(trim(e.name), '\\s+', ' ', 'g'))"
+NORMALIZED_TYPE = "coalesce(nullif(lower(regexp_replace(trim(e.type), '\\s+', ' ', 'g')), ''), 'unknown')"
+
+
+def upgrade() -> None:
+    op.create_table('canonical_entity',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('normalized_name', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('type', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('normalized_name', 'type')
+    )
+    op.create_table('document_entity',
+    sa.Column('document_id', sa.Integer(), nullable=False),
+    sa.Column('entity_id', sa.Integer(), nullable=False),
+    sa.Column('description', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('source', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('score', sa.Float(), nullable=True),
+    sa.PrimaryKeyConstraint('document_id', 'entity_id')
+    )
+    op.create_index(op.f('ix_document_entity_entity_id'), 'document_entity', ['entity_id'], unique=False)
+
+    # Backfill from the per-document entity table, keeping the first spelling of each entity
+    op.execute(f"""
+        INSERT INTO canonical_entity (name, normalized_name, type)
+        SELECT DISTINCT ON ({NORMALIZED_NAME}, {NORMALIZED_TYPE})
+            trim(e.name), {NORMALIZED_NAME}, {NORMALIZED_TYPE}
+        FROM entity e
+        WHERE e.name IS NOT NULL AND trim(e.name) <> ''
+        ORDER BY {NORMALIZED_NAME}, {NORMALIZED_TYPE}, e.id
+    """)
+    op.execute(f"""
+        INSERT INTO document_entity (document_id, entity_id, description, source, score)
+        SELECT DISTINCT ON (e.document_id, ce.id)
+            e.document_id, ce.id, e.description, e.source, e.score
+        FROM entity e
+        JOIN canonical_entity ce
+            ON ce.normalized_name = {NORMALIZED_NAME} AND ce.type = {NORMALIZED_TYPE}
+        WHERE e.document_id IS NOT NULL
+        ORDER BY e.document_id, ce.id, e.id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_document_entity_entity_id'), table_name='document_entity')
+    op.drop_table('document_entity')
+    op.drop_table('canonical_entity')
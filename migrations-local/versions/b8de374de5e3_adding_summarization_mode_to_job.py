@@ -0,0 +1,29 @@
+"""Adding summarization_mode to job
+
+Revision ID: b8de374de5e3
+Revises: 7db9d994cda3
+Create Date: 2026-10-18 18:02:17.419386
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8de374de5e3'
+down_revision: Union[str, None] = '7db9d994cda3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('job', sa.Column('summarization_mode', sqlmodel.sql.sqltypes.AutoString(), server_default='single', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('job', 'summarization_mode')
@@ -0,0 +1,50 @@
+"""Adding job table
+
+Revision ID: b8f6886503e8
+Revises: c1fbe041c7a9
+Create Date: 2026-10-18 16:58:23.117402
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b8f6886503e8'
+down_revision: Union[str, None] = 'c1fbe041c7a9'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('job',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('document_id', sa.Integer(), nullable=False),
+    sa.Column('status', sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('max_attempts', sa.Integer(), nullable=False),
+    sa.Column('last_error', sqlmodel.sql.sqltypes.AutoString(), nullable=True),
+    sa.Column('run_after', sa.DateTime(), nullable=False),
+    sa.Column('locked_at', sa.DateTime(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('update_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_job_document_id'), 'job', ['document_id'], unique=False)
+    # Claiming only looks at Pending and Running jobs, keep finished ones out of the index
+    op.create_index('ix_job_claim', 'job', ['status', 'run_after', 'id'], unique=False, postgresql_where=sa.text("status IN ('Pending', 'Running')"))
+    # At most one pending or running job per document, concurrent enqueues insert one job
+    op.create_index('ix_job_active_document_id', 'job', ['document_id'], unique=True, postgresql_where=sa.text("status IN ('Pending', 'Running')"))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_job_active_document_id', table_name='job')
+    op.drop_index('ix_job_claim', table_name='job')
+    op.drop_index(op.f('ix_job_document_id'), table_name='job')
+    op.drop_table('job')
@@ -0,0 +1,48 @@
+"""Adding HNSW index to document_embeddings
+
+Revision ID: c1fbe041c7a9
+Revises: 87d4caea3615
+Create Date: 2026-10-18 16:31:07.842215
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+import pgvector
+from pgvector.sqlalchemy import Vector
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c1fbe041c7a9'
+down_revision: Union[str, None] = '87d4caea3615'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # HNSW needs pgvector 0.5.0 or newer, the extension is upgraded by the DBA, not here
+    version = op.get_bind().execute(
+        sa.text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")
+    ).scalar()
+    if version is None or tuple(int(part) for part in version.split(".")[:2]) < (0, 5):
+        raise RuntimeError(
+            f"HNSW indexes need pgvector 0.5.0 or newer, found {version}. "
+            "Run ALTER EXTENSION vector UPDATE first."
+        )
+    op.create_index(
+        'ix_document_embeddings_embeddings_hnsw',
+        'document_embeddings',
+        ['embeddings'],
+        unique=False,
+        postgresql_using='hnsw',
+        postgresql_with={'m': 16, 'ef_construction': 64},
+        postgresql_ops={'embeddings': 'vector_cosine_ops'},
+    )
+    op.create_index(op.f('ix_document_embeddings_document_id'), 'document_embeddings', ['document_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_document_embeddings_document_id'), table_name='document_embeddings')
+    op.drop_index('ix_document_embeddings_embeddings_hnsw', table_name='document_embeddings')
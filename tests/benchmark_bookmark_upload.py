@@ -0,0 +1,84 @@
+import sys
+import json
+import gzip
+import time
+import asyncio
+from app import html_parser
+from app.models import PagePayload
+
+""" Measure what the extension uploads for a bookmark and the server time before parsing is done:
+- JSON /bookmark payload as sent today, and gzip compressed
+- server side: gzip decompress + JSON decode + PagePayload validation + parse, against
+  /bookmark/html where the raw HTML body is read in 64 KB chunks (fed to the parser as they
+  arrive with HTML_PARSER_BACKEND=lxml)
+Uses an HTML file, or a synthetic page of `paragraphs` paragraphs.
+
+    python tests/benchmark_bookmark_upload.py [paragraphs] [html file]
+"""
+
+paragraphs = 20000
+file_name = None
+chunk_size = 64 * 1024
+url = "https://example.com/benchmark/article"
+
+
+def synthetic_page(number_of_paragraphs: int) -> str:
+    body = "".join(
+        f"<p class=\"text\">Paragraph {index} of the article, with <a href=\"/link/{index}\">a link</a> "
+        f"and enough words to be kept by the parser.</p>\n"
+        for index in range(number_of_paragraphs)
+    )
+    return f"<html><body><article><h1>Benchmark title</h1>{body}</article></body></html>"
+
+
+def timed(fn, runs: int = 5) -> float:
+    timings = []
+    for _ in range(runs):
+        html_parser.page_cache.clear()
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return sorted(timings)[len(timings) // 2]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        paragraphs = int(args[0])
+    if len(args) > 1:
+        file_name = args[1]
+
+    if file_name:
+        with open(file_name, encoding="utf-8", errors="replace") as file:
+            html = file.read()
+    else:
+        html = synthetic_page(paragraphs)
+
+    json_body = json.dumps({"url": url, "html": html, "user_id": "benchmark"}).encode()
+    raw_body = html.encode()
+    sizes = {
+        "JSON": len(json_body),
+        "JSON gzip": len(gzip.compress(json_body, 6)),
+        "raw HTML": len(raw_body),
+        "raw HTML gzip": len(gzip.compress(raw_body, 6)),
+    }
+
+    print(f"HTML: {len(raw_body) // 1024} KB")
+    for name, size in sizes.items():
+        print(f"{name}: {size // 1024} KB ({size / len(json_body):.0%} of JSON)")
+
+    gzipped_json = gzip.compress(json_body, 6)
+
+    def json_path():
+        payload = PagePayload.model_validate_json(gzip.decompress(gzipped_json))
+        asyncio.run(html_parser.create_page_async(payload))
+
+    def raw_path():
+        async def chunks():
+            for start in range(0, len(raw_body), chunk_size):
+                yield raw_body[start : start + chunk_size]
+
+        asyncio.run(html_parser.create_page_from_stream(url, chunks(), "utf-8"))
+
+    print(f"gzip JSON decode + validate + parse: {timed(json_path) * 1000:.1f} ms")
+    print(f"raw HTML streamed into the parser: {timed(raw_path) * 1000:.1f} ms")
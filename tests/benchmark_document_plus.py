@@ -0,0 +1,58 @@
+import sys
+import time
+import asyncio
+import aiohttp
+
+""" Measure requests/sec on /document_plus/{bookmark_id} with concurrent clients.
+Run it against a local API backed by the docker-compose Postgres, once on the
+commit before the async database layer and once after, and compare the output.
+
+    python tests/benchmark_document_plus.py [base_url] [bookmark_id] [clients] [requests_per_client]
+"""
+
+
+base_url = "http://127.0.0.1:8889"
+bookmark_id = 55
+clients = 50
+requests_per_client = 20
+
+
+async def client(session, url, latencies):
+    for _ in range(requests_per_client):
+        start_time = time.perf_counter()
+        async with session.get(url) as response:
+            await response.read()
+        latencies.append(time.perf_counter() - start_time)
+
+
+async def run(url):
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=clients)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        start_time = time.perf_counter()
+        await asyncio.gather(
+            *[client(session, url, latencies) for _ in range(clients)]
+        )
+        elapsed_time = time.perf_counter() - start_time
+
+    latencies.sort()
+    print(f"URL: {url}")
+    print(f"Clients: {clients}. Requests: {len(latencies)}")
+    print(f"Elapsed time: {elapsed_time:.2f} seconds")
+    print(f"Requests/sec: {len(latencies) / elapsed_time:.1f}")
+    print(f"Latency p50: {latencies[len(latencies) // 2] * 1000:.1f} ms")
+    print(f"Latency p95: {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        base_url = args[0]
+    if len(args) > 1:
+        bookmark_id = int(args[1])
+    if len(args) > 2:
+        clients = int(args[2])
+    if len(args) > 3:
+        requests_per_client = int(args[3])
+
+    asyncio.run(run(f"{base_url}/document_plus/{bookmark_id}"))
@@ -0,0 +1,57 @@
+import sys
+import time
+import random
+from app.models import Document
+from app.transformers_util import model, document_texts
+
+""" Compare sentences/sec of encoding document texts one sentence at a time
+against batched encoding, on CPU.
+
+    python tests/benchmark_embeddings.py [documents] [batch_size]
+"""
+
+documents = 200
+batch_size = 64
+words = (
+    "the market game launch season league player company product growth city "
+    "research energy policy election science model data team report quarter"
+).split()
+
+
+def sentence(length: int) -> str:
+    return " ".join(random.choice(words) for _ in range(length)).capitalize() + "."
+
+
+def synthetic_documents(number_of_documents: int) -> list[Document]:
+    return [
+        Document(
+            id=index,
+            title=sentence(8),
+            short_summary=sentence(20),
+            summary_bullet_points=[sentence(15) for _ in range(6)],
+        )
+        for index in range(number_of_documents)
+    ]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        documents = int(args[0])
+    if len(args) > 1:
+        batch_size = int(args[1])
+
+    texts = [text for _, _, text in document_texts(synthetic_documents(documents))]
+
+    start_time = time.perf_counter()
+    for text in texts:
+        model.encode(text, device="cpu")
+    single_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    model.encode(texts, batch_size=batch_size, device="cpu")
+    batch_time = time.perf_counter() - start_time
+
+    print(f"Documents: {documents}. Sentences: {len(texts)}. Batch size: {batch_size}")
+    print(f"One at a time: {len(texts) / single_time:.1f} sentences/sec")
+    print(f"Batched: {len(texts) / batch_time:.1f} sentences/sec")
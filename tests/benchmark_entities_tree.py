@@ -0,0 +1,102 @@
+import sys
+import time
+import random
+import app.app_logic as app_logic
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+from app.models import Bookmark, Document, CanonicalEntity, DocumentEntity
+
+""" Time /entities_tree for a synthetic user against the local Postgres.
+Seeds a user with `entities` document-entity links spread over `documents` documents, times the
+tree query and the in-memory assembly separately, then deletes the user's records.
+
+    python tests/benchmark_entities_tree.py [entities] [documents]
+"""
+
+user_id = "benchmark-entities-tree"
+entities = 10000
+documents = 1000
+types = ["person", "company", "location", "product", "topic", "industry", "event"]
+
+
+def seed(number_of_entities: int, number_of_documents: int) -> None:
+    with Session(app_logic.engine) as session:
+        canonical_entities = [
+            CanonicalEntity(
+                name=f"{user_id} {index}",
+                normalized_name=f"{user_id} {index}",
+                type=random.choice(types),
+            )
+            for index in range(number_of_entities // 4)
+        ]
+        session.add_all(canonical_entities)
+
+        docs = [
+            Document(title=f"Document {index}", url=f"https://example.com/{user_id}/{index}")
+            for index in range(number_of_documents)
+        ]
+        session.add_all(docs)
+        session.flush()
+
+        session.add_all(
+            [
+                Bookmark(url=doc.url, document_id=doc.id, user_id=user_id)
+                for doc in docs
+            ]
+        )
+
+        links = set()
+        while len(links) < number_of_entities:
+            links.add(
+                (
+                    random.choice(docs).id,
+                    random.choice(canonical_entities).id,
+                )
+            )
+        session.add_all(
+            [
+                DocumentEntity(document_id=document_id, entity_id=entity_id)
+                for document_id, entity_id in links
+            ]
+        )
+        session.commit()
+
+
+def cleanup() -> None:
+    app_logic.delete_all_of_users_records(user_id)
+    with Session(app_logic.engine) as session:
+        session.execute(
+            delete(CanonicalEntity).where(CanonicalEntity.name.startswith(user_id))
+        )
+        session.commit()
+
+
+def run() -> None:
+    start_time = time.perf_counter()
+    with Session(app_logic.engine) as session:
+        rows = session.execute(app_logic.entities_tree_query(user_id)).all()
+    query_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    tree = app_logic.build_entities_tree(rows)
+    build_time = time.perf_counter() - start_time
+
+    print(f"Entity links: {entities}. Documents: {documents}. Rows: {len(rows)}")
+    print(f"Types: {len(tree)}. Entity nodes: {sum(len(node['children']) for node in tree)}")
+    print(f"Query time: {query_time * 1000:.1f} ms")
+    print(f"Tree build time: {build_time * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        entities = int(args[0])
+    if len(args) > 1:
+        documents = int(args[1])
+
+    cleanup()
+    seed(entities, documents)
+    try:
+        run()
+    finally:
+        cleanup()
@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+from app import html_parser
+from app.models import PagePayload
+
+""" Compare the BeautifulSoup html.parser path of create_page against the lxml single walk.
+Parses every .html file of a directory of saved pages (e.g. saved from the browser with
+"Save Page As... HTML only") `runs` times with each backend, prints the median time per page
+and whether both backends extracted the same title, author and paragraphs.
+
+    python tests/benchmark_html_parser.py <pages directory> [runs]
+"""
+
+runs = 3
+
+
+def parse(html: str, backend: str) -> tuple[object, float]:
+    html_parser.HTML_PARSER_BACKEND = backend
+    payload = PagePayload(url="https://example.com/benchmark", html=html)
+    timings = []
+    page = None
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        try:
+            page = html_parser.create_page(payload)
+        except Exception as e:
+            page = repr(e)
+        timings.append(time.perf_counter() - start_time)
+    return page, sorted(timings)[len(timings) // 2]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) == 0:
+        print(__doc__)
+        sys.exit(1)
+    directory = args[0]
+    if len(args) > 1:
+        runs = int(args[1])
+
+    totals = {"bs4": 0.0, "lxml": 0.0}
+    same = 0
+    files = sorted(name for name in os.listdir(directory) if name.endswith(".html"))
+    for name in files:
+        with open(os.path.join(directory, name), encoding="utf-8", errors="replace") as file:
+            html = file.read()
+
+        bs4_page, bs4_time = parse(html, "bs4")
+        lxml_page, lxml_time = parse(html, "lxml")
+        totals["bs4"] += bs4_time
+        totals["lxml"] += lxml_time
+        same += bs4_page == lxml_page
+        print(
+            f"{name}: {len(html) // 1024} KB, bs4 {bs4_time * 1000:.1f} ms, "
+            f"lxml {lxml_time * 1000:.1f} ms, same text {bs4_page == lxml_page}"
+        )
+
+    print(f"Pages: {len(files)}. Same text: {same}")
+    print(f"Total bs4 {totals['bs4']:.2f} s, lxml {totals['lxml']:.2f} s")
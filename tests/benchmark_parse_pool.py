@@ -0,0 +1,77 @@
+import sys
+import time
+import asyncio
+from app import html_parser
+from app.models import PagePayload
+
+""" Load test of page parsing for bookmarks: `concurrency` bookmarks at a time through
+html_parser.create_page_async, with the parser pool at each worker count (0 parses in the
+event loop's process). Prints pages per second, which should grow with the workers up to
+the number of cores. Pages are synthetic articles of `paragraphs` paragraphs, each different
+so page_cache doesn't answer them.
+
+    PYTHONPATH=. python tests/benchmark_parse_pool.py [pages] [paragraphs] [workers,...]
+"""
+
+pages = 200
+paragraphs = 400
+worker_counts = [0, 1, 2, 4]
+concurrency = 32
+
+
+def make_page(number: int) -> str:
+    body = "".join(
+        f"<p>Paragraph {i} of page {number} has enough words to be kept by the parser.</p>"
+        f"<div class='ad'><span>ad {i}</span></div>"
+        for i in range(paragraphs)
+    )
+    return (
+        f"<html><head><title>Page {number}</title></head><body>"
+        f"<div class='nav'><a href='/'>home</a></div>"
+        f"<article><h1>Page {number}</h1>{body}</article></body></html>"
+    )
+
+
+async def run(payloads: list[PagePayload]) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bookmark(payload: PagePayload):
+        async with semaphore:
+            return await html_parser.create_page_async(payload)
+
+    start_time = time.perf_counter()
+    results = await asyncio.gather(*[bookmark(payload) for payload in payloads])
+    elapsed = time.perf_counter() - start_time
+    assert all(page is not None for page in results)
+    return elapsed
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        pages = int(args[0])
+    if len(args) > 1:
+        paragraphs = int(args[1])
+    if len(args) > 2:
+        worker_counts = [int(workers) for workers in args[2].split(",")]
+
+    html = [make_page(number) for number in range(pages)]
+    print(f"{pages} pages of {len(html[0]) // 1024} KB")
+
+    for workers in worker_counts:
+        html_parser.parser_pool.shutdown()
+        html_parser.parser_pool = html_parser.ParserPool(workers, max_pending=pages)
+        html_parser.page_cache.clear()
+        ## Start the workers before timing, spawning them is a one-off cost
+        if workers > 0:
+            asyncio.run(html_parser.parse_page_async("https://example.com/0", html[0]))
+            html_parser.page_cache.clear()
+
+        payloads = [
+            PagePayload(url=f"https://example.com/{number}", html=page_html)
+            for number, page_html in enumerate(html)
+        ]
+        elapsed = asyncio.run(run(payloads))
+        print(f"workers {workers}: {elapsed:.2f} s, {pages / elapsed:.1f} pages/s")
+
+    html_parser.parser_pool.shutdown()
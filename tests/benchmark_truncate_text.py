@@ -0,0 +1,94 @@
+import sys
+import time
+import random
+from collections import Counter
+from sumy.parsers.plaintext import PlaintextParser
+from sumy.nlp.tokenizers import Tokenizer
+from sumy.summarizers.lsa import LsaSummarizer
+from app.icog_util import truncate_text, WORD
+
+""" Compare the runtime of truncate_text against the sumy LSA summarizer it replaced, and how much
+the two summaries overlap (ROUGE-1 and ROUGE-2 F1). Uses the text of a file, or random sentences
+built from a Zipf-like vocabulary. Tokens are estimated as 4 characters each.
+The LSA path needs the nltk punkt data: python -m nltk.downloader punkt
+
+    python tests/benchmark_truncate_text.py [words] [budget_tokens] [file]
+"""
+
+words = 20000
+budget_tokens = 4000
+file_name = None
+
+
+def synthetic_text(number_of_words: int) -> str:
+    vocabulary = [f"term{index}" for index in range(number_of_words // 5 + 1)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    sentences = []
+    total = 0
+    while total < number_of_words:
+        length = random.randint(8, 30)
+        sentence = random.choices(vocabulary, weights, k=length)
+        sentences.append(" ".join(sentence).capitalize() + ".")
+        total += length
+    return " ".join(sentences)
+
+
+def lsa_truncate_text(text: str, llm_max_tokens: int, number_of_tokens: int) -> str:
+    """The previous truncate_text"""
+    parser = PlaintextParser.from_string(text, Tokenizer("english"))
+    num_sentences = len(parser.document.sentences)
+    avg_tokens_per_sentence = max(1, int(number_of_tokens / num_sentences))
+    excess_tokens = number_of_tokens - llm_max_tokens
+    num_sentences_to_summarize = num_sentences - -(-excess_tokens // avg_tokens_per_sentence)
+    summary = LsaSummarizer()(parser.document, num_sentences_to_summarize)
+    return " ".join([sentence._text for sentence in summary])
+
+
+def ngrams(text: str, n: int) -> Counter:
+    tokens = WORD.findall(text.lower())
+    return Counter(zip(*[tokens[index:] for index in range(n)]))
+
+
+def rouge(candidate: str, reference: str, n: int) -> float:
+    candidate_ngrams = ngrams(candidate, n)
+    reference_ngrams = ngrams(reference, n)
+    overlap = sum((candidate_ngrams & reference_ngrams).values())
+    if overlap == 0:
+        return 0.0
+    precision = overlap / sum(candidate_ngrams.values())
+    recall = overlap / sum(reference_ngrams.values())
+    return 2 * precision * recall / (precision + recall)
+
+
+def timed(fn, *args) -> tuple[str, float]:
+    start_time = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        words = int(args[0])
+    if len(args) > 1:
+        budget_tokens = int(args[1])
+    if len(args) > 2:
+        file_name = args[2]
+
+    if file_name:
+        with open(file_name) as file:
+            text = file.read()
+    else:
+        text = synthetic_text(words)
+    number_of_tokens = len(text) // 4
+
+    print(f"Words: {len(text.split())}. Tokens: {number_of_tokens}. Budget: {budget_tokens}")
+    summary, seconds = timed(truncate_text, text, budget_tokens, number_of_tokens)
+    print(f"TF-IDF centroid: {seconds * 1000:.1f} ms, {len(summary) // 4} tokens")
+
+    lsa_summary, lsa_seconds = timed(lsa_truncate_text, text, budget_tokens, number_of_tokens)
+    print(f"LSA: {lsa_seconds * 1000:.1f} ms, {len(lsa_summary) // 4} tokens")
+
+    print(f"ROUGE-1 F1 vs LSA: {rouge(summary, lsa_summary, 1):.3f}")
+    print(f"ROUGE-2 F1 vs LSA: {rouge(summary, lsa_summary, 2):.3f}")
+    print(f"ROUGE-1 F1 vs full text: TF-IDF {rouge(summary, text, 1):.3f}, LSA {rouge(lsa_summary, text, 1):.3f}")
@@ -0,0 +1,119 @@
+import sys
+import time
+import random
+import app.app_logic as app_logic
+import app.embedding_search as embedding_search
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+""" Compare the grouped full scan search query against the HNSW nearest neighbour query
+on the local pgvector container. Seeds `rows` random embeddings for a synthetic user
+(8 per document), runs each query `runs` times with random vectors, then deletes the rows.
+Run `alembic upgrade head` first so the HNSW index exists.
+
+    python tests/benchmark_vector_search.py [rows] [runs] [top_k]
+"""
+
+user_id = "benchmark-vector-search"
+rows = 1000000
+runs = 20
+top_k = 10
+embeddings_per_document = 8
+document_id_offset = 1000000000
+
+FULL_SCAN_QUERY = text(
+    """SELECT a.document_id, a.cosine_similarity
+    FROM (SELECT de.document_id, MIN(1 - (de.embeddings <=> :vector)) AS cosine_similarity
+        FROM document_embeddings AS de
+        JOIN bookmark ON de.document_id = bookmark.document_id
+        WHERE bookmark.user_id = :user_id
+        GROUP BY de.document_id) a
+    WHERE a.cosine_similarity > 0.05
+    ORDER BY a.cosine_similarity DESC"""
+)
+
+
+def seed(number_of_rows: int) -> None:
+    number_of_documents = number_of_rows // embeddings_per_document
+    with Session(app_logic.engine) as session:
+        session.execute(
+            text(
+                """INSERT INTO bookmark (url, update_at, document_id, user_id, cloned_documents)
+                SELECT 'https://example.com/' || g, now(), :offset + g, :user_id, '{}'
+                FROM generate_series(1, :documents) g"""
+            ),
+            {"offset": document_id_offset, "user_id": user_id, "documents": number_of_documents},
+        )
+        session.execute(
+            text(
+                """INSERT INTO document_embeddings (document_id, field, embeddings)
+                SELECT :offset + 1 + g % :documents, 'benchmark',
+                    (SELECT array_agg(random() - 0.5 + g * 0) FROM generate_series(1, 384))::vector
+                FROM generate_series(1, :rows) g"""
+            ),
+            {"offset": document_id_offset, "documents": number_of_documents, "rows": number_of_rows},
+        )
+        session.commit()
+        session.execute(text("ANALYZE document_embeddings"))
+        session.commit()
+
+
+def cleanup() -> None:
+    with Session(app_logic.engine) as session:
+        session.execute(
+            text("DELETE FROM document_embeddings WHERE document_id > :offset"),
+            {"offset": document_id_offset},
+        )
+        session.execute(text("DELETE FROM bookmark WHERE user_id = :user_id"), {"user_id": user_id})
+        session.commit()
+
+
+def time_query(stmt, params: dict, set_ef_search: bool = False) -> list[float]:
+    timings = []
+    for _ in range(runs):
+        vector = str([random.random() - 0.5 for _ in range(384)])
+        with Session(app_logic.engine) as session:
+            if set_ef_search:
+                session.execute(
+                    text(f"SET LOCAL hnsw.ef_search = {embedding_search.SEARCH_HNSW_EF_SEARCH}")
+                )
+            start_time = time.perf_counter()
+            session.execute(stmt, {"vector": vector, "user_id": user_id, **params}).all()
+            timings.append(time.perf_counter() - start_time)
+    return sorted(timings)
+
+
+def report(name: str, timings: list[float]) -> None:
+    print(
+        f"{name}: p50 {timings[len(timings) // 2] * 1000:.1f} ms, "
+        f"p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if len(args) > 0:
+        rows = int(args[0])
+    if len(args) > 1:
+        runs = int(args[1])
+    if len(args) > 2:
+        top_k = int(args[2])
+
+    cleanup()
+    seed(rows)
+    try:
+        print(f"Rows: {rows}. Runs: {runs}. top_k: {top_k}")
+        report("Full scan", time_query(FULL_SCAN_QUERY, {}))
+        report(
+            "HNSW",
+            time_query(
+                embedding_search.SEARCH_EMBEDDINGS_QUERY,
+                {
+                    "candidates": top_k * embedding_search.SEARCH_CANDIDATES_PER_RESULT,
+                    "top_k": top_k,
+                },
+                set_ef_search=True,
+            ),
+        )
+    finally:
+        cleanup()
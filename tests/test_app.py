@@ -1,5 +1,8 @@
 import app.app_logic as app_logic
+import asyncio
 import time
+from sqlalchemy import event
+from app.models import Page
 
 url = "https://www.yahoo.com/finance/news/collecting-degrees-thermometer-atlanta-woman-110000419.html"
 
@@ -55,3 +58,84 @@ def test_get_entities_by_document_id():
     assert len(entities) > 0
     assert entities[0].document_id == doc.id
     assert type(entities) == list
+
+
+def test_documents_plus_query_count_is_constant():
+    user_id = "test-documents-plus-query-count"
+    app_logic.delete_all_of_users_records(user_id)
+
+    statements = []
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    async def count_queries() -> list[int]:
+        # Warm up the pool so connection setup isn't counted
+        await app_logic.get_documents_plus_by_user_id_async(user_id)
+
+        query_counts = []
+        for number_of_bookmarks in [1, 5, 20]:
+            for index in range(number_of_bookmarks):
+                page = Page(
+                    clean_url=f"https://example.com/{user_id}/{index}",
+                    title=f"Document {index}",
+                    full_text="Document text",
+                )
+                app_logic.create_bookmark(page, user_id)
+
+            statements.clear()
+            documents, _ = await app_logic.get_documents_plus_by_user_id_async(user_id)
+            assert len(documents) == number_of_bookmarks
+            query_counts.append(len(statements))
+
+        # Connections are bound to this event loop, don't leave them in the pool
+        await app_logic.async_engine.dispose()
+        return query_counts
+
+    sync_engine = app_logic.async_engine.sync_engine
+    event.listen(sync_engine, "before_cursor_execute", count_statement)
+    try:
+        query_counts = asyncio.run(count_queries())
+    finally:
+        event.remove(sync_engine, "before_cursor_execute", count_statement)
+        app_logic.delete_all_of_users_records(user_id)
+
+    assert len(set(query_counts)) == 1
+
+
+def test_documents_plus_pagination():
+    user_id = "test-documents-plus-pagination"
+    app_logic.delete_all_of_users_records(user_id)
+
+    for index in range(5):
+        page = Page(
+            clean_url=f"https://example.com/{user_id}/{index}",
+            title=f"Document {index}",
+            full_text="Document text",
+        )
+        app_logic.create_bookmark(page, user_id)
+
+    async def load_pages() -> tuple[list, list]:
+        all_documents, _ = await app_logic.get_documents_plus_by_user_id_async(user_id)
+
+        documents, cursor = await app_logic.get_documents_plus_by_user_id_async(
+            user_id, limit=2
+        )
+        while cursor:
+            page, cursor = await app_logic.get_documents_plus_by_user_id_async(
+                user_id, limit=2, cursor=cursor
+            )
+            documents.extend(page)
+
+        # Connections are bound to this event loop, don't leave them in the pool
+        await app_logic.async_engine.dispose()
+        return documents, all_documents
+
+    try:
+        documents, all_documents = asyncio.run(load_pages())
+    finally:
+        app_logic.delete_all_of_users_records(user_id)
+
+    assert [document.id for document in documents] == [
+        document.id for document in all_documents
+    ]
@@ -0,0 +1,47 @@
+import asyncio
+import httpx
+import pytest
+from concurrent.futures.process import BrokenProcessPool
+import app.app_logic as app_logic
+import app.main as main
+from app.html_parser import ParserQueueFull
+
+""" Runs the bookmark endpoints with app_logic's parsing replaced, no database needed """
+
+
+def post(path: str, **kwargs) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post(path, **kwargs)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize(
+    "error", [ParserQueueFull("HTML parser queue is full"), BrokenProcessPool("worker died")]
+)
+def test_busy_or_broken_parser_is_a_service_unavailable(monkeypatch, error):
+    async def get_existing_bookmark(url, user_id):
+        return None
+
+    async def create_page_async(payload):
+        raise error
+
+    async def create_page_from_stream(url, chunks, encoding):
+        raise error
+
+    monkeypatch.setattr(main, "get_existing_bookmark", get_existing_bookmark)
+    monkeypatch.setattr(app_logic, "create_page_async", create_page_async)
+    monkeypatch.setattr(app_logic, "create_page_from_stream", create_page_from_stream)
+
+    response = post("/bookmark", json={"url": "https://example.com/a", "html": "<p>a</p>"})
+    assert response.status_code == 503
+
+    response = post(
+        "/bookmark/html",
+        params={"url": "https://example.com/a"},
+        content=b"<p>a</p>",
+        headers={"Content-Type": "text/html"},
+    )
+    assert response.status_code == 503
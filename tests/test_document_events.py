@@ -0,0 +1,29 @@
+import asyncio
+from app.document_events import (
+    DocumentStatusListener,
+    DOCUMENT_STATUS_CHANNEL,
+    notify_params,
+)
+
+
+def test_notifications_reach_the_streams_of_the_document():
+    async def run():
+        listener = DocumentStatusListener(engine=None)
+        queue = listener.subscribe(1)
+        other_queue = listener.subscribe(2)
+
+        params = notify_params(1, "Done")
+        listener._on_notification(None, 0, params["channel"], params["payload"])
+        listener._on_notification(None, 0, DOCUMENT_STATUS_CHANNEL, "not json")
+
+        assert queue.get_nowait() == {"document_id": 1, "status": "Done"}
+        assert queue.empty()
+        assert other_queue.empty()
+        assert listener.stats()["streams"] == 2
+
+        listener.unsubscribe(1, queue)
+        listener.unsubscribe(2, other_queue)
+        assert listener.stats()["documents"] == 0
+        assert listener.stats()["notifications"] == 2
+
+    asyncio.run(run())
@@ -0,0 +1,53 @@
+import asyncio
+from app.embedding_search import (
+    EXACT_SEARCH_EMBEDDINGS_QUERY,
+    SEARCH_EMBEDDINGS_QUERY,
+    find_nearest_documents,
+)
+
+
+class Result:
+    def __init__(self, rows: list) -> None:
+        self.rows = rows
+
+    def all(self) -> list:
+        return self.rows
+
+
+class FakeSession:
+    """Answers the HNSW and exact search queries with fixed rows and records the statements"""
+
+    def __init__(self, hnsw_rows: list, exact_rows: list) -> None:
+        self.rows = {SEARCH_EMBEDDINGS_QUERY: hnsw_rows, EXACT_SEARCH_EMBEDDINGS_QUERY: exact_rows}
+        self.statements = []
+
+    async def execute(self, statement, params=None):
+        self.statements.append((statement, params))
+        return Result(self.rows.get(statement, []))
+
+
+def test_hnsw_results_are_used_when_there_are_enough():
+    session = FakeSession([(1, 0.9), (2, 0.8)], [(3, 0.99)])
+    matches = asyncio.run(find_nearest_documents(session, "[0.1]", "user", top_k=2))
+
+    assert matches == [(1, 0.9), (2, 0.8)]
+    assert EXACT_SEARCH_EMBEDDINGS_QUERY not in [statement for statement, _ in session.statements]
+
+
+def test_user_with_few_embeddings_falls_back_to_exact_scan():
+    ## The index walk hit other users' embeddings first and only one row of the user was left
+    session = FakeSession([(1, 0.9)], [(1, 0.9), (2, 0.5), (3, 0.2)])
+    matches = asyncio.run(find_nearest_documents(session, "[0.1]", "user", top_k=3))
+
+    assert matches == [(1, 0.9), (2, 0.5), (3, 0.2)]
+    statement, params = session.statements[-1]
+    assert statement is EXACT_SEARCH_EMBEDDINGS_QUERY
+    assert params == {"vector": "[0.1]", "user_id": "user", "top_k": 3}
+
+
+def test_ef_search_covers_the_candidates():
+    session = FakeSession([], [])
+    asyncio.run(find_nearest_documents(session, "[0.1]", "user", top_k=50))
+
+    assert str(session.statements[0][0]) == "SET LOCAL hnsw.ef_search = 400"
+    assert session.statements[1][1]["candidates"] == 400
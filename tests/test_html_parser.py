@@ -1,4 +1,7 @@
+import asyncio
+import pytest
 from app import html_parser
+from app.models import PagePayload
 
 url = "https://www.yahoo.com/finance/news/collecting-degrees-thermometer-atlanta-woman-110000419.html"
 
@@ -8,3 +11,140 @@ def test_create_page():
     assert type(page.full_text) == str
     assert len(page.full_text) > 0
     # assert len(page.author) > 1
+
+
+PAGE = """<html><body>
+<div class="nav"><p>menu item one two three four five six seven eight nine</p></div>
+<div class="article" id="article"><span data-testid="authorName">Jane Doe</span>
+<h1>The Main Title</h1><h2>A sub heading with words</h2><!-- comment -->
+<p>The first paragraph has &amp; entities and <b>bold</b> text in it, more words.</p>
+<p>The second paragraph is long enough to be kept by the parser as well.</p>
+<p>Too short to keep.</p>
+</div>
+<div class="article"><p>short</p></div>
+</body></html>"""
+
+
+def test_lxml_and_bs4_backends_extract_the_same_page():
+    payload = PagePayload(url="https://example.com/article?utm=1", html=PAGE)
+    pages = {}
+    for backend in ["bs4", "lxml"]:
+        html_parser.HTML_PARSER_BACKEND = backend
+        pages[backend] = html_parser.create_page(payload)
+    html_parser.HTML_PARSER_BACKEND = "bs4"
+
+    assert pages["lxml"] == pages["bs4"]
+    assert pages["lxml"].title == "The Main Title"
+    assert pages["lxml"].author == "Jane Doe"
+    assert pages["lxml"].paragraphs[0] == "A sub heading with words"
+    assert len(pages["lxml"].paragraphs) == 3
+
+
+MALFORMED = [
+    ## bs4 keeps the div inside the p, lxml's own parser would close the p before it
+    "<p>The paragraph starts here <div>with a block inside it</div> and goes on after it.</p>",
+    "<p>An outer paragraph with enough words <p>and a nested one with enough words</p> left.</p>",
+    "<p>A paragraph that is never closed with enough words<h2>Then a heading with words",
+    "<h2>An unclosed heading with enough words<p>and its paragraph, also left open, words",
+    "<p>Stray end tags are ignored </div></span> in this paragraph with words</p></p>",
+    "<p>A break<br>and an image <img src=x> in a paragraph</br></img> with words in it</p>",
+    "<table><tr><td><p>A paragraph in a cell that is never closed with words<td>next</table>",
+    "<p>Entities &amp; &copy &#150; &nosuch; and <script>var x = '<p>';</script> script words</p>",
+    "<p>Whitespace   between <b>tags</b>   <i>is kept</i> \n <!-- c --> like bs4 does it</p>",
+]
+
+
+@pytest.mark.parametrize("markup", MALFORMED)
+def test_backends_agree_on_malformed_markup(markup):
+    html = (
+        "<html><body><div class=article><h1>The title of the page</h1>"
+        f"<p>A first paragraph long enough to be kept by the parser.</p>{markup}</div>"
+    )
+    payload = PagePayload(url="https://example.com/article", html=html)
+    pages = {}
+    for backend in ["bs4", "lxml"]:
+        html_parser.HTML_PARSER_BACKEND = backend
+        pages[backend] = html_parser.create_page(payload)
+    html_parser.HTML_PARSER_BACKEND = "bs4"
+
+    assert pages["lxml"] == pages["bs4"]
+    assert len(pages["lxml"].paragraphs) > 1
+
+
+def test_page_without_article_element():
+    payload = PagePayload(url="https://example.com/a", html="<html><p>text</p></html>")
+    assert html_parser.create_page(payload) is None
+
+
+def test_same_page_is_parsed_once():
+    html_parser.page_cache.clear()
+    payload = PagePayload(url="https://example.com/article?utm=1", html=PAGE)
+    page = asyncio.run(html_parser.create_page_async(payload))
+    same_page = asyncio.run(
+        html_parser.create_page_async(
+            PagePayload(url="https://example.com/article?utm=2", html=PAGE)
+        )
+    )
+    changed_page = asyncio.run(
+        html_parser.create_page_async(
+            PagePayload(url="https://example.com/article", html=PAGE.replace("Main", "New"))
+        )
+    )
+
+    assert same_page is page
+    assert changed_page.title == "The New Title"
+    assert html_parser.page_cache.stats()["hits"] == 1
+
+
+def test_streamed_html_gives_the_same_page():
+    html_parser.page_cache.clear()
+    body = PAGE.encode()
+
+    async def chunks():
+        for start in range(0, len(body), 100):
+            yield body[start : start + 100]
+
+    page = asyncio.run(
+        html_parser.create_page_from_stream("https://example.com/article", chunks(), "utf-8")
+    )
+    html_parser.page_cache.clear()
+    expected = html_parser.create_page(
+        PagePayload(url="https://example.com/article", html=PAGE)
+    )
+    assert page == expected
+
+
+def test_parser_pool_gives_the_same_page():
+    pool = html_parser.ParserPool(workers=2, max_pending=8)
+    try:
+        page = asyncio.run(pool.parse("https://example.com/article", PAGE.encode(), "utf-8"))
+    finally:
+        pool.shutdown()
+
+    expected = html_parser.parse_page("https://example.com/article", PAGE)
+    assert page == expected
+    assert pool.pending == 0
+
+
+def test_parser_pool_rejects_pages_when_full():
+    pool = html_parser.ParserPool(workers=1, max_pending=0)
+    with pytest.raises(html_parser.ParserQueueFull):
+        asyncio.run(pool.parse("https://example.com/article", PAGE))
+
+
+def test_streamed_html_without_charset_is_read_as_utf8():
+    html_parser.page_cache.clear()
+    body = PAGE.replace("The Main Title", "Le Café Crème").encode()
+
+    async def chunks():
+        for start in range(0, len(body), 100):
+            yield body[start : start + 100]
+
+    for backend in ["bs4", "lxml"]:
+        html_parser.HTML_PARSER_BACKEND = backend
+        html_parser.page_cache.clear()
+        page = asyncio.run(
+            html_parser.create_page_from_stream("https://example.com/article", chunks(), None)
+        )
+        assert page.title == "Le Café Crème"
+    html_parser.HTML_PARSER_BACKEND = "bs4"
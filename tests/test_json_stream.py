@@ -0,0 +1,34 @@
+from app.json_stream import PartialJsonObject
+
+
+ANSWER = """ {"oneSentenceSummary": "Solar \\"panels\\" {are} cheap, now.",
+"summaryInNumericBulletPoints": ["1. Prices fell", "2. Demand [grew]"],
+"entities_and_concepts": [{"name": "Solar", "type": "topic", "explanation": "a, b"}],
+"score": 3}"""
+
+
+def test_fields_complete_as_the_answer_streams():
+    parser = PartialJsonObject()
+    completed = []
+    for start in range(0, len(ANSWER), 7):
+        completed.extend(parser.feed(ANSWER[start : start + 7]))
+
+    assert completed == [
+        "oneSentenceSummary",
+        "summaryInNumericBulletPoints",
+        "entities_and_concepts",
+        "score",
+    ]
+    assert parser.fields["oneSentenceSummary"] == 'Solar "panels" {are} cheap, now.'
+    assert parser.fields["summaryInNumericBulletPoints"] == ["1. Prices fell", "2. Demand [grew]"]
+    assert parser.fields["entities_and_concepts"][0]["explanation"] == "a, b"
+    assert parser.fields["score"] == 3
+
+
+def test_incomplete_field_is_not_reported():
+    parser = PartialJsonObject()
+    assert parser.feed('{"oneSentenceSummary": "Solar panels') == []
+    assert parser.feed(' are cheap", "summaryInNumericBulletPoints": ["1. Prices') == [
+        "oneSentenceSummary"
+    ]
+    assert "summaryInNumericBulletPoints" not in parser.fields
@@ -0,0 +1,51 @@
+import asyncio
+import httpx
+from app.models import Bookmark
+import app.app_logic as app_logic
+from app.main import app
+
+""" Runs the paginated listing endpoints with app_logic's queries replaced, no database needed """
+
+
+def get(path: str, params: dict) -> httpx.Response:
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path, params=params)
+
+    return asyncio.run(run())
+
+
+def test_bookmark_listing_returns_the_next_cursor(monkeypatch):
+    calls = []
+
+    async def get_bookmarks_by_user_id_async(user_id, limit, cursor):
+        calls.append((user_id, limit, cursor))
+        bookmarks = [Bookmark(id=1, url="https://example.com/a", user_id=user_id)]
+        return bookmarks, "next-page" if cursor is None else None
+
+    monkeypatch.setattr(
+        app_logic, "get_bookmarks_by_user_id_async", get_bookmarks_by_user_id_async
+    )
+
+    response = get("/bookmark/user/7778888", params={"limit": 1})
+    assert response.status_code == 200
+    assert response.json()[0]["url"] == "https://example.com/a"
+    assert response.headers["X-Next-Cursor"] == "next-page"
+
+    response = get("/bookmark/user/7778888", params={"limit": 1, "cursor": "next-page"})
+    assert response.status_code == 200
+    assert "X-Next-Cursor" not in response.headers
+    assert calls == [("7778888", 1, None), ("7778888", 1, "next-page")]
+
+
+def test_invalid_cursor_is_a_bad_request(monkeypatch):
+    async def get_bookmarks_by_user_id_async(user_id, limit, cursor):
+        raise ValueError("Invalid cursor")
+
+    monkeypatch.setattr(
+        app_logic, "get_bookmarks_by_user_id_async", get_bookmarks_by_user_id_async
+    )
+
+    response = get("/bookmark/user/7778888", params={"cursor": "garbage"})
+    assert response.status_code == 400
@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from app.llm_retry import ApiCallException, RetryPolicy, parse_retry_after
+
+
+def api_error(status_code, retry_after=None):
+    return ApiCallException(
+        "Error during API call",
+        {"status_code": status_code, "reason": "", "retry_after": retry_after},
+    )
+
+
+def failing_call(errors: list, result="answer"):
+    """Call that raises the given errors in order, then returns result"""
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return result
+
+    return call, calls
+
+
+def test_retries_rate_limit_and_server_errors():
+    call, calls = failing_call([api_error(429), api_error(503)])
+    policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+    result, attempts = asyncio.run(policy.run(call))
+    assert result == "answer"
+    assert attempts == 3
+    assert len(calls) == 3
+
+
+def test_gives_up_after_max_attempts():
+    call, calls = failing_call([api_error(500)] * 5)
+    policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+    with pytest.raises(ApiCallException) as e:
+        asyncio.run(policy.run(call))
+    assert e.value.attempts == 2
+    assert len(calls) == 2
+
+
+def test_does_not_retry_client_errors():
+    call, calls = failing_call([api_error(401)])
+    policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+    with pytest.raises(ApiCallException):
+        asyncio.run(policy.run(call))
+    assert len(calls) == 1
+
+
+def test_too_long_is_retried_only_when_text_can_be_shortened():
+    policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0)
+
+    call, calls = failing_call([api_error(422)])
+    with pytest.raises(ApiCallException):
+        asyncio.run(policy.run(call))
+    assert len(calls) == 1
+
+    shortened = []
+    call, calls = failing_call([api_error(422)])
+    result, attempts = asyncio.run(
+        policy.run(call, on_too_long=lambda: shortened.append(1))
+    )
+    assert attempts == 2
+    assert len(shortened) == 1
+
+
+def test_backoff_honours_retry_after():
+    policy = RetryPolicy(base_delay=1, max_delay=60)
+    assert policy.backoff(1, retry_after=10) >= 10
+    assert policy.backoff(1, retry_after=600) == 60
+    assert 0 <= policy.backoff(3) <= 4
+    assert parse_retry_after("5") == 5
+    assert parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+    assert parse_retry_after(None) is None
@@ -0,0 +1,101 @@
+import asyncio
+from aiohttp import web
+from app.page_fetcher import PageFetcher
+
+""" Runs PageFetcher against a local aiohttp server with slow, huge and concurrent pages """
+
+
+async def start_server(handlers: dict) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    for path, handler in handlers.items():
+        app.router.add_get(path, handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def run_with_server(handlers: dict, test, **fetcher_options):
+    async def run():
+        runner, base_url = await start_server(handlers)
+        fetcher = PageFetcher(**fetcher_options)
+        try:
+            return await test(fetcher, base_url)
+        finally:
+            await fetcher.close()
+            await runner.cleanup()
+
+    return asyncio.run(run())
+
+
+def test_fetches_and_decodes_the_page_charset():
+    async def page(request):
+        return web.Response(
+            body="<p>Café crème</p>".encode("latin-1"),
+            content_type="text/html",
+            charset="latin-1",
+        )
+
+    async def missing(request):
+        return web.Response(status=404)
+
+    async def test(fetcher, base_url):
+        assert await fetcher.fetch(f"{base_url}/page") == "<p>Café crème</p>"
+        assert await fetcher.fetch(f"{base_url}/missing") is None
+
+    run_with_server({"/page": page, "/missing": missing}, test)
+
+
+def test_slow_page_times_out():
+    async def slow(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(b"<html>")
+        await asyncio.sleep(2)
+        await response.write(b"</html>")
+        return response
+
+    async def test(fetcher, base_url):
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        assert await fetcher.fetch(f"{base_url}/slow") is None
+        assert loop.time() - start_time < 1
+
+    run_with_server({"/slow": slow}, test, read_timeout=0.2)
+
+
+def test_huge_page_is_cut_off_at_max_bytes():
+    async def huge(request):
+        response = web.StreamResponse()
+        response.content_type = "text/html"
+        await response.prepare(request)
+        for _ in range(100):
+            await response.write(b"<p>" + b"a" * 100 * 1024 + b"</p>")
+        return response
+
+    async def test(fetcher, base_url):
+        html = await fetcher.fetch(f"{base_url}/huge")
+        assert len(html) == 256 * 1024
+        assert html.startswith("<p>aaa")
+
+    run_with_server({"/huge": huge}, test, max_bytes=256 * 1024)
+
+
+def test_connections_per_host_are_limited():
+    state = {"in_flight": 0, "max_in_flight": 0}
+
+    async def page(request):
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        await asyncio.sleep(0.05)
+        state["in_flight"] -= 1
+        return web.Response(text="<p>page</p>", content_type="text/html")
+
+    async def test(fetcher, base_url):
+        pages = await asyncio.gather(*[fetcher.fetch(f"{base_url}/page") for _ in range(8)])
+        assert pages == ["<p>page</p>"] * 8
+        assert state["max_in_flight"] == 2
+
+    run_with_server({"/page": page}, test, max_per_host=2)
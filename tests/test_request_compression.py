@@ -0,0 +1,125 @@
+import gzip
+import zlib
+import asyncio
+import tracemalloc
+import pytest
+from fastapi import FastAPI, Request
+from app.request_compression import DecompressRequestMiddleware
+
+""" Sends compressed bodies in chunks through the middleware to a FastAPI app echoing their size """
+
+app = FastAPI()
+app.add_middleware(DecompressRequestMiddleware, max_size=1024 * 1024)
+
+
+@app.post("/echo")
+async def echo(request: Request):
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+    return {"size": size, "encoding": request.headers.get("content-encoding")}
+
+
+def post(body: bytes, encoding: str, chunk_size: int = 1000) -> tuple[int, bytes]:
+    chunks = [body[start : start + chunk_size] for start in range(0, len(body), chunk_size)]
+    messages = [
+        {"type": "http.request", "body": chunk, "more_body": index < len(chunks) - 1}
+        for index, chunk in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "POST",
+        "scheme": "http",
+        "path": "/echo",
+        "raw_path": b"/echo",
+        "query_string": b"",
+        "root_path": "",
+        "headers": [
+            (b"content-encoding", encoding.encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+        "client": ("127.0.0.1", 1234),
+        "server": ("127.0.0.1", 80),
+    }
+    asyncio.run(app(scope, receive, send))
+    status = sent[0]["status"]
+    content = b"".join(message.get("body", b"") for message in sent[1:])
+    return status, content
+
+
+def test_gzip_and_deflate_bodies_are_decompressed():
+    html = b"<p>" + b"page text " * 10000 + b"</p>"
+
+    status, content = post(gzip.compress(html), "gzip")
+    assert status == 200
+    assert content == b'{"size":%d,"encoding":null}' % len(html)
+
+    status, content = post(zlib.compress(html), "deflate")
+    assert status == 200
+    assert content == b'{"size":%d,"encoding":null}' % len(html)
+
+
+def test_bodies_over_the_limit_are_rejected():
+    status, _ = post(gzip.compress(b"a" * 2 * 1024 * 1024), "gzip")
+    assert status == 413
+
+
+def zeros(size: int) -> bytes:
+    """ gzip of size zero bytes, compressed without holding them all in memory """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 31)
+    chunk = bytes(1024 * 1024)
+    body = b"".join(compressor.compress(chunk) for _ in range(size // len(chunk)))
+    return body + compressor.flush()
+
+
+def assert_rejected_without_inflating(body: bytes, encoding: str):
+    tracemalloc.start()
+    try:
+        status, _ = post(body, encoding, chunk_size=len(body))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert status == 413
+    assert peak < 16 * 1024 * 1024
+
+
+def test_bomb_in_one_chunk_is_rejected_without_inflating():
+    ## ~200 KB of gzip inflating to 200 MB
+    assert_rejected_without_inflating(zeros(200 * 1024 * 1024), "gzip")
+
+
+def test_brotli_bodies_are_capped():
+    brotli = pytest.importorskip("brotli")
+    html = b"<p>" + b"page text " * 10000 + b"</p>"
+    status, content = post(brotli.compress(html), "br")
+    assert status == 200
+    assert content == b'{"size":%d,"encoding":null}' % len(html)
+
+    assert_rejected_without_inflating(brotli.compress(bytes(200 * 1024 * 1024), quality=1), "br")
+
+
+def test_zstd_bodies_are_capped():
+    zstandard = pytest.importorskip("zstandard")
+    html = b"<p>" + b"page text " * 10000 + b"</p>"
+    status, content = post(zstandard.ZstdCompressor().compress(html), "zstd")
+    assert status == 200
+    assert content == b'{"size":%d,"encoding":null}' % len(html)
+
+    bomb = zstandard.ZstdCompressor(level=19).compress(bytes(200 * 1024 * 1024))
+    assert_rejected_without_inflating(bomb, "zstd")
+
+
+def test_unsupported_and_invalid_encodings():
+    assert post(b"data", "compress")[0] == 415
+    assert post(b"not gzip data", "gzip")[0] == 400
+    assert post(gzip.compress(b"page text " * 1000)[:-20], "gzip")[0] == 400
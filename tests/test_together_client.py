@@ -0,0 +1,230 @@
+import os
+import json
+import asyncio
+from aiohttp import web
+
+os.environ.setdefault("TOGETHER_TOKEN", "test")
+
+from app import icog_util
+from app import together_api_client
+from app.together_api_client import TogetherMixtralClient, InclusiveTemplate
+from app.json_stream import PartialJsonObject
+
+""" Runs TogetherMixtralClient.generate end to end with api_call stubbed, no API or Hub access """
+
+MODEL_NAME = "mistralai/Mixtral-8x7B-Instruct-v0.1"
+
+ANSWER = {
+    "oneSentenceSummary": "Solar panels are cheap now.",
+    "whatThisArticleIsAbout": "Solar panel prices",
+    "summaryInNumericBulletPoints": ["1. Prices fell", "2. Demand grew"],
+    "entities_and_concepts": [
+        {"name": "Solar", "type": "topic", "explanation": "Energy from the sun"}
+    ],
+    "usage": None,
+}
+
+
+class WordTokenizer:
+    """One token per word, enough to count and cut articles in tests"""
+
+    def encode(self, text, add_special_tokens=True):
+        return text.split()
+
+    def __call__(self, texts, add_special_tokens=True):
+        return {"input_ids": [text.split() for text in texts]}
+
+    def decode(self, ids):
+        return " ".join(ids)
+
+
+def make_client(answer: dict = ANSWER) -> tuple[TogetherMixtralClient, list]:
+    """Client whose api_call records the payloads and answers with answer"""
+    icog_util._tokenizers[MODEL_NAME] = WordTokenizer()
+    payloads = []
+    client = TogetherMixtralClient()
+
+    async def api_call(payload):
+        payloads.append(payload)
+        return {
+            "output": {"choices": [{"text": json.dumps(answer)}]},
+            "usage": {"prompt_tokens": 100, "completion_tokens": 50, "total_tokens": 150},
+        }
+
+    client.api_call = api_call
+    return client, payloads
+
+
+def run(test):
+    ## The client opens its aiohttp session in __init__, which needs a running loop
+    async def main():
+        client, payloads = make_client()
+        try:
+            return await test(client, payloads)
+        finally:
+            await client._client_session.close()
+
+    return asyncio.run(main())
+
+
+def test_generate_sends_the_article_with_the_answer_schema():
+    async def test(client, payloads):
+        answer = await client.generate("Solar panels got cheaper this year.")
+
+        assert answer.oneSentenceSummary == ANSWER["oneSentenceSummary"]
+        assert answer.entities_and_concepts[0].name == "Solar"
+        assert answer.usage["total_tokens"] == 150
+        assert answer.usage["truncated"] is False
+        assert answer.usage["retries"] == 0
+
+        payload = payloads[0]
+        assert payload["model"] == MODEL_NAME
+        assert payload["temperature"] == 0.2
+        assert payload["top_k"] == 70
+        assert payload["response_format"]["type"] == "json_object"
+        assert "oneSentenceSummary" in payload["response_format"]["schema"]["properties"]
+        assert len(payload["messages"]) == 4
+        assert payload["messages"][-1]["content"].endswith("Solar panels got cheaper this year.")
+
+    run(test)
+
+
+def test_generate_renders_the_template():
+    async def test(client, payloads):
+        await client.generate("Solar panels got cheaper.", template=InclusiveTemplate(), top_p=0.5)
+
+        messages = payloads[0]["messages"]
+        assert len(messages) == 2
+        assert messages[1]["content"] == InclusiveTemplate()("Solar panels got cheaper.")
+        assert payloads[0]["top_p"] == 0.5
+
+    run(test)
+
+
+def test_long_article_is_cut_to_the_budget():
+    async def test(client, payloads):
+        client._max_length = client.scaffold_tokens() + 1024 + 50
+        body_text = ". ".join(f"Sentence number {i} about solar panels" for i in range(100))
+        answer = await client.generate(body_text)
+
+        article = payloads[0]["messages"][-1]["content"]
+        assert len(article.split()) <= 50 + 1
+        assert answer.usage["truncated"] is True
+        assert answer.usage["article_tokens"] == len(body_text.split())
+
+    run(test)
+
+
+def test_map_reduce_summarizes_chunks_then_reduces_their_summaries(monkeypatch):
+    monkeypatch.setattr(together_api_client, "LLM_MAP_CHUNK_TOKENS", 60)
+
+    async def test(client, payloads):
+        client._max_length = client.scaffold_tokens() + 1024 + 100
+        body_text = ". ".join(f"Sentence number {i} about solar panels" for i in range(100))
+        answer_call = client.api_call
+
+        async def api_call(payload):
+            if "response_format" in payload:
+                return await answer_call(payload)
+            ## A map call, answer with the part number it was asked to summarize
+            payloads.append(payload)
+            part = payload["messages"][-1]["content"].split("Part ")[1].split(" ")[0]
+            return {
+                "output": {"choices": [{"text": f" Notes of part {part} "}]},
+                "usage": {"prompt_tokens": 80, "completion_tokens": 10, "total_tokens": 90},
+            }
+
+        client.api_call = api_call
+        answer = await client.generate_map_reduce(body_text)
+
+        map_payloads = [payload for payload in payloads if "response_format" not in payload]
+        reduce_payloads = [payload for payload in payloads if "response_format" in payload]
+        chunks = client.split_into_chunks(body_text, 60)
+        assert len(chunks) > 1
+        assert len(map_payloads) == len(chunks)
+        assert len(reduce_payloads) == 1
+        assert reduce_payloads[0]["messages"][-1]["content"] == "Article: " + "\n".join(
+            f"Notes of part {part}" for part in range(1, len(chunks) + 1)
+        )
+
+        assert answer.oneSentenceSummary == ANSWER["oneSentenceSummary"]
+        assert answer.usage["mode"] == "map_reduce"
+        assert answer.usage["chunks"] == len(chunks)
+        assert answer.usage["map"]["prompt_tokens"] == 80 * len(chunks)
+        assert answer.usage["reduce"]["prompt_tokens"] == 100
+
+    run(test)
+
+
+def test_streamed_fields_are_handed_over_as_they_complete():
+    async def test(client, payloads):
+        text = json.dumps(ANSWER)
+        fields = []
+
+        async def api_call_stream(payload, on_field):
+            payloads.append(payload)
+            parser = PartialJsonObject()
+            for start in range(0, len(text), 16):
+                for key in parser.feed(text[start : start + 16]):
+                    await on_field(key, parser.fields[key])
+                    ## The answer isn't finished when the first fields arrive
+                    fields.append((key, start + 16 < len(text)))
+            return {"output": {"choices": [{"text": parser.text}]}, "usage": {"total_tokens": 9}}
+
+        async def on_field(key, value):
+            assert value == ANSWER[key]
+
+        client.api_call_stream = api_call_stream
+        answer = await client.generate("Solar panels got cheaper.", on_field=on_field)
+
+        assert [key for key, _ in fields] == list(ANSWER)
+        assert fields[0][1] is True
+        assert "response_format" in payloads[0]
+        assert answer.summaryInNumericBulletPoints == ANSWER["summaryInNumericBulletPoints"]
+        assert answer.usage["total_tokens"] == 9
+
+    run(test)
+
+
+def test_stream_events_are_parsed_from_the_api():
+    text = json.dumps(ANSWER)
+
+    async def inference(request):
+        payload = await request.json()
+        assert payload["stream_tokens"] is True
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for start in range(0, len(text), 10):
+            event = {"choices": [{"text": text[start : start + 10]}]}
+            await response.write(f"data: {json.dumps(event)}\n\n".encode())
+        await response.write(b'data: {"choices": [{"text": ""}], "usage": {"total_tokens": 7}}\n\n')
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_post("/inference", inference)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+
+        client, _ = make_client()
+        client._api_url = f"http://127.0.0.1:{port}/inference"
+        keys = []
+
+        async def on_field(key, value):
+            keys.append(key)
+
+        try:
+            res = await client.api_call_stream({"messages": []}, on_field)
+        finally:
+            await client._client_session.close()
+            await runner.cleanup()
+
+        assert keys == list(ANSWER)
+        assert json.loads(res["output"]["choices"][0]["text"]) == ANSWER
+        assert res["usage"] == {"total_tokens": 7}
+
+    asyncio.run(main())
@@ -1,5 +1,6 @@
+import time
 import unittest
-from app.icog_util import remove_stop_words
+from app.icog_util import remove_stop_words, truncate_text, LRUCache
 
 
 class TestUtil(unittest.TestCase):
@@ -9,6 +10,42 @@ class TestUtil(unittest.TestCase):
         answer = "Nick likes play football however fond tennis"
         assert (remove_stop_words(text) == answer)
 
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(max_size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+        assert cache.stats()["hits"] == 3
+        assert cache.stats()["misses"] == 1
+
+    def test_lru_cache_expires_entries(self):
+        cache = LRUCache(max_size=2, ttl=0.01)
+        cache.set("a", 1)
+        time.sleep(0.02)
+        assert cache.get("a") is None
+        assert len(cache) == 0
+
+    def test_truncate_text_keeps_central_sentences_in_order(self):
+        text = (
+            "Solar panels convert sunlight into electricity. "
+            "My cat likes naps. "
+            "Cheaper solar panels made solar electricity popular. "
+            "Electricity from solar panels is stored in batteries."
+        )
+        summary = truncate_text(text, llm_max_tokens=30, number_of_tokens=40)
+        assert "My cat likes naps." not in summary
+        assert summary.index("convert") < summary.index("Cheaper")
+        assert len(summary) <= len(text) * 30 / 40
+
+    def test_truncate_text_without_sentences(self):
+        assert truncate_text("", llm_max_tokens=10, number_of_tokens=20) == ""
+        assert truncate_text("no punctuation at all", 2, 20) == "no"
+        assert truncate_text("Short text.", 10, 5) == "Short text."
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,86 @@
+import asyncio
+import app.app_logic as app_logic
+import app.worker as worker
+from app.models import Job
+
+""" Runs worker.run_job with app_logic's job and document functions replaced, no database needed """
+
+
+def test_lock_is_refreshed_while_the_job_runs(monkeypatch):
+    calls = []
+
+    async def get_document_by_id_async(document_id):
+        return {"id": document_id}
+
+    async def extract_info_from_doc(document, summarization_mode):
+        ## A long LLM run, several heartbeat intervals
+        await asyncio.sleep(0.1)
+        return document
+
+    async def heartbeat_job_async(job):
+        calls.append("heartbeat")
+        return True
+
+    async def complete_job_async(job):
+        calls.append("complete")
+
+    monkeypatch.setattr(app_logic, "JOB_HEARTBEAT_INTERVAL", 0.02)
+    monkeypatch.setattr(app_logic, "get_document_by_id_async", get_document_by_id_async)
+    monkeypatch.setattr(app_logic, "extract_info_from_doc", extract_info_from_doc)
+    monkeypatch.setattr(app_logic, "heartbeat_job_async", heartbeat_job_async)
+    monkeypatch.setattr(app_logic, "complete_job_async", complete_job_async)
+
+    async def run():
+        await worker.run_job(Job(id=1, kind="generate", document_id=7, attempts=1))
+        ## The heartbeat stops with the job
+        await asyncio.sleep(0.05)
+
+    asyncio.run(run())
+
+    assert calls.count("heartbeat") >= 3
+    assert calls[-1] == "complete"
+
+
+def test_job_is_stopped_when_another_worker_claims_it(monkeypatch):
+    calls = []
+
+    async def get_document_by_id_async(document_id):
+        return {"id": document_id}
+
+    async def extract_info_from_doc(document, summarization_mode):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            calls.append("cancelled")
+            raise
+        return document
+
+    async def heartbeat_job_async(job):
+        ## The job outlived JOB_LOCK_TIMEOUT and was claimed again
+        return False
+
+    async def complete_job_async(job):
+        calls.append("complete")
+
+    async def fail_job_async(job, error):
+        calls.append("fail")
+
+    monkeypatch.setattr(app_logic, "JOB_HEARTBEAT_INTERVAL", 0.02)
+    monkeypatch.setattr(app_logic, "get_document_by_id_async", get_document_by_id_async)
+    monkeypatch.setattr(app_logic, "extract_info_from_doc", extract_info_from_doc)
+    monkeypatch.setattr(app_logic, "heartbeat_job_async", heartbeat_job_async)
+    monkeypatch.setattr(app_logic, "complete_job_async", complete_job_async)
+    monkeypatch.setattr(app_logic, "fail_job_async", fail_job_async)
+
+    asyncio.run(worker.run_job(Job(id=1, kind="generate", document_id=7, attempts=1)))
+
+    assert calls == ["cancelled"]
+
+
+def test_finishing_a_job_only_updates_the_current_claim():
+    job = Job(id=1, kind="generate", document_id=7, attempts=2)
+    where = str(app_logic.owned_job(job).compile(compile_kwargs={"literal_binds": True}))
+
+    assert "job.id = 1" in where
+    assert "job.attempts = 2" in where
+    assert "job.status = 'Running'" in where